@@ -1,18 +1,35 @@
-import json
 import os
 from flask import request, _request_ctx_stack, abort
 from flask import _app_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
-from dotenv import load_dotenv
 
-load_dotenv()
+from auth.jwks import JWKSKeyStore, JWKSError
+from auth.rate_limit import limit_subject
+from auth.token_cache import TokenCache
+from settings import load_env
+from timing import timed
+
+load_env()
 
 #Auth0 Data
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 ALGORITHMS = os.getenv("ALGORITHMS")
 API_AUDIENCE = os.getenv("API_AUDIENCE")
+JWKS_URL = os.getenv("JWKS_URL", f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+#Signing keys are cached in-process rather than fetched per request
+jwks_store = JWKSKeyStore(
+    JWKS_URL,
+    ttl=int(os.getenv("JWKS_TTL", 600)),
+    min_refresh_interval=int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", 30))
+)
+
+#Verified payloads are reused until the token expires
+token_cache = TokenCache(
+    max_size=int(os.getenv("TOKEN_CACHE_SIZE", 1024)),
+    enabled=os.getenv("TOKEN_CACHE_ENABLED", "True").lower() != "false"
+)
 
 
 ## AuthError Exception
@@ -28,11 +45,13 @@ class AuthError(Exception):
 
 ## Auth Header - referred to Udacity
 # modules content
-def get_token_auth_header():
-    if 'Authorization' not in request.headers:
+# headers defaults to the current request's
+def get_token_auth_header(headers=None):
+    headers = request.headers if headers is None else headers
+    if 'Authorization' not in headers:
         abort(401)
     #get token
-    auth_header = request.headers.get('Authorization', None)
+    auth_header = headers.get('Authorization', None)
     header_parts = auth_header.split()
 
     #check if its valid
@@ -42,17 +61,29 @@ def get_token_auth_header():
         abort(401)
     return header_parts[1]
 
+## Builds the set of granted permissions once per verified token
+def compile_permissions(payload):
+    if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
 ## Checks for permissions in token - referred to Udacity
 # modules content
-def check_permissions(permission, payload):
+# permission may be a single permission or a collection which must all
+# be granted; any_of requires at least one of its permissions
+def check_permissions(permission, payload, granted=None, any_of=None):
+    if granted is None:
+        granted = compile_permissions(payload)
 
-    if 'permissions' not in payload:
+    if granted is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
-    
-    if permission not in payload['permissions']:
+
+    required = (permission,) if isinstance(permission, str) else permission
+    if not granted.issuperset(required) or \
+            (any_of and granted.isdisjoint(any_of)):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -60,33 +91,56 @@ def check_permissions(permission, payload):
     
     return True
 
+## Tokens are rate limited by subject, a token without one is refused
+# rather than sharing a bucket with every other such token
+def check_subject(payload):
+    if not payload.get('sub'):
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Subject not included in JWT.'
+        }, 401)
+    return payload['sub']
+
 ## Checks unverified token - referred to Udacity
 # modules content
 def verify_decode_jwt(token):
-    #getting public key
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    kid = _get_kid(token)
+    try:
+        rsa_key = jwks_store.get_key(kid)
+    except JWKSError as e:
+        raise _jwks_unavailable(e)
+    return decode_jwt(token, rsa_key)
+
+## verify_decode_jwt for asyncio callers, fetching keys doesn't block
+async def verify_decode_jwt_async(token):
+    kid = _get_kid(token)
+    try:
+        rsa_key = await jwks_store.get_key_async(kid)
+    except JWKSError as e:
+        raise _jwks_unavailable(e)
+    return decode_jwt(token, rsa_key)
+
+def _get_kid(token):
     #get data in header
     unverified_header = jwt.get_unverified_header(token)
 
     #choosing key
-    rsa_key={}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+def _jwks_unavailable(e):
+    print(e)
+    return AuthError({
+        'code': 'jwks_unavailable',
+        'description': 'Unable to fetch signing keys.'
+    }, 503)
 
+## Verifies token with rsa_key, the key of its kid (None if there is none)
+def decode_jwt(token, rsa_key):
     #verify
     if rsa_key:
         try:
@@ -124,14 +178,31 @@ def verify_decode_jwt(token):
 
 ## requires auth wrapper - referred to Udacity
 # modules content
-def requires_auth(permission=''):
+# requires_auth('a', 'b') needs both permissions,
+# requires_auth(any_of=('a', 'b')) needs either of them
+# calls are rate limited per token subject, see auth.rate_limit
+def requires_auth(*permissions, any_of=None):
+    required = frozenset(permissions)
+    any_of = frozenset(any_of) if any_of else None
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                cached = token_cache.get(token)
+                if cached is None:
+                    payload = verify_decode_jwt(token)
+                    granted = compile_permissions(payload)
+                    token_cache.put(token, payload, granted)
+                else:
+                    payload, granted = cached
+                check_subject(payload)
+                #counted before the permission check, so refused calls count too
+                limit_subject(payload)
+                if required or any_of:
+                    check_permissions(required, payload, granted, any_of)
             return f(payload, *args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+from timing import timed
+
+
+'''
+JWKSError Exception
+Raised when no usable key set can be fetched from the JWKS endpoint
+'''
+class JWKSError(Exception):
+    pass
+
+
+'''
+JWKSKeyStore
+In-process cache of the signing keys published at a JWKS url.
+
+    url                     - https:// (Auth0) or file:// url of the key set
+    ttl                     - seconds a fetched key set is considered fresh
+    min_refresh_interval    - minimum seconds between fetches triggered by
+                              an unknown kid, so bad tokens can't force a
+                              refetch storm
+    timeout                 - socket timeout for a single fetch
+
+Once the key set is older than ttl, lookups keep answering from the last
+good key set while a single background thread fetches a fresh one.
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=600, min_refresh_interval=30, timeout=5,
+                 clock=time.monotonic):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._keys = None
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self.fetch_count = 0
+
+    ## fetch the key set and keep only the fields needed to verify RS256
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key.get('kty'),
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key.get('n'),
+                'e': key.get('e')
+            }
+        return keys
+
+    ## fetch synchronously, keeping the last good key set on failure
+    def refresh(self):
+        with self._lock:
+            self._last_attempt = self.clock()
+        try:
+            with timed('jwks'):
+                keys = self._fetch()
+        except Exception as e:
+            with self._lock:
+                self._refreshing = False
+                if self._keys is None:
+                    raise JWKSError(f'Unable to fetch JWKS: {e}')
+            print(e)
+            return False
+
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = self.clock()
+            self._refreshing = False
+            self.fetch_count += 1
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self.refresh, daemon=True)
+        thread.start()
+
+    def _is_stale(self):
+        return self.clock() - self._fetched_at >= self.ttl
+
+    def _can_refetch(self):
+        return (self._last_attempt is None or
+                self.clock() - self._last_attempt >= self.min_refresh_interval)
+
+    ## returns the rsa key for kid, or None if the key set doesn't have it
+    def get_key(self, kid):
+        if self._keys is None:
+            self.refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and not self._refreshing and self._can_refetch():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    ## get_key for asyncio callers - a lookup which has to fetch runs in a
+    # worker thread, so it never blocks the event loop
+    async def get_key_async(self, kid):
+        keys = self._keys
+        if keys is not None and kid in keys:
+            if self._is_stale():
+                self._refresh_in_background()
+            return keys[kid]
+        return await asyncio.to_thread(self.get_key, kid)
+
+    ## drop the cached key set, the next lookup fetches synchronously
+    def clear(self):
+        with self._lock:
+            self._keys = None
+            self._fetched_at = None
+            self._last_attempt = None
@@ -0,0 +1,174 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+
+from settings import load_env
+
+load_env()
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() != "false"
+#requests per second, and the burst above it, per token subject
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", 10))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 20))
+#the same per client address, for the endpoints open without a token. Off
+#unless turned on - behind a proxy every client has the proxy's address
+#until TRUSTED_PROXY_COUNT is set
+ANONYMOUS_RATE_LIMIT_ENABLED = os.getenv("ANONYMOUS_RATE_LIMIT_ENABLED", "False").lower() == "true"
+ANONYMOUS_RATE_LIMIT_RATE = float(os.getenv("ANONYMOUS_RATE_LIMIT_RATE", 5))
+ANONYMOUS_RATE_LIMIT_BURST = int(os.getenv("ANONYMOUS_RATE_LIMIT_BURST", 10))
+
+
+'''
+RateLimitExceeded Exception
+retry_after - whole seconds until the client has a token again
+'''
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+'''
+Rate limit backend interface
+    take(key, rate, burst) - takes one token from the bucket of key,
+                             which holds up to burst tokens and refills
+                             at rate tokens a second. Returns 0 when a
+                             token was taken, otherwise the seconds until
+                             one is available
+
+A backend shared between gunicorn workers (e.g. RedisRateLimitBackend)
+makes the limit hold for the whole deployment rather than per worker.
+'''
+class RateLimitBackend:
+    def take(self, key, rate, burst):
+        raise NotImplementedError
+
+
+'''
+LocalRateLimitBackend
+In-process token buckets, the least recently used evicted beyond
+max_keys (an evicted client starts again with a full bucket)
+'''
+class LocalRateLimitBackend(RateLimitBackend):
+    def __init__(self, max_keys=10000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+'''
+RedisRateLimitBackend
+Shared token buckets over a redis client (anything with eval), e.g.
+    RedisRateLimitBackend(redis.Redis.from_url(url))
+Each take is one atomic script run. Buckets expire once they would be full.
+'''
+class RedisRateLimitBackend(RateLimitBackend):
+    SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return wait
+'''
+
+    def __init__(self, client, prefix='capstone:ratelimit:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key, rate, burst):
+        #the script returns milliseconds, redis truncates numbers to integers
+        wait_ms = self.client.eval(self.SCRIPT, 1, self.prefix + key, rate, burst, self.clock())
+        return int(wait_ms) / 1000
+
+
+'''
+RateLimiter
+Token bucket per verified token subject (requires_auth) and per client
+address (rate_limited, for endpoints open without a token)
+'''
+class RateLimiter:
+    def __init__(self, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST,
+                 anonymous_rate=ANONYMOUS_RATE_LIMIT_RATE,
+                 anonymous_burst=ANONYMOUS_RATE_LIMIT_BURST,
+                 backend=None, enabled=RATE_LIMIT_ENABLED,
+                 anonymous_enabled=ANONYMOUS_RATE_LIMIT_ENABLED):
+        self.rate = rate
+        self.burst = burst
+        self.anonymous_rate = anonymous_rate
+        self.anonymous_burst = anonymous_burst
+        self.backend = backend if backend is not None else LocalRateLimitBackend()
+        self.enabled = enabled
+        self.anonymous_enabled = anonymous_enabled
+
+    def _check(self, key, rate, burst):
+        if not self.enabled:
+            return
+        wait = self.backend.take(key, rate, burst)
+        if wait:
+            raise RateLimitExceeded(max(1, math.ceil(wait)))
+
+    def check_subject(self, subject):
+        self._check(f'sub:{subject}', self.rate, self.burst)
+
+    def check_address(self, address):
+        if not self.anonymous_enabled:
+            return
+        self._check(f'ip:{address}', self.anonymous_rate, self.anonymous_burst)
+
+
+## Each app has its own limiter (see init_rate_limits), apps without one
+# aren't limited
+def current_limiter():
+    return current_app.extensions.get('rate_limiter')
+
+def limit_subject(payload):
+    limiter = current_limiter()
+    if limiter is not None:
+        limiter.check_subject(payload['sub'])
+
+## route decorator, limits by client address - the X-Forwarded-For one
+# when the app trusts its proxies, see TRUSTED_PROXY_COUNT
+def rate_limited(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        limiter = current_limiter()
+        if limiter is not None:
+            limiter.check_address(request.remote_addr)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def init_rate_limits(app, limiter=None):
+    limiter = limiter if limiter is not None else RateLimiter()
+    app.extensions['rate_limiter'] = limiter
+    return limiter
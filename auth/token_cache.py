@@ -0,0 +1,84 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+TokenCache
+Bounded LRU cache of verified JWT payloads and their compiled permission
+sets, keyed on a hash of the token.
+
+    max_size    - number of tokens kept before the least recently used
+                  one is evicted
+    enabled     - when False every lookup misses and nothing is stored
+
+An entry is only kept until the token's exp claim, so a cached payload
+is never served for a token jwt.decode would reject as expired.
+'''
+class TokenCache:
+    def __init__(self, max_size=1024, enabled=True, clock=time.time):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            payload, permissions, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload, permissions
+
+    def put(self, token, payload, permissions=None):
+        if not self.enabled or self.max_size <= 0:
+            return
+
+        expires_at = payload.get('exp')
+        if expires_at is None or expires_at <= self.clock():
+            return
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,151 @@
+'''
+Load test of the sync (gunicorn) and async (hypercorn) deployments:
+
+    python -m benchmarks.asgi_load --database-url postgresql://localhost/bench
+
+Seeds the database, starts each server in turn and drives it with
+concurrent clients fetching GET /actors?limit=20 for --duration seconds.
+--slow-ms makes every client pause between the request line and the rest
+of its headers, like a client on a slow network. A sync worker is blocked
+for that time, an event loop is not.
+'''
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from sqlalchemy import create_engine
+
+from models import db
+from benchmarks.seed import seed
+
+PATH = '/actors?limit=20'
+
+
+def servers(args):
+    bind = f'{args.host}:{args.port}'
+    return {
+        'gunicorn sync': [
+            sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+            '--worker-class', 'sync', '--bind', bind, 'flaskr:create_app()'],
+        'hypercorn async': [
+            sys.executable, '-m', 'hypercorn', '--workers', '1',
+            '--bind', bind, 'flaskr.asgi:create_asgi_app()']
+    }
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server did not start on {host}:{port}')
+
+
+## One request on a new connection, returns the status code
+async def fetch(host, port, slow_ms):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f'GET {PATH} HTTP/1.1\r\n'.encode('ascii'))
+        if slow_ms:
+            await writer.drain()
+            await asyncio.sleep(slow_ms / 1000)
+        writer.write(f'Host: {host}\r\nConnection: close\r\n\r\n'.encode('ascii'))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def client(host, port, slow_ms, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            status = await fetch(host, port, slow_ms)
+        except (OSError, IndexError, ValueError):
+            status = None
+        if status == 200:
+            latencies.append((time.perf_counter() - start) * 1000)
+        else:
+            errors.append(status)
+
+
+async def run_load(host, port, concurrency, duration, slow_ms):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*[client(host, port, slow_ms, deadline, latencies, errors)
+                           for _ in range(concurrency)])
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(statistics.median(latencies), 2) if latencies else None,
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)], 2) if latencies else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--concurrency', default='10,100,500',
+                        help='comma separated numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--slow-ms', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.begin() as connection:
+        db.metadata.create_all(connection)
+        seed(connection, actors=args.actors, movies=0)
+    engine.dispose()
+
+    env = dict(os.environ, database_path=args.database_url,
+               RESPONSE_CACHE_ENABLED='False', RATE_LIMIT_ENABLED='False')
+    levels = [int(level) for level in args.concurrency.split(',')]
+    results = {}
+    for name, command in servers(args).items():
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.host, args.port)
+            results[name] = {
+                level: asyncio.run(run_load(args.host, args.port, level,
+                                            args.duration, args.slow_ms))
+                for level in levels
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'GET {PATH}, {args.duration:g}s per level, slow clients {args.slow_ms} ms')
+    for name, by_level in results.items():
+        print(f'== {name}')
+        for level, result in by_level.items():
+            print(f'   {level:>5} clients {result["rps"]:9.1f} req/s   '
+                  f'p50 {result["p50_ms"]} ms   p99 {result["p99_ms"]} ms   '
+                  f'errors {result["errors"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+'''
+Bytes on the wire and CPU cost of compressing list responses, no
+database needed:
+
+    python -m benchmarks.compression --rows 1000
+
+Compares identity, gzip levels 1/6/9, brotli (if installed) and a
+CompressedBodyCache hit, which is what a repeated payload costs.
+'''
+import argparse
+import json
+import statistics
+import time
+
+from flaskr.compression import CompressedBodyCache, brotli, compress
+from flaskr.filters import ACTOR_FIELDS
+from flaskr.serializer import dumps, rows_to_dicts
+from benchmarks.serialization import make_rows
+
+
+def time_ms(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    actor_rows, _ = make_rows(args.rows)
+    body = dumps({'success': True, 'actors': rows_to_dicts(actor_rows, ACTOR_FIELDS),
+                  'next_cursor': None})
+
+    variants = [('gzip -1', 'gzip', 1), ('gzip -6', 'gzip', 6), ('gzip -9', 'gzip', 9)]
+    if brotli is not None:
+        variants.append(('br', 'br', None))
+
+    results = {'identity': {'bytes': len(body), 'ms': 0.0}}
+    for name, encoding, level in variants:
+        run = (lambda: compress(body, encoding, level)) if level else \
+            (lambda: compress(body, encoding))
+        results[name] = {'bytes': len(run()), 'ms': time_ms(run, args.repeat)}
+
+    cache = CompressedBodyCache()
+    cache.get_or_compress('etag', body, 'gzip')
+    results['gzip -6 cached'] = {
+        'bytes': results['gzip -6']['bytes'],
+        'ms': time_ms(lambda: cache.get_or_compress('etag', body, 'gzip'), args.repeat)
+    }
+
+    if args.json:
+        print(json.dumps({'rows': args.rows, 'results': results}, indent=2))
+        return
+
+    print(f'GET /actors body with {args.rows} actors, median of {args.repeat} runs')
+    for name, result in results.items():
+        ratio = len(body) / result['bytes']
+        print(f'   {name:<16} {result["bytes"]:>10} bytes {ratio:6.1f}x   {result["ms"]:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+'''
+Load test of every route of the WSGI app:
+
+    python -m benchmarks.load --database-url postgresql://localhost/bench --output base.json
+    python -m benchmarks.load --database-url postgresql://localhost/bench --compare base.json
+
+Seeds actors and movies, signs tokens with a local key published as a JWKS
+file (see benchmarks.tokens), serves the app in-process on a threaded
+werkzeug server and runs each scenario in turn for --duration seconds with
+--concurrency client threads. Reports requests per second, p50/p95/p99
+latency, errors and SQL statements per request.
+
+The clients share the process (and the GIL) with the server, so numbers
+are for comparing runs on the same machine, not capacity planning.
+'''
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event, func, select
+
+from benchmarks.tokens import LocalIssuer
+
+#words and prefixes of the seeded names and titles (benchmarks.seed)
+SEARCH_WORDS = ['ava', 'chen', 'milo khan', 'night', 'gold', 'silent river']
+
+
+'''
+Scenario
+    name - reported name, e.g. 'GET /actors'
+    method - http method
+    make - called with a random.Random, returns (path, json body or None),
+           or None once the scenario has run out of rows to work on
+'''
+class Scenario:
+    def __init__(self, name, method, make):
+        self.name = name
+        self.method = method
+        self.make = make
+
+
+## SQL statements run by the server, counted from its request threads
+class StatementCounter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def incr(self):
+        with self._lock:
+            self.value += 1
+
+
+## Ids of rows created during the run, consumed by the delete scenarios
+class IdPool:
+    def __init__(self):
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    def fill(self, ids):
+        with self._lock:
+            self._ids.extend(ids)
+
+    def take(self, count=1):
+        with self._lock:
+            if len(self._ids) < count:
+                return None
+            return [self._ids.popleft() for _ in range(count)]
+
+
+def scenarios(actor_ids, movie_ids, change_seq, deletable):
+    actor = lambda rng: rng.randint(*actor_ids)
+    movie = lambda rng: rng.randint(*movie_ids)
+
+    def new_actor(rng):
+        return {'name': f'Bench {rng.randint(0, 10 ** 6)}', 'age': rng.randint(8, 90),
+                'gender': rng.choice(['MALE', 'FEMALE', 'NON_BINARY', 'OTHER'])}
+
+    def new_movie(rng):
+        return {'title': f'Bench {rng.randint(0, 10 ** 6)}',
+                'release_date': f'{rng.randint(1950, 2023)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}'}
+
+    #POST /movies stores release_date unparsed, which only postgres accepts
+    def new_undated_movie(rng):
+        return {'title': f'Bench {rng.randint(0, 10 ** 6)}'}
+
+    def delete_one(key):
+        def make(rng):
+            ids = deletable[key].take()
+            return (f'/{key}/{ids[0]}', None) if ids else None
+        return make
+
+    def delete_cast(rng):
+        pairs = deletable['castings'].take()
+        return (f'/movies/{pairs[0][0]}/actors/{pairs[0][1]}', None) if pairs else None
+
+    def delete_bulk(key):
+        def make(rng):
+            ids = deletable[key].take(10)
+            return (f'/{key}/bulk', {'ids': ids}) if ids else None
+        return make
+
+    return [
+        Scenario('GET /', 'GET', lambda rng: ('/', None)),
+        Scenario('GET /actors', 'GET', lambda rng: ('/actors?limit=20', None)),
+        Scenario('GET /actors filtered', 'GET', lambda rng: (
+            f'/actors?gender=FEMALE&age_min={rng.randint(8, 60)}&sort=-age&limit=50', None)),
+        Scenario('GET /movies', 'GET', lambda rng: ('/movies?limit=20', None)),
+        Scenario('GET /movies filtered', 'GET', lambda rng: (
+            f'/movies?release_date_from={rng.randint(1950, 2020)}-01-01'
+            '&sort=release_date&limit=50', None)),
+        Scenario('GET /actors/<id>', 'GET', lambda rng: (f'/actors/{actor(rng)}', None)),
+        Scenario('GET /movies/<id>', 'GET', lambda rng: (f'/movies/{movie(rng)}', None)),
+        Scenario('GET /actors/<id>/movies', 'GET', lambda rng: (
+            f'/actors/{actor(rng)}/movies', None)),
+        Scenario('GET /movies/<id>/actors', 'GET', lambda rng: (
+            f'/movies/{movie(rng)}/actors', None)),
+        Scenario('GET /actors include', 'GET', lambda rng: (
+            '/actors?limit=20&include=movies', None)),
+        Scenario('GET /movies include', 'GET', lambda rng: (
+            '/movies?limit=20&include=actors', None)),
+        Scenario('GET /search', 'GET', lambda rng: (
+            f'/search?q={quote(rng.choice(SEARCH_WORDS))}&limit=20', None)),
+        Scenario('GET /stats', 'GET', lambda rng: ('/stats', None)),
+        #resumes behind the latest seeded changes, the stream ends after
+        #CHANGES_STREAM_TIMEOUT so each request includes that wait
+        Scenario('GET /changes', 'GET', lambda rng: (
+            f'/changes?after={max(0, change_seq - 100)}', None)),
+        Scenario('GET /actors/export', 'GET', lambda rng: ('/actors/export?format=ndjson', None)),
+        Scenario('GET /movies/export', 'GET', lambda rng: ('/movies/export?format=ndjson', None)),
+        Scenario('GET /admin/cache', 'GET', lambda rng: ('/admin/cache', None)),
+        Scenario('GET /admin/pool', 'GET', lambda rng: ('/admin/pool', None)),
+        Scenario('GET /metrics', 'GET', lambda rng: ('/metrics', None)),
+        Scenario('POST /actors', 'POST', lambda rng: ('/actors', new_actor(rng))),
+        Scenario('POST /movies', 'POST', lambda rng: ('/movies', new_undated_movie(rng))),
+        Scenario('POST /actors/bulk', 'POST', lambda rng: (
+            '/actors/bulk', [new_actor(rng) for _ in range(10)])),
+        Scenario('POST /movies/bulk', 'POST', lambda rng: (
+            '/movies/bulk', [new_movie(rng) for _ in range(10)])),
+        Scenario('POST /movies/<id>/actors', 'POST', lambda rng: (
+            f'/movies/{movie(rng)}/actors', {'actor_id': actor(rng)})),
+        Scenario('PATCH /actors/<id>', 'PATCH', lambda rng: (
+            f'/actors/{actor(rng)}', {'age': rng.randint(8, 90)})),
+        Scenario('PATCH /movies/<id>', 'PATCH', lambda rng: (
+            f'/movies/{movie(rng)}', {'title': f'Bench {rng.randint(0, 10 ** 6)}'})),
+        Scenario('PATCH /actors/bulk', 'PATCH', lambda rng: (
+            '/actors/bulk', {'ids': [actor(rng) for _ in range(10)],
+                             'changes': {'age': rng.randint(8, 90)}})),
+        Scenario('PATCH /movies/bulk', 'PATCH', lambda rng: (
+            '/movies/bulk', {'ids': [movie(rng) for _ in range(10)],
+                             'changes': {'title': f'Bench {rng.randint(0, 10 ** 6)}'}})),
+        Scenario('DELETE /actors/<id>', 'DELETE', delete_one('actors')),
+        Scenario('DELETE /movies/<id>', 'DELETE', delete_one('movies')),
+        Scenario('DELETE /actors/bulk', 'DELETE', delete_bulk('actors')),
+        Scenario('DELETE /movies/bulk', 'DELETE', delete_bulk('movies')),
+        Scenario('DELETE /movies/<id>/actors/<id>', 'DELETE', delete_cast)
+    ]
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return round(ordered[index], 2)
+
+
+## One client thread, keeps its connection open between requests
+def client(host, port, token, scenario, deadline, seed, samples):
+    rng = random.Random(seed)
+    connection = None
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    while time.monotonic() < deadline:
+        request = scenario.make(rng)
+        if request is None:
+            break
+        path, body = request
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+            connection.request(scenario.method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if response.will_close:
+                connection.close()
+                connection = None
+        except (OSError, http.client.HTTPException):
+            status = None
+            if connection is not None:
+                connection.close()
+            connection = None
+        samples.append(((time.perf_counter() - start) * 1000, status))
+
+    if connection is not None:
+        connection.close()
+
+
+def run_scenario(host, port, token, scenario, concurrency, duration, statements):
+    samples = []
+    before = statements.value
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [threading.Thread(target=client, args=(
+        host, port, token, scenario, deadline, seed, samples))
+        for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    ok = sorted(ms for ms, status in samples if status is not None and status < 400)
+    return {
+        'requests': len(samples),
+        'errors': len(samples) - len(ok),
+        'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': percentile(ok, 50),
+        'p95_ms': percentile(ok, 95),
+        'p99_ms': percentile(ok, 99),
+        'queries_per_request': round((statements.value - before) / len(samples), 2)
+        if samples else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f'compared with {baseline["meta"].get("commit")} '
+          f'({baseline["meta"].get("started_at")})')
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None or not base['rps'] or not base['p95_ms'] or not result['p95_ms']:
+            continue
+        rps = (result['rps'] - base['rps']) / base['rps'] * 100
+        p95 = (result['p95_ms'] - base['p95_ms']) / base['p95_ms'] * 100
+        print(f'   {name:<32} rps {rps:+7.1f}%   p95 {p95:+7.1f}%   '
+              f'queries {base["queries_per_request"]} -> {result["queries_per_request"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds per scenario')
+    parser.add_argument('--scenarios', default='',
+                        help='regular expression, only run the scenarios it matches')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='turn off the response cache')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    parser.add_argument('--output', help='also write the json results to this file')
+    parser.add_argument('--compare', help='json results of an earlier run')
+    args = parser.parse_args()
+
+    #auth.auth and models read their settings at import
+    workdir = tempfile.mkdtemp()
+    issuer = LocalIssuer()
+    jwks_path = os.path.join(workdir, 'jwks.json')
+    issuer.write_jwks(jwks_path)
+    issuer.configure_env(jwks_path)
+    os.environ['database_path'] = args.database_url
+    #one token and one address drive every route
+    os.environ['RATE_LIMIT_ENABLED'] = 'False'
+    #short streams, so a client reads GET /changes to its end
+    os.environ['CHANGES_STREAM_TIMEOUT'] = '0.1'
+    if args.no_cache:
+        os.environ['RESPONSE_CACHE_ENABLED'] = 'False'
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from models import db, Actor, Change, Movie, castings
+    from benchmarks.seed import seed
+    from flaskr import create_app
+
+    engine = create_engine(args.database_url)
+    with engine.begin() as connection:
+        db.metadata.create_all(connection)
+        seed(connection, actors=args.actors, movies=args.movies)
+        actor_ids = connection.execute(select(func.min(Actor.id), func.max(Actor.id))).one()
+        movie_ids = connection.execute(select(func.min(Movie.id), func.max(Movie.id))).one()
+        change_seq = connection.execute(select(func.max(Change.seq))).scalar() or 0
+    database = engine.dialect.name
+    engine.dispose()
+
+    app = create_app()
+    statements = StatementCounter()
+    with app.app_context():
+        @event.listens_for(db.get_engine(app), 'after_cursor_execute')
+        def count_statement(*args):
+            statements.incr()
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        #headers and body are separate writes, don't wait for delayed acks
+        disable_nagle_algorithm = True
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    host = '127.0.0.1'
+    server = make_server(host, args.port, app, threaded=True, request_handler=Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    deletable = {'actors': IdPool(), 'movies': IdPool(), 'castings': IdPool()}
+    token = issuer.mint()
+    pattern = re.compile(args.scenarios)
+    filled = False
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'database': database,
+            'actors': args.actors,
+            'movies': args.movies,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'response_cache': not args.no_cache
+        },
+        'scenarios': {}
+    }
+    try:
+        for scenario in scenarios(actor_ids, movie_ids, change_seq, deletable):
+            if not pattern.search(scenario.name):
+                continue
+            if scenario.method == 'DELETE' and not filled:
+                #delete what the create scenarios added
+                with app.app_context():
+                    for key, model, ids in (('actors', Actor, actor_ids),
+                                            ('movies', Movie, movie_ids)):
+                        deletable[key].fill(db.session.execute(
+                            select(model.id).where(model.id > ids[1]).order_by(model.id)
+                        ).scalars())
+                    deletable['castings'].fill(db.session.execute(
+                        select(castings.c.movie_id, castings.c.actor_id)
+                        .where(castings.c.movie_id <= movie_ids[1])).all())
+                filled = True
+            results['scenarios'][scenario.name] = run_scenario(
+                host, args.port, token, scenario, args.concurrency, args.duration, statements)
+    finally:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        meta = results['meta']
+        print(f'{meta["actors"]} actors, {meta["movies"]} movies on {meta["database"]}, '
+              f'{args.concurrency} clients, {args.duration:g}s per scenario')
+        for name, result in results['scenarios'].items():
+            print(f'   {name:<32} {result["rps"]:8.1f} req/s   p50 {result["p50_ms"]}   '
+                  f'p95 {result["p95_ms"]}   p99 {result["p99_ms"]} ms   '
+                  f'errors {result["errors"]}   queries/req {result["queries_per_request"]}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
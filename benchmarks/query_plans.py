@@ -0,0 +1,131 @@
+'''
+Query plans and latency of the list endpoint queries, with and without
+the indexes declared on Actor and Movie.
+
+Seeds a dedicated database, so never point it at a real one:
+
+    python -m benchmarks.query_plans --database-url postgresql://localhost/capstone_bench \
+        --actors 200000 --movies 200000
+
+The database should be empty - the script creates the tables, drops and
+recreates the model indexes and leaves the seeded rows behind.
+SQLite can't use the lower() prefix indexes for LIKE, so the name and
+title prefix queries only improve on postgres.
+'''
+import argparse
+import json
+import statistics
+import time
+
+from sqlalchemy import create_engine, func, select, text
+
+from models import db, Actor, Movie, GenderChoices
+from benchmarks.seed import seed
+
+PAGE = 101
+
+
+def list_queries():
+    actors = Actor.__table__
+    movies = Movie.__table__
+    return [
+        ('actors gender & age range', select(actors)
+            .where(actors.c.gender == GenderChoices.FEMALE,
+                   actors.c.age >= 30, actors.c.age <= 40)
+            .order_by(actors.c.id).limit(PAGE)),
+        ('actors name prefix', select(actors)
+            .where(func.lower(actors.c.name).startswith('lena n', autoescape=True))
+            .order_by(actors.c.id).limit(PAGE)),
+        ('movies release date range', select(movies)
+            .where(movies.c.release_date >= '1990-01-01',
+                   movies.c.release_date <= '1990-03-01')
+            .order_by(movies.c.id).limit(PAGE)),
+        ('movies sorted by release date', select(movies)
+            .order_by(movies.c.release_date.asc().nulls_last(), movies.c.id)
+            .limit(PAGE)),
+        ('movies title prefix', select(movies)
+            .where(func.lower(movies.c.title).startswith('glass echo', autoescape=True))
+            .order_by(movies.c.id).limit(PAGE)),
+    ]
+
+
+def explain(connection, statement):
+    sql = str(statement.compile(
+        dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    rows = connection.execute(text(prefix + sql)).fetchall()
+    return '\n'.join(str(row[-1]) for row in rows)
+
+
+def latency_ms(connection, statement, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(statement).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def indexes():
+    return list(Actor.__table__.indexes) + list(Movie.__table__.indexes)
+
+
+def analyze(connection):
+    connection.execute(text('ANALYZE'))
+
+
+def measure(connection, repeat):
+    return {
+        name: {
+            'plan': explain(connection, statement),
+            'median_ms': latency_ms(connection, statement, repeat)
+        }
+        for name, statement in list_queries()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--actors', type=int, default=100000)
+    parser.add_argument('--movies', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.begin() as connection:
+        db.metadata.create_all(connection, tables=[Actor.__table__, Movie.__table__])
+        for index in indexes():
+            connection.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+        seed(connection, actors=args.actors, movies=args.movies)
+        analyze(connection)
+
+    with engine.begin() as connection:
+        before = measure(connection, args.repeat)
+
+    with engine.begin() as connection:
+        for index in indexes():
+            index.create(connection)
+        analyze(connection)
+
+    with engine.begin() as connection:
+        after = measure(connection, args.repeat)
+
+    if args.json:
+        print(json.dumps({'before': before, 'after': after}, indent=2))
+        return
+
+    for name, _ in list_queries():
+        print(f'== {name}')
+        print(f'   without indexes: {before[name]["median_ms"]:.2f} ms')
+        print('   ' + before[name]['plan'].replace('\n', '\n   '))
+        print(f'   with indexes:    {after[name]["median_ms"]:.2f} ms')
+        print('   ' + after[name]['plan'].replace('\n', '\n   '))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import random
+from datetime import datetime, timedelta
+
+from models import Actor, Movie, GenderChoices
+
+FIRST_NAMES = ['Ava', 'Ben', 'Cara', 'Dev', 'Eli', 'Fay', 'Gus', 'Hana',
+               'Ivan', 'Jude', 'Kai', 'Lena', 'Milo', 'Nia', 'Omar', 'Pia']
+LAST_NAMES = ['Adams', 'Brooks', 'Chen', 'Diaz', 'Evans', 'Fox', 'Gray',
+              'Hughes', 'Ito', 'Jones', 'Khan', 'Lopez', 'Moore', 'Novak']
+TITLE_WORDS = ['Night', 'Summer', 'River', 'Piece', 'Glass', 'Echo', 'Storm',
+               'Last', 'Silent', 'Golden', 'Paper', 'City', 'Road', 'Heart']
+
+
+'''
+Bulk inserts generated actors and movies
+    connection - sqlalchemy connection, the tables must already exist
+    batch - rows per executemany
+'''
+def seed(connection, actors=10000, movies=10000, seed=0, batch=5000):
+    rng = random.Random(seed)
+    genders = [g.name for g in GenderChoices]
+    epoch = datetime(1950, 1, 1)
+
+    def actor_rows(count):
+        for _ in range(count):
+            yield {
+                'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                'age': rng.randint(8, 90),
+                'gender': rng.choice(genders)
+            }
+
+    def movie_rows(count):
+        for _ in range(count):
+            yield {
+                'title': ' '.join(rng.sample(TITLE_WORDS, 3)),
+                'release_date': epoch + timedelta(days=rng.randint(0, 27000))
+            }
+
+    for table, rows, count in ((Actor.__table__, actor_rows, actors),
+                               (Movie.__table__, movie_rows, movies)):
+        remaining = count
+        while remaining > 0:
+            size = min(batch, remaining)
+            connection.execute(table.insert(), list(rows(size)))
+            remaining -= size
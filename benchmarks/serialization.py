@@ -0,0 +1,94 @@
+'''
+Micro-benchmark of the list endpoint serialization paths, no database
+needed:
+
+    python -m benchmarks.serialization --rows 10000
+
+    format + flask.jsonify  - ORM instances, format(), stdlib encoder
+                              (the path before flaskr.serializer)
+    rows + json             - column tuples, stdlib JSONEncoder
+    rows + orjson           - column tuples, orjson (if installed)
+'''
+import argparse
+import json
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify as flask_jsonify
+
+from models import Actor, Movie, GenderChoices
+from flaskr.filters import ACTOR_FIELDS, MOVIE_FIELDS
+from flaskr.serializer import Serializer, orjson, rows_to_dicts
+
+
+def make_rows(count, seed=0):
+    rng = random.Random(seed)
+    genders = list(GenderChoices)
+    epoch = datetime(1950, 1, 1)
+    actors = [(i, f'Actor {i}', rng.randint(8, 90), rng.choice(genders))
+              for i in range(1, count + 1)]
+    movies = [(i, f'Movie {i}', epoch + timedelta(days=rng.randint(0, 27000)))
+              for i in range(1, count + 1)]
+    return actors, movies
+
+
+def time_ms(f, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    actor_rows, movie_rows = make_rows(args.rows)
+    #building the instances is part of the cost of the ORM path
+    def orm_instances():
+        actors = [Actor(id=i, name=n, age=a, gender=g) for i, n, a, g in actor_rows]
+        movies = [Movie(id=i, title=t, release_date=d) for i, t, d in movie_rows]
+        return actors, movies
+
+    app = Flask(__name__)
+
+    def format_jsonify():
+        actors, movies = orm_instances()
+        with app.app_context():
+            flask_jsonify({'success': True, 'actors': [a.format() for a in actors]}).get_data()
+            flask_jsonify({'success': True, 'movies': [m.format() for m in movies]}).get_data()
+
+    def rows_with(serializer):
+        def run():
+            serializer.dumps({'success': True,
+                              'actors': rows_to_dicts(actor_rows, ACTOR_FIELDS)})
+            serializer.dumps({'success': True,
+                              'movies': rows_to_dicts(movie_rows, MOVIE_FIELDS)})
+        return run
+
+    paths = [('format + flask.jsonify', format_jsonify),
+             ('rows + json', rows_with(Serializer('json')))]
+    if orjson is not None:
+        paths.append(('rows + orjson', rows_with(Serializer('orjson'))))
+
+    results = {name: time_ms(run, args.repeat) for name, run in paths}
+
+    if args.json:
+        print(json.dumps({'rows': args.rows, 'median_ms': results}, indent=2))
+        return
+
+    baseline = results['format + flask.jsonify']
+    print(f'{args.rows} actors + {args.rows} movies, median of {args.repeat} runs')
+    for name, ms in results.items():
+        print(f'   {name:<24} {ms:9.2f} ms   {baseline / ms:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
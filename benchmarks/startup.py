@@ -0,0 +1,129 @@
+'''
+Cold start cost of the app - import time and time to first response:
+
+    python -m benchmarks.startup --database-url sqlite:///bench.db
+
+Each measurement runs in a fresh interpreter. Reports the median time to
+import flaskr and to build the app with create_app, the slowest imports
+(python -X importtime), and the time from starting gunicorn - with and
+without preload - to its first successful response.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.error import URLError
+
+from sqlalchemy import create_engine
+
+from models import db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#prints the import and create_app times in seconds
+MEASURE = '''
+import time
+start = time.perf_counter()
+import flaskr
+imported = time.perf_counter()
+flaskr.create_app()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def run_python(args, env, **kwargs):
+    return subprocess.run([sys.executable] + args, env=env, cwd=ROOT, check=True,
+                          capture_output=True, text=True, **kwargs)
+
+
+def measure_import(env, repeat):
+    imports, builds = [], []
+    for _ in range(repeat):
+        imported, built = run_python(['-c', MEASURE], env).stdout.split()
+        imports.append(float(imported) * 1000)
+        builds.append(float(built) * 1000)
+    return round(statistics.median(imports), 1), round(statistics.median(builds), 1)
+
+
+## The modules with the largest cumulative import time, in ms
+def slowest_imports(env, count):
+    stderr = run_python(['-X', 'importtime', '-c', 'import flaskr'], env).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative) / 1000, name.strip()))
+    modules.sort(reverse=True)
+    return [{'module': name, 'ms': round(ms, 1)} for ms, name in modules[:count]]
+
+
+def first_response(url, env, preload, port, timeout=60):
+    command = [sys.executable, '-m', 'gunicorn', '--workers', '1',
+               '--bind', f'127.0.0.1:{port}', 'flaskr:create_app()']
+    env = dict(env, GUNICORN_PRELOAD=str(preload))
+    start = time.perf_counter()
+    server = subprocess.Popen(command, env=env, cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return round((time.perf_counter() - start) * 1000, 1)
+            except (URLError, ConnectionError):
+                time.sleep(0.01)
+        raise RuntimeError('server did not respond')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--path', default='/actors?limit=1',
+                        help='the first request, it reads the database by default')
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    with engine.begin() as connection:
+        db.metadata.create_all(connection)
+    engine.dispose()
+
+    env = dict(os.environ, database_path=args.database_url)
+    import_ms, create_app_ms = measure_import(env, args.repeat)
+    url = f'http://127.0.0.1:{args.port}{args.path}'
+    results = {
+        'import_ms': import_ms,
+        'create_app_ms': create_app_ms,
+        'slowest_imports': slowest_imports(env, 10),
+        'first_response_ms': {
+            name: statistics.median(
+                first_response(url, env, preload, args.port) for _ in range(args.repeat))
+            for name, preload in (('preload', True), ('no preload', False))
+        }
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'import flaskr {results["import_ms"]} ms   create_app {results["create_app_ms"]} ms')
+    print('slowest imports (cumulative):')
+    for module in results['slowest_imports']:
+        print(f'   {module["ms"]:8.1f} ms  {module["module"]}')
+    print(f'gunicorn start to first GET {args.path}:')
+    for name, ms in results['first_response_ms'].items():
+        print(f'   {name:>10} {ms} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import base64
+import json
+import os
+import time
+
+import rsa
+from jose import jwt
+
+AUTH0_DOMAIN = 'bench.local'
+API_AUDIENCE = 'capstone-bench'
+
+#every permission of the Executive Producer role, and the admin endpoints'
+ALL_PERMISSIONS = [
+    'get:actors', 'get:movies',
+    'create:actor', 'create:movie',
+    'patch:actor', 'patch:movie',
+    'delete:actor', 'delete:movie',
+    'read:admin'
+]
+
+
+def _b64_uint(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+'''
+LocalIssuer
+Signs tokens with a key generated on the spot and publishes it as a JWKS
+file, standing in for Auth0 in benchmarks
+
+    issuer.write_jwks(path)
+    issuer.configure_env(path) - point auth.auth at the file, call before
+                                 auth.auth is imported
+    issuer.mint(permissions) - a bearer token auth.auth accepts
+'''
+class LocalIssuer:
+    def __init__(self, kid='bench-key', bits=2048):
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self._pem = self.private_key.save_pkcs1().decode('ascii')
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': _b64_uint(self.public_key.n),
+            'e': _b64_uint(self.public_key.e)
+        }]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+
+    def configure_env(self, path):
+        os.environ.update({
+            'JWKS_URL': f'file://{os.path.abspath(path)}',
+            'AUTH0_DOMAIN': AUTH0_DOMAIN,
+            'API_AUDIENCE': API_AUDIENCE,
+            'ALGORITHMS': 'RS256'
+        })
+
+    def mint(self, permissions=ALL_PERMISSIONS, sub='bench|user', ttl=3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': sub,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(claims, self._pem, algorithm='RS256', headers={'kid': self.kid})
@@ -1,21 +1,77 @@
 import os
+import click
 from flask import (
     Flask, 
+    current_app,
     request, 
-    abort, 
-    jsonify
+    abort
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from auth.auth import AuthError, requires_auth
-from models import Actor, Movie, setup_db
+from auth.rate_limit import RateLimitExceeded, init_rate_limits, rate_limited
+from sqlalchemy import orm
+
+from models import Actor, Movie, castings, db, init_db, setup_db
+from pooling import pool_stats
+from flaskr.pagination import paginate, get_sort
+from flaskr.filters import (
+    ACTOR_FIELDS,
+    ACTOR_INCLUDES,
+    ACTOR_SORTS,
+    MOVIE_FIELDS,
+    MOVIE_INCLUDES,
+    MOVIE_SORTS,
+    filter_actors,
+    filter_movies,
+    get_fields,
+    get_includes,
+    include_tables,
+    select_fields,
+    select_includes
+)
+from flaskr.export import export_response
+from flaskr.search import search_results
+from flaskr.stats import rebuild_stats, stats_summary, verify_stats
+from flaskr.changes import changes_response, init_changes, prune_changes, CHANGES_RETENTION_DAYS
+from flaskr.bulk import bulk_create, bulk_update, bulk_delete
+from flaskr.validation import validate_actor, validate_movie
+from flaskr.cache import cached, init_response_cache
+from flaskr.conditional import conditional
+from flaskr.serializer import jsonify, JSONEncoder, entities_to_dicts, rows_to_dicts
+from flaskr.compression import init_compression
+from flaskr.replicas import init_replicas
+from flaskr.metrics import init_metrics, metrics_response
+from flaskr.query_debug import init_query_debug
+from flaskr.admission import init_admission
+
+#create missing tables when the app is built, for local databases - see
+#models.init_db and flask init-db
+CREATE_SCHEMA = os.getenv("DB_CREATE_SCHEMA", "False").lower() == "true"
+#proxies in front of the app (e.g. 1 on Render), whose X-Forwarded-For
+#entries are trusted for the client address
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", 0))
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    app.json_encoder = JSONEncoder
+    if TRUSTED_PROXY_COUNT:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
     setup_db(app)
+    if CREATE_SCHEMA:
+        init_db(app)
     CORS(app)
+    init_compression(app)
+    init_response_cache(app)
+    init_replicas(app)
+    init_metrics(app)
+    init_admission(app)
+    init_rate_limits(app)
+    init_query_debug(app)
+    init_changes(app)
 
         # CORS Headers
     @app.after_request
@@ -29,6 +85,39 @@ def create_app(test_config=None):
         return response
 
 
+    '''
+    flask init-db - creates the missing tables on the primary database
+    '''
+    @app.cli.command('init-db')
+    def init_db_command():
+        init_db(app)
+
+    '''
+    flask rebuild-stats - recomputes the /stats summary counts from scratch,
+    --verify only compares them with a recount and fails on a mismatch
+    '''
+    @app.cli.command('rebuild-stats')
+    @click.option('--verify', is_flag=True, help='check the counts without rebuilding')
+    def rebuild_stats_command(verify):
+        if not verify:
+            rebuild_stats()
+        mismatches = verify_stats()
+        for stat, buckets in mismatches.items():
+            for bucket, (stored, computed) in buckets.items():
+                click.echo(f'{stat} {bucket}: stored {stored}, computed {computed}', err=True)
+        if mismatches:
+            raise click.ClickException('stats are inconsistent')
+        click.echo('stats are consistent')
+
+    '''
+    flask prune-changes - deletes change log entries older than --days,
+    streams resuming from before them start at the oldest one kept
+    '''
+    @app.cli.command('prune-changes')
+    @click.option('--days', type=int, default=CHANGES_RETENTION_DAYS, show_default=True)
+    def prune_changes_command(days):
+        click.echo(f'pruned {prune_changes(days)} changes')
+
     #ROUTES
 
     '''
@@ -41,27 +130,220 @@ def create_app(test_config=None):
         })
 
     '''
-    Endpoint which fetches all actor data
+    Endpoint which fetches a page of actor data
+    params: limit & cursor (next_cursor of the previous page),
+    gender, age_min, age_max, name (prefix), sort, fields & include (movies)
     '''
     @app.route('/actors', methods=['GET'])
+    @rate_limited
+    @conditional('actors', include_tables(Actor, ACTOR_INCLUDES))
+    @cached('actors', include_tables(Actor, ACTOR_INCLUDES))
     def get_actors():
-        actors = Actor.query.all()
+        sort = get_sort(ACTOR_SORTS)
+        fields = get_fields(ACTOR_FIELDS)
+        includes = get_includes(ACTOR_INCLUDES)
+        if includes:
+            query = filter_actors(select_includes(Actor, fields, sort, includes))
+            actors, next_cursor = paginate(query, Actor, sort)
+            actors = entities_to_dicts(actors, fields, includes)
+        else:
+            query = filter_actors(select_fields(Actor, fields, sort))
+            actors, next_cursor = paginate(query, Actor, sort)
+            actors = rows_to_dicts(actors, fields)
         return jsonify({
             'success': True, 
-            'actors': [actor.format() for actor in actors]
+            'actors': actors,
+            'next_cursor': next_cursor
         })
 
     '''
-    Endpoint which fetches all movie data
+    Endpoint which fetches a page of movie data
+    params: limit & cursor (next_cursor of the previous page),
+    release_date_from, release_date_to, title (prefix), sort, fields &
+    include (actors)
     '''
     @app.route('/movies', methods=['GET'])
+    @rate_limited
+    @conditional('movies', include_tables(Movie, MOVIE_INCLUDES))
+    @cached('movies', include_tables(Movie, MOVIE_INCLUDES))
     def get_movies():
-        movies = Movie.query.all()
+        sort = get_sort(MOVIE_SORTS)
+        fields = get_fields(MOVIE_FIELDS)
+        includes = get_includes(MOVIE_INCLUDES)
+        if includes:
+            query = filter_movies(select_includes(Movie, fields, sort, includes))
+            movies, next_cursor = paginate(query, Movie, sort)
+            movies = entities_to_dicts(movies, fields, includes)
+        else:
+            query = filter_movies(select_fields(Movie, fields, sort))
+            movies, next_cursor = paginate(query, Movie, sort)
+            movies = rows_to_dicts(movies, fields)
         return jsonify({
             'success': True,
-            'movies': [movie.format() for movie in movies]
+            'movies': movies,
+            'next_cursor': next_cursor
         })
 
+    '''
+    Endpoint which fetches a single actor
+    params: id of actor
+    '''
+    @app.route('/actors/<int:id>', methods=['GET'])
+    @conditional('actors')
+    def get_actor(id):
+        actor = Actor.query.filter(Actor.id == id).one_or_none()
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor.format()
+        })
+
+    '''
+    Endpoint which fetches a single movie
+    params: id of movie
+    '''
+    @app.route('/movies/<int:id>', methods=['GET'])
+    @conditional('movies')
+    def get_movie(id):
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format()
+        })
+
+    '''
+    Endpoint which searches actor names and movie titles
+    params: q, type (actor and/or movie), limit & cursor
+    '''
+    @app.route('/search', methods=['GET'])
+    @rate_limited
+    @conditional('actors', 'movies')
+    @cached('actors', 'movies')
+    def search_all():
+        results, next_cursor = search_results()
+        return jsonify({
+            'success': True,
+            'results': results,
+            'next_cursor': next_cursor
+        })
+
+    '''
+    Endpoint which fetches actor and movie counts - totals, actors by
+    gender and age (decade), movies by release year. Read from the summary
+    counts the database keeps up to date on every write (see models.StatCount)
+    '''
+    @app.route('/stats', methods=['GET'])
+    @rate_limited
+    @conditional('actors', 'movies')
+    @cached('actors', 'movies')
+    def get_stats():
+        return jsonify(dict({'success': True}, **stats_summary()))
+
+    '''
+    Endpoint which streams actor and movie changes as server-sent events
+    params: after (seq of the last change seen), or the Last-Event-ID
+    header of a reconnecting EventSource. Without either, only changes
+    from now on are sent
+    '''
+    @app.route('/changes', methods=['GET'])
+    @rate_limited
+    def stream_changes():
+        return changes_response()
+
+    '''
+    Endpoint which fetches the movies an actor is cast in
+    params: id of actor
+    '''
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @conditional('actors', castings.name, 'movies')
+    def get_filmography(id):
+        actor = Actor.query.options(orm.selectinload(Actor.movies)) \
+            .filter(Actor.id == id).one_or_none()
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'id': id,
+            'movies': [movie.format() for movie in actor.movies]
+        })
+
+    '''
+    Endpoint which fetches the cast of a movie
+    params: id of movie
+    '''
+    @app.route('/movies/<int:id>/actors', methods=['GET'])
+    @conditional('movies', castings.name, 'actors')
+    def get_cast(id):
+        movie = Movie.query.options(orm.selectinload(Movie.actors)) \
+            .filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'id': id,
+            'actors': [actor.format() for actor in movie.actors]
+        })
+
+    '''
+    Endpoint which reports response cache hits & misses
+    '''
+    @app.route('/admin/cache', methods=['GET'])
+    @requires_auth('read:admin')
+    def cache_stats(payload):
+        return jsonify({
+            'success': True,
+            'cache': current_app.extensions['response_cache'].stats()
+        })
+
+    '''
+    Endpoint with request metrics in the Prometheus text format
+    '''
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return metrics_response()
+
+    '''
+    Endpoint with the connection pool state and checkout wait times,
+    and the state of each read replica
+    '''
+    @app.route('/admin/pool', methods=['GET'])
+    @requires_auth('read:admin')
+    def pool_status(payload):
+        router = app.extensions['replica_router']
+        replicas = router.stats(app)
+        for replica in replicas:
+            replica['pool'] = pool_stats(db.get_engine(app, bind=replica['bind']))
+        return jsonify({
+            'success': True,
+            'pool': pool_stats(db.get_engine()),
+            'replicas': replicas
+        })
+
+    '''
+    Endpoint which streams every actor
+    params: format - json (default) or ndjson
+    '''
+    @app.route('/actors/export', methods=['GET'])
+    @rate_limited
+    def export_actors():
+        return export_response(Actor, 'actors', ACTOR_FIELDS)
+
+    '''
+    Endpoint which streams every movie
+    params: format - json (default) or ndjson
+    '''
+    @app.route('/movies/export', methods=['GET'])
+    @rate_limited
+    def export_movies():
+        return export_response(Movie, 'movies', MOVIE_FIELDS)
+
     '''
     Endpoint which adds an actor to the database
     params: name, age & gender
@@ -121,6 +403,66 @@ def create_app(test_config=None):
         else:
             abort(422)
 
+    '''
+    Endpoint which adds many actors in one transaction
+    params: json array (or NDJSON) of actors, chunk_size & transaction
+    requires_auth: needs to be Executive Producer or Casting Director
+    '''
+    @app.route('/actors/bulk', methods=["POST"])
+    @requires_auth('create:actor')
+    def bulk_create_actors(payload):
+        return bulk_create(Actor, 'actors', validate_actor)
+
+    '''
+    Endpoint which adds many movies in one transaction
+    params: json array (or NDJSON) of movies, chunk_size & transaction
+    requires_auth: needs to be Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=["POST"])
+    @requires_auth('create:movie')
+    def bulk_create_movies(payload):
+        return bulk_create(Movie, 'movies', validate_movie)
+
+    '''
+    Endpoint which updates many actors with one UPDATE
+    params: ids and changes in the body and/or list filters
+    requires_auth: needs to be Casting Director or Executive Producer
+    '''
+    @app.route('/actors/bulk', methods=["PATCH"])
+    @requires_auth('patch:actor')
+    def bulk_patch_actors(payload):
+        return bulk_update(Actor, filter_actors, validate_actor)
+
+    '''
+    Endpoint which updates many movies with one UPDATE
+    params: ids and changes in the body and/or list filters
+    requires_auth: needs to be Casting Director or Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=["PATCH"])
+    @requires_auth('patch:movie')
+    def bulk_patch_movies(payload):
+        return bulk_update(Movie, filter_movies, validate_movie)
+
+    '''
+    Endpoint which deletes many actors with one DELETE
+    params: ids in the body and/or list filters
+    requires_auth: needs to be Casting Director or Executive Producer
+    '''
+    @app.route('/actors/bulk', methods=["DELETE"])
+    @requires_auth('delete:actor')
+    def bulk_delete_actors(payload):
+        return bulk_delete(Actor, filter_actors)
+
+    '''
+    Endpoint which deletes many movies with one DELETE
+    params: ids in the body and/or list filters
+    requires_auth: needs to be Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=["DELETE"])
+    @requires_auth('delete:movie')
+    def bulk_delete_movies(payload):
+        return bulk_delete(Movie, filter_movies)
+
     '''
     Endpoint which deletes an actor fromthe database
     params: id of actor to be deleted
@@ -233,8 +575,85 @@ def create_app(test_config=None):
             'movie': movie.format()
         }), 200
 
+    '''
+    Endpoint which casts an actor in a movie
+    params: id of movie, actor_id in the body
+    requires_auth: needs to be Casting Director or Executive Producer
+    '''
+    @app.route('/movies/<int:id>/actors', methods=["POST"])
+    @requires_auth('patch:movie')
+    def cast_actor(payload, id):
+        body = request.get_json(silent=True) or {}
+        actor_id = body.get("actor_id")
+        if not isinstance(actor_id, int):
+            abort(400)
+
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        if movie is None or actor is None:
+            abort(404)
+
+        try:
+            movie.add_actor(actor)
+        except Exception as e:
+            print(e)
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'id': id,
+            'actors': [actor.format() for actor in movie.actors]
+        })
+
+    '''
+    Endpoint which removes an actor from a movie's cast
+    params: id of movie & actor_id of the actor
+    requires_auth: needs to be Casting Director or Executive Producer
+    '''
+    @app.route('/movies/<int:id>/actors/<int:actor_id>', methods=["DELETE"])
+    @requires_auth('patch:movie')
+    def uncast_actor(payload, id, actor_id):
+        movie = Movie.query.filter(Movie.id == id).one_or_none()
+        if movie is None:
+            abort(404)
+        actor = next((actor for actor in movie.actors if actor.id == actor_id), None)
+        if actor is None:
+            abort(404)
+
+        try:
+            movie.remove_actor(actor)
+        except Exception as e:
+            print(e)
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'id': id,
+            'actor_id': actor_id
+        })
+
 
     # Error Handling
+    #Malformed request
+    @app.errorhandler(400)
+    def bad_request(error):
+        return(
+        jsonify({
+            "success": False,
+            "error": 400,
+            "message": 'Bad Request'
+        }), 400)
+
+    #Request body too large
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return(
+        jsonify({
+            "success": False,
+            "error": 413,
+            "message": 'Payload Too Large'
+        }), 413)
+
     #error on database side
     @app.errorhandler(422)
     def unprocessable(error):
@@ -285,6 +704,18 @@ def create_app(test_config=None):
             "message": 'Unauthorized'
         }), 401)
 
+    #Too many requests from one client, see auth.rate_limit
+    @app.errorhandler(RateLimitExceeded)
+    def rate_limit_exceeded(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": 'Too Many Requests'
+        })
+        response.status_code = 429
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     #Method for authorisation errors
     @app.errorhandler(AuthError)
     def auth_error(error):
@@ -297,7 +728,18 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+
+## flaskr.app (gunicorn flaskr:app, flask run) is built on first access,
+# so importing flaskr - or flaskr.asgi - builds nothing
+_app = None
+
+def __getattr__(name):
+    global _app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _app = create_app()
+    return _app
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
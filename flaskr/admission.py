@@ -0,0 +1,61 @@
+import os
+import threading
+from flask import g, request
+
+from flaskr.serializer import jsonify
+
+#requests handled at once per process, beyond it they are refused, 0 is no cap
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", 0))
+#Retry-After of refused requests, in seconds
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", 1))
+
+
+'''
+AdmissionControl
+Caps the requests in flight in the process. One over the cap is answered
+503 with Retry-After at once - not queued behind the others, so under
+overload clients back off instead of timing out. exempt paths (metrics)
+are always served.
+'''
+class AdmissionControl:
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, retry_after=SHED_RETRY_AFTER,
+                 exempt=('/metrics',)):
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.exempt = frozenset(exempt)
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self._lock = threading.Lock()
+        self.shed = 0
+
+    def start_request(self):
+        if self._slots is None or request.path in self.exempt:
+            return None
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.shed += 1
+            response = jsonify({
+                "success": False,
+                "error": 503,
+                "message": 'Service Unavailable'
+            })
+            response.status_code = 503
+            response.headers['Retry-After'] = str(self.retry_after)
+            return response
+        g.admitted = True
+        return None
+
+    def finish_request(self, exception=None):
+        if g.pop('admitted', False):
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'max_in_flight': self.max_in_flight, 'shed': self.shed}
+
+
+def init_admission(app, admission=None):
+    admission = admission if admission is not None else AdmissionControl()
+    app.extensions['admission'] = admission
+    app.before_request(admission.start_request)
+    app.teardown_request(admission.finish_request)
+    return admission
@@ -0,0 +1,379 @@
+from functools import wraps
+from quart import Quart, Response, abort, current_app, request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from auth.auth import (
+    AuthError, check_permissions, check_subject, compile_permissions,
+    get_token_auth_header, token_cache, verify_decode_jwt_async
+)
+from auth.rate_limit import RateLimitExceeded, init_rate_limits
+from models import Actor, Movie, bump_version, notify_write, database_path
+from pooling import (
+    pool_config, async_database_url, async_engine_options, statement_timeout_hook
+)
+from flaskr.pagination import get_sort, next_page, null_tail_query, page_query
+from flaskr.filters import (
+    ACTOR_FIELDS, ACTOR_SORTS, MOVIE_FIELDS, MOVIE_SORTS,
+    filter_actors, filter_movies, get_fields, select_columns
+)
+from flaskr.export import EXPORT_CHUNK_SIZE
+from flaskr.serializer import dumps, rows_to_dicts
+from flaskr.validation import parse_date
+
+'''
+Async (ASGI) variant of the app for high-concurrency read traffic, served
+with an ASGI server, e.g.
+
+    hypercorn 'flaskr.asgi:create_asgi_app()'
+
+Same routes and error contract as flaskr.create_app for the list, single
+item, export and create/update/delete endpoints, on SQLAlchemy's asyncio
+extension (asyncpg, or aiosqlite for sqlite urls). Signing keys are fetched
+in a worker thread, so verifying tokens never blocks the event loop.
+Only the WSGI app serves
+    - the bulk, /search, /stats, /changes, /metrics and /admin endpoints
+    - the castings routes - /actors/<id>/movies, /movies/<id>/actors,
+      casting and removing from a cast - and include= on the lists
+    - response caching, conditional requests and compression
+    - replica routing, rate limiting by client address, admission control
+      (MAX_IN_FLIGHT), request metrics and query debugging
+Writes are rate limited per token subject as on the WSGI app.
+'''
+
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    422: 'unprocessable',
+    500: 'Internal Server Error'
+}
+
+
+def jsonify(data, status=200):
+    return Response(dumps(data) + b'\n', status=status, mimetype='application/json')
+
+
+## A request body value as its column takes it. psycopg2 lets Postgres cast
+# strings, so the WSGI app stores them as they are - asyncpg needs python types
+def column_value(field, value):
+    if value is None:
+        return None
+    if field == 'release_date':
+        return parse_date(value)
+    if field == 'age':
+        if isinstance(value, bool):
+            raise ValueError('age must be an integer')
+        return int(value)
+    return value
+
+
+## auth.rate_limit.limit_subject for the Quart app - the same per subject
+# buckets, counted by the app's limiter (see init_rate_limits)
+def limit_subject(payload):
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None:
+        limiter.check_subject(payload['sub'])
+
+
+## requires_auth for coroutines, see auth.auth.requires_auth
+def requires_auth(*permissions, any_of=None):
+    required = frozenset(permissions)
+    any_of = frozenset(any_of) if any_of else None
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            token = get_token_auth_header(request.headers)
+            cached = token_cache.get(token)
+            if cached is None:
+                payload = await verify_decode_jwt_async(token)
+                granted = compile_permissions(payload)
+                token_cache.put(token, payload, granted)
+            else:
+                payload, granted = cached
+            check_subject(payload)
+            #counted before the permission check, so refused calls count too
+            limit_subject(payload)
+            if required or any_of:
+                check_permissions(required, payload, granted, any_of)
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+## Bumps the table version, commits, then notifies write listeners -
+# what the models' insert/update/delete do on the sync session
+async def commit_write(session, tablename, action):
+    await session.run_sync(lambda sync_session: bump_version(tablename, sync_session))
+    await session.commit()
+    notify_write(tablename, action)
+
+
+# pool_options override the DB_POOL_* environment settings, see
+# pooling.pool_config
+def create_asgi_app(database_path=database_path, **pool_options):
+    app = Quart(__name__)
+
+    config = pool_config(**pool_options)
+    engine = create_async_engine(
+        async_database_url(database_path, config),
+        **async_engine_options(database_path, config))
+    statement_timeout_hook(config)(engine.sync_engine)
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    app.extensions['async_engine'] = engine
+    init_rate_limits(app)
+
+    @app.after_serving
+    async def dispose_engine():
+        await engine.dispose()
+
+    @app.after_request
+    async def after_request(response):
+        response.headers.add(
+            'Access-Control-Allow-Headers',
+            'Content-Type,Authorization,true')
+        response.headers.add(
+            'Access-Control-Allow-Methods',
+            'GET,PUT,POST,DELETE,OPTIONS')
+        return response
+
+    async def list_response(model, key, allowed_fields, sorts, filter_rows):
+        sort = get_sort(sorts, request.args)
+        fields = get_fields(allowed_fields, request.args)
+        query = filter_rows(select(*select_columns(model, fields, sort)), request.args)
+        page, limit = page_query(query, model, sort, request.args)
+
+        async with Session() as session:
+            rows = (await session.execute(page)).all()
+            tail = null_tail_query(query, model, sort, len(rows), request.args)
+            if tail is not None:
+                rows += (await session.execute(tail)).all()
+
+        rows, next_cursor = next_page(rows, limit, model, sort)
+        return jsonify({
+            'success': True,
+            key: rows_to_dicts(rows, fields),
+            'next_cursor': next_cursor
+        })
+
+    async def get_one(model, id):
+        async with Session() as session:
+            return await session.get(model, id)
+
+    ## Streams every row of model ordered by id, see flaskr.export
+    def export_response(model, key, fields):
+        fmt = request.args.get('format', 'json')
+        if fmt not in ('json', 'ndjson'):
+            abort(400)
+
+        query = select(*[getattr(model, name) for name in fields]) \
+            .order_by(model.id) \
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+        async def body():
+            async with Session() as session:
+                rows = await session.stream(query)
+                if fmt == 'json':
+                    yield b'{"success":true,"%s":[' % key.encode('utf-8')
+                separator = b''
+                async for row in rows:
+                    if fmt == 'ndjson':
+                        yield dumps(dict(zip(fields, row))) + b'\n'
+                    else:
+                        yield separator + dumps(dict(zip(fields, row)))
+                        separator = b','
+                if fmt == 'json':
+                    yield b']}'
+
+        mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+        return Response(body(), mimetype=mimetype)
+
+    #ROUTES
+
+    @app.route('/', methods=['GET'])
+    async def index():
+        return jsonify({
+            'message': 'Welcome to my Capstone API!'
+        })
+
+    @app.route('/actors', methods=['GET'])
+    async def get_actors():
+        return await list_response(Actor, 'actors', ACTOR_FIELDS, ACTOR_SORTS, filter_actors)
+
+    @app.route('/movies', methods=['GET'])
+    async def get_movies():
+        return await list_response(Movie, 'movies', MOVIE_FIELDS, MOVIE_SORTS, filter_movies)
+
+    @app.route('/actors/<int:id>', methods=['GET'])
+    async def get_actor(id):
+        actor = await get_one(Actor, id)
+        if actor is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'actor': actor.format()
+        })
+
+    @app.route('/movies/<int:id>', methods=['GET'])
+    async def get_movie(id):
+        movie = await get_one(Movie, id)
+        if movie is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie.format()
+        })
+
+    @app.route('/actors/export', methods=['GET'])
+    async def export_actors():
+        return export_response(Actor, 'actors', ACTOR_FIELDS)
+
+    @app.route('/movies/export', methods=['GET'])
+    async def export_movies():
+        return export_response(Movie, 'movies', MOVIE_FIELDS)
+
+    @app.route('/actors', methods=['POST'])
+    @requires_auth('create:actor')
+    async def create_actor(payload):
+        body = await request.get_json()
+
+        try:
+            new_actor = Actor(name=body.get('name'), age=column_value('age', body.get('age')),
+                              gender=body.get('gender'))
+            async with Session() as session:
+                session.add(new_actor)
+                await commit_write(session, 'actors', 'insert')
+                await session.refresh(new_actor)
+
+            return jsonify({
+                'success': True,
+                'actor': new_actor.format()
+            })
+
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    @app.route('/movies', methods=['POST'])
+    @requires_auth('create:movie')
+    async def create_movie(payload):
+        body = await request.get_json()
+
+        try:
+            new_movie = Movie(title=body.get('title'),
+                              release_date=column_value('release_date', body.get('release_date')))
+            async with Session() as session:
+                session.add(new_movie)
+                await commit_write(session, 'movies', 'insert')
+                await session.refresh(new_movie)
+
+            #same key as the sync app
+            return jsonify({
+                'success': True,
+                'actor': new_movie.format()
+            })
+
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    async def delete_response(model, id):
+        async with Session() as session:
+            item = await session.get(model, id)
+            try:
+                await session.delete(item)
+                await commit_write(session, model.__tablename__, 'delete')
+                return jsonify({
+                    'success': True,
+                    'id': id
+                })
+
+            except Exception as e:
+                print(e)
+                abort(422)
+
+    @app.route('/actors/<int:id>', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    async def delete_actor(payload, id):
+        return await delete_response(Actor, id)
+
+    @app.route('/movies/<int:id>', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    async def delete_movie(payload, id):
+        return await delete_response(Movie, id)
+
+    ## fields - the body keys which update the column of the same name
+    async def patch_response(model, key, id, fields):
+        body = await request.get_json()
+        async with Session() as session:
+            item = await session.get(model, id)
+
+            try:
+                if item is None:
+                    abort(404)
+
+                for field in fields:
+                    if body.get(field):
+                        setattr(item, field, column_value(field, body.get(field)))
+
+                await commit_write(session, model.__tablename__, 'update')
+                await session.refresh(item)
+
+            except Exception as e:
+                print(e)
+                abort(400)
+
+        return jsonify({
+            'success': True,
+            key: item.format()
+        })
+
+    @app.route('/actors/<int:id>', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    async def patch_actor(payload, id):
+        return await patch_response(Actor, 'actor', id, ('name', 'age', 'gender'))
+
+    @app.route('/movies/<int:id>', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    async def patch_movie(payload, id):
+        return await patch_response(Movie, 'movie', id, ('title', 'release_date'))
+
+    # Error Handling - the same bodies as the WSGI app
+    def error_handler(status):
+        async def handler(error):
+            return jsonify({
+                'success': False,
+                'error': status,
+                'message': ERROR_MESSAGES[status]
+            }, status)
+        return handler
+
+    for status in ERROR_MESSAGES:
+        app.register_error_handler(status, error_handler(status))
+
+    @app.errorhandler(RateLimitExceeded)
+    async def rate_limit_exceeded(error):
+        response = jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'Too Many Requests'
+        }, 429)
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+    @app.errorhandler(AuthError)
+    async def auth_error(error):
+        return jsonify({
+            'success': False,
+            'error': error.status_code,
+            'message': error.error['description']
+        }, error.status_code)
+
+    return app
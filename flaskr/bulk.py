@@ -0,0 +1,240 @@
+import json
+import os
+from flask import request, abort
+
+from models import db, notify_write, bump_version
+from flaskr.serializer import jsonify
+
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 10000))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+
+
+## Reads the items of a bulk request - a json array, an object holding
+# the array under key, or an NDJSON body (one object per line)
+def get_bulk_items(key):
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            items = [json.loads(line)
+                     for line in request.get_data(as_text=True).splitlines()
+                     if line.strip()]
+        except ValueError:
+            abort(400)
+    else:
+        body = request.get_json(silent=True)
+        items = body.get(key) if isinstance(body, dict) else body
+
+    if not isinstance(items, list) or not items:
+        abort(400)
+    if len(items) > BULK_MAX_ITEMS:
+        abort(413)
+    return items
+
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield start, rows[start:start + size]
+
+
+def _insert(table, rows):
+    #executemany needs every row to bind the same columns
+    columns = set().union(*rows)
+    rows = [{column: row.get(column) for column in columns} for row in rows]
+
+    statement = table.insert()
+    if db.engine.dialect.insert_executemany_returning:
+        #executemany with RETURNING (psycopg2 execute_values) gives the ids
+        return [row.id for row in
+                db.session.execute(statement.returning(table.c.id), rows)]
+    db.session.execute(statement, rows)
+    return [None] * len(rows)
+
+
+'''
+Bulk insert of model rows
+    key - name of the array in a json object body
+    validate - validate_actor / validate_movie
+    query params
+        chunk_size - rows per INSERT statement
+        transaction - single (default, all or nothing) or chunk (commit
+                      after every chunk, earlier chunks are kept on failure)
+    everything is validated before anything is inserted, a single invalid
+    item fails the request with a 422 listing the errors per item
+'''
+def bulk_create(model, key, validate):
+    items = get_bulk_items(key)
+
+    chunk_size = request.args.get('chunk_size', BULK_CHUNK_SIZE, type=int)
+    transaction = request.args.get('transaction', 'single')
+    if chunk_size is None or chunk_size < 1 or transaction not in ('single', 'chunk'):
+        abort(400)
+
+    rows, invalid = [], []
+    for index, item in enumerate(items):
+        row, errors = validate(item)
+        if errors:
+            invalid.append({'index': index, 'errors': errors})
+        rows.append(row)
+
+    if invalid:
+        return jsonify({
+            "success": False,
+            "error": 422,
+            "message": "unprocessable",
+            "results": invalid
+        }), 422
+
+    results = []
+    table = model.__table__
+    for start, chunk in _chunks(rows, chunk_size):
+        try:
+            ids = _insert(table, chunk)
+            if transaction == 'chunk':
+                bump_version(table.name)
+                db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            if transaction == 'single' or not results:
+                abort(422)
+            results.extend({'index': index, 'success': False}
+                           for index in range(start, len(rows)))
+            break
+        results.extend({'index': start + offset, 'success': True, 'id': id}
+                       for offset, id in enumerate(ids))
+    else:
+        try:
+            if transaction == 'single':
+                bump_version(table.name)
+            db.session.commit()
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            abort(422)
+
+    created = sum(1 for result in results if result['success'])
+    if created:
+        notify_write(table.name, 'insert')
+    return jsonify({
+        "success": created == len(rows),
+        "created": created,
+        "results": results
+    })
+
+
+## Ids of a bulk patch/delete - from the json body or ids=1,2,3
+def get_bulk_ids(body):
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if ids is not None:
+        #a json array of integers - not strings, booleans or floats
+        if not isinstance(ids, list) or any(type(id) is not int for id in ids):
+            abort(400)
+    elif request.args.get('ids'):
+        try:
+            ids = [int(id) for id in request.args.get('ids').split(',')]
+        except ValueError:
+            abort(400)
+    else:
+        return None
+    if not ids or len(ids) > BULK_MAX_ITEMS:
+        abort(400 if not ids else 413)
+    return ids
+
+
+'''
+WHERE clause of a bulk patch/delete
+    ids and/or the list endpoint filters in the query string, at least one
+    of them is required so a bare request can't touch the whole table
+'''
+def _bulk_criterion(model, filter_rows, body):
+    ids = get_bulk_ids(body)
+    query = filter_rows(model.query)
+    if ids is not None:
+        query = query.filter(model.id.in_(ids))
+
+    criterion = query.whereclause
+    if criterion is None:
+        abort(400)
+    return criterion
+
+
+## Runs an UPDATE/DELETE statement, returning the affected ids
+def _execute_returning(statement, table, criterion):
+    if db.engine.dialect.full_returning:
+        return [row.id for row in
+                db.session.execute(statement.returning(table.c.id))]
+    #no RETURNING - read the ids first, in the same transaction
+    ids = [row.id for row in
+           db.session.execute(table.select().with_only_columns(table.c.id)
+                              .where(criterion))]
+    db.session.execute(statement)
+    return ids
+
+
+def _bulk_response(ids):
+    return jsonify({
+        "success": True,
+        "ids": ids,
+        "count": len(ids)
+    })
+
+
+'''
+Bulk update without loading ORM objects - one UPDATE ... WHERE
+    body - {"ids": [...], "changes": {...}}, the rows can also be chosen
+           with the list endpoint filters in the query string
+    validate - validate_actor / validate_movie
+'''
+def bulk_update(model, filter_rows, validate):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+
+    changes, errors = validate(body.get('changes'), partial=True)
+    if errors or not changes:
+        return jsonify({
+            "success": False,
+            "error": 422,
+            "message": "unprocessable",
+            "errors": errors or ['no changes given']
+        }), 422
+
+    table = model.__table__
+    criterion = _bulk_criterion(model, filter_rows, body)
+    statement = table.update().where(criterion).values(**changes)
+    try:
+        ids = _execute_returning(statement, table, criterion)
+        if ids:
+            bump_version(table.name)
+        db.session.commit()
+    except Exception as e:
+        print(e)
+        db.session.rollback()
+        abort(422)
+    if ids:
+        notify_write(table.name, 'update')
+    return _bulk_response(ids)
+
+
+'''
+Bulk delete without loading ORM objects - one DELETE ... WHERE
+    body - {"ids": [...]}, the rows can also be chosen with the list
+           endpoint filters in the query string
+'''
+def bulk_delete(model, filter_rows):
+    body = request.get_json(silent=True)
+
+    table = model.__table__
+    criterion = _bulk_criterion(model, filter_rows, body)
+    statement = table.delete().where(criterion)
+    try:
+        ids = _execute_returning(statement, table, criterion)
+        if ids:
+            bump_version(table.name)
+        db.session.commit()
+    except Exception as e:
+        print(e)
+        db.session.rollback()
+        abort(422)
+    if ids:
+        notify_write(table.name, 'delete')
+    return _bulk_response(ids)
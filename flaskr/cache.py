@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import quote, urlencode
+from flask import Response, current_app, g, request
+
+from models import get_table_versions
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() != "false"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 30))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+#redis url of a cache shared by every process, unset - each process caches
+#on its own
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL")
+
+
+'''
+Cache backend interface
+    get(key) - cached value or None
+    set(key, value, ttl) - store value for ttl seconds
+
+Values are bytes.
+'''
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+
+'''
+LocalCacheBackend
+Bounded in-process cache with TTL and LRU eviction
+'''
+class LocalCacheBackend(CacheBackend):
+    def __init__(self, max_entries=256, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+'''
+RedisCacheBackend
+Shared backend over a redis client (anything with get/setex), e.g.
+    RedisCacheBackend(redis.Redis.from_url(url))
+'''
+class RedisCacheBackend(CacheBackend):
+    def __init__(self, client, prefix='capstone:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.setex(self.prefix + key, ttl, value)
+
+
+## A RedisCacheBackend on redis_url (redis has to be installed), or a
+# LocalCacheBackend of max_entries without one
+def cache_backend(redis_url, max_entries, prefix='capstone:'):
+    if not redis_url:
+        return LocalCacheBackend(max_entries=max_entries)
+    import redis
+    return RedisCacheBackend(redis.Redis.from_url(redis_url), prefix=prefix)
+
+
+## Route decorator tables are table names, or callables returning the
+# names a request depends on (e.g. filters.include_tables)
+def resolve_tables(tables):
+    names = []
+    for table in tables:
+        names.extend(table() if callable(table) else (table,))
+    return names
+
+
+'''
+ResponseCache
+Caches successful GET responses keyed by path, query string and the
+TableVersion of each table the response depends on. Versions are bumped
+in the transaction of every write, whichever process makes it, so stale
+entries are never read again and just age out. The versions are the ones
+conditional already looked up for the request, or are looked up here.
+'''
+class ResponseCache:
+    def __init__(self, backend, ttl=30, enabled=True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, tables):
+        tablenames = resolve_tables(tables)
+        known = g.get('table_versions', {})
+        if not all(tablename in known for tablename in tablenames):
+            known = dict(zip(tablenames, (version for version, updated_at
+                                          in get_table_versions(tablenames))))
+        versions = ','.join(f'{tablename}={known[tablename]}' for tablename in tablenames)
+        #encoded, so a & or = inside a value can't pass for another param
+        query = urlencode(sorted(request.args.items(multi=True)))
+        return f'response:{quote(request.path)}?{query}#{versions}'
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    ## The cached response of the request, or view's response - stored when
+    # it is a 200
+    def get_or_build(self, tables, view):
+        key = self._key(tables)
+        body = self.backend.get(key)
+        if body is not None:
+            self._count(True)
+            response = Response(body, mimetype='application/json')
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        self._count(False)
+        response = view()
+        if isinstance(response, Response) and response.status_code == 200:
+            self.backend.set(key, response.get_data(), self.ttl)
+            response.headers['X-Cache'] = 'MISS'
+        return response
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+
+## Each app has its own cache (see init_response_cache), apps without one
+# don't cache
+def current_cache():
+    return current_app.extensions.get('response_cache')
+
+## route decorator, tables - the tables the response is built from
+# (see resolve_tables)
+def cached(*tables):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            cache = current_cache()
+            if cache is None or not cache.enabled:
+                return f(*args, **kwargs)
+            return cache.get_or_build(tables, lambda: f(*args, **kwargs))
+
+        return wrapper
+    return cached_decorator
+
+
+def init_response_cache(app, cache=None):
+    if cache is None:
+        cache = ResponseCache(
+            cache_backend(RESPONSE_CACHE_REDIS_URL, RESPONSE_CACHE_SIZE),
+            ttl=RESPONSE_CACHE_TTL,
+            enabled=RESPONSE_CACHE_ENABLED
+        )
+    app.extensions['response_cache'] = cache
+    return cache
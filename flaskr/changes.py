@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from datetime import timedelta
+from flask import Response, abort, current_app, request
+from sqlalchemy import func, select
+
+from models import Change, db, write_listeners
+from flaskr.serializer import dumps
+
+#seconds between change log polls, local writes are picked up at once
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", 1))
+#recent changes kept in memory per process, subscribers further behind
+#catch up from the change log
+CHANGES_BUFFER_SIZE = int(os.getenv("CHANGES_BUFFER_SIZE", 1000))
+#seconds without changes before a stream sends a keep-alive comment
+CHANGES_HEARTBEAT = float(os.getenv("CHANGES_HEARTBEAT", 15))
+#seconds a stream stays open, the client then reconnects with Last-Event-ID
+CHANGES_STREAM_TIMEOUT = float(os.getenv("CHANGES_STREAM_TIMEOUT", 300))
+#days of changes kept by flask prune-changes
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", 7))
+#milliseconds an EventSource waits before reconnecting
+CHANGES_RETRY_MS = 3000
+
+
+## Change events after seq in seq order, at most limit
+def load_changes(after, limit, session=None):
+    session = session if session is not None else db.session()
+    rows = session.execute(
+        select(Change).where(Change.seq > after).order_by(Change.seq).limit(limit)
+    ).scalars()
+    return [change.format() for change in rows]
+
+## seq of the latest change, 0 when there is none
+def latest_seq(session=None):
+    session = session if session is not None else db.session()
+    return session.execute(select(func.max(Change.seq))).scalar() or 0
+
+## Deletes changes older than days, returns how many
+def prune_changes(days=CHANGES_RETENTION_DAYS, session=None):
+    session = session if session is not None else db.session()
+    #created_at is set by the database's clock
+    cutoff = session.execute(select(func.now())).scalar() - timedelta(days=days)
+    result = session.execute(Change.__table__.delete().where(Change.created_at < cutoff))
+    session.commit()
+    return result.rowcount
+
+
+'''
+ChangeFeed
+In-process pub/sub of the change log. One thread per process polls the
+log - every poll_interval, or at once after a local write - into a
+buffer of the latest buffer_size events, and wakes every subscriber.
+Subscribers read from the buffer, so the database sees one query per
+poll however many streams are open. Only a subscriber behind the buffer
+(resuming from an old Last-Event-ID) reads the log itself, until it has
+caught up.
+'''
+class ChangeFeed:
+    def __init__(self, app, poll_interval=CHANGES_POLL_INTERVAL,
+                 buffer_size=CHANGES_BUFFER_SIZE, heartbeat=CHANGES_HEARTBEAT,
+                 stream_timeout=CHANGES_STREAM_TIMEOUT):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.stream_timeout = stream_timeout
+        self._events = deque(maxlen=buffer_size)
+        self._changed = threading.Condition()
+        self._wake = threading.Event()
+        self._polling = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        #the buffer holds every change after floor
+        self.floor = None
+        self.last_seq = None
+
+    ## Starts the polling thread on first use - after a gunicorn fork
+    def start(self):
+        with self._changed:
+            if self._thread is not None:
+                return
+            with self.app.app_context():
+                self.floor = self.last_seq = latest_seq()
+                db.session.remove()
+            self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    ## write listener, a local write is polled for right away
+    def notify(self, tablename, action):
+        if tablename in ('actors', 'movies'):
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stopped:
+                return
+            try:
+                self.poll()
+            except Exception as e:
+                print(e)
+
+    ## Reads the changes after the last one buffered into the buffer
+    def poll(self):
+        with self._polling, self.app.app_context():
+            try:
+                events = load_changes(self.last_seq, self.buffer_size)
+            finally:
+                db.session.remove()
+            if not events:
+                return
+            with self._changed:
+                for event in events:
+                    if len(self._events) == self._events.maxlen:
+                        self.floor = self._events[0]['seq']
+                    self._events.append(event)
+                self.last_seq = events[-1]['seq']
+                self._changed.notify_all()
+
+    '''
+    The buffered events after seq, waiting up to timeout for one. None
+    when the buffer no longer holds every event after seq - the caller
+    reads those from the change log
+    '''
+    def events_after(self, seq, timeout):
+        with self._changed:
+            if seq < self.floor:
+                return None
+            if seq >= self.last_seq:
+                self._changed.wait(timeout)
+                if seq < self.floor:
+                    return None
+            events = []
+            for event in reversed(self._events):
+                if event['seq'] <= seq:
+                    break
+                events.append(event)
+            events.reverse()
+            return events
+
+    def catch_up(self, seq):
+        with self.app.app_context():
+            try:
+                return load_changes(seq, self.buffer_size)
+            finally:
+                db.session.remove()
+
+    ## Server-sent events of every change after seq, until stream_timeout
+    def stream(self, seq):
+        deadline = time.monotonic() + self.stream_timeout
+        yield f'retry: {CHANGES_RETRY_MS}\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            events = self.events_after(seq, min(self.heartbeat, remaining))
+            if events is None:
+                events = self.catch_up(seq)
+                if not events:
+                    #the changes up to the buffer were pruned
+                    seq = max(seq, self.floor)
+                    continue
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            chunk = []
+            for event in events:
+                chunk.append(f"id: {event['seq']}\nevent: {event['action']}\n"
+                             f"data: {dumps(event).decode('utf-8')}\n\n")
+                seq = event['seq']
+            yield ''.join(chunk)
+
+
+## Where a stream starts - the Last-Event-ID header of a reconnecting
+# EventSource, else the after query param, else the latest change
+def get_start_seq(feed):
+    value = request.headers.get('Last-Event-ID') or request.args.get('after')
+    if value is None:
+        return feed.last_seq
+    try:
+        seq = int(value)
+    except ValueError:
+        abort(400)
+    if seq < 0:
+        abort(400)
+    return seq
+
+
+def changes_response():
+    feed = current_app.extensions['change_feed']
+    feed.start()
+    seq = get_start_seq(feed)
+    #the stream doesn't keep the request context (or an admission slot)
+    return Response(feed.stream(seq), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+#feeds of every app, woken by writes in this process
+_feeds = weakref.WeakSet()
+
+def _wake_feeds(tablename, action):
+    for feed in list(_feeds):
+        feed.notify(tablename, action)
+
+write_listeners.append(_wake_feeds)
+
+
+def init_changes(app, feed=None):
+    feed = feed if feed is not None else ChangeFeed(app)
+    app.extensions['change_feed'] = feed
+    _feeds.add(feed)
+    return feed
@@ -0,0 +1,133 @@
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "True").lower() != "false"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 5))
+COMPRESSION_CACHE_SIZE = int(os.getenv("COMPRESSION_CACHE_SIZE", 128))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+
+#strong etags have to differ per content-coding
+ETAG_SUFFIXES = {'gzip': '-gzip', 'br': '-br'}
+
+
+def compress(body, encoding, level=COMPRESSION_LEVEL):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+## Incremental compressor for streamed responses
+def compress_stream(chunks, encoding, level=COMPRESSION_LEVEL):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, finish = compressor.process, compressor.finish
+    else:
+        #wbits 31 - zlib stream with a gzip header
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        process, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = process(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+## Picks br or gzip from Accept-Encoding, None if neither is acceptable
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(candidates, key=lambda encoding: accepted[encoding])
+    return best if accepted[best] > 0 else None
+
+
+'''
+CompressedBodyCache
+Bounded LRU of compressed bodies keyed by (etag or body hash, encoding),
+so a payload served repeatedly - e.g. from the response cache - is only
+compressed once.
+'''
+class CompressedBodyCache:
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compress(self, key, body, encoding):
+        with self._lock:
+            compressed = self._entries.get((key, encoding))
+            if compressed is not None:
+                self._entries.move_to_end((key, encoding))
+                self.hits += 1
+                return compressed
+            self.misses += 1
+
+        compressed = compress(body, encoding)
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[(key, encoding)] = compressed
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return compressed
+
+
+compressed_cache = CompressedBodyCache(COMPRESSION_CACHE_SIZE)
+
+
+def _compressible(response):
+    return (response.status_code == 200 and
+            response.mimetype in COMPRESSIBLE_MIMETYPES and
+            'Content-Encoding' not in response.headers)
+
+
+'''
+Compresses responses above COMPRESSION_MIN_SIZE with the best encoding
+the client accepts. Streamed responses are compressed chunk by chunk,
+buffered bodies are looked up in compressed_cache by their ETag (or a
+hash of the body) before being compressed.
+'''
+def compress_response(response):
+    if not COMPRESSION_ENABLED or not _compressible(response):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESSION_MIN_SIZE:
+            return response
+        key = etag if etag and not weak else hashlib.sha1(body).hexdigest()
+        response.set_data(compressed_cache.get_or_compress(key, body, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag + ETAG_SUFFIXES[encoding], weak=weak)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
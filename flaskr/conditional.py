@@ -0,0 +1,76 @@
+import hashlib
+from functools import wraps
+from flask import Response, g, request
+
+from models import get_table_version, get_table_versions
+from flaskr.cache import resolve_tables
+from flaskr.compression import ETAG_SUFFIXES
+
+
+def _etag(tablenames, versions):
+    #the representation also depends on the path and query string
+    query = request.query_string.decode('utf-8', 'replace')
+    digest = hashlib.sha1(f'{request.path}?{query}'.encode('utf-8')).hexdigest()[:16]
+    tables = '-'.join(f'{tablename}-{version}' for tablename, version in zip(tablenames, versions))
+    return f'{tables}-{digest}'
+
+
+## (versions, last updated_at) of the tables, in a single lookup
+def _versions(tablenames):
+    if len(tablenames) == 1:
+        version, updated_at = get_table_version(tablenames[0])
+        return [version], updated_at
+    rows = get_table_versions(tablenames)
+    updated = [updated_at for version, updated_at in rows if updated_at is not None]
+    return [version for version, updated_at in rows], max(updated, default=None)
+
+
+## returns the etag the client already has (one of the etags of the
+# compressed variants too), or None if the response has to be sent
+def _not_modified(etag, updated_at):
+    if request.if_none_match:
+        for suffix in ('',) + tuple(ETAG_SUFFIXES.values()):
+            if request.if_none_match.contains(etag + suffix):
+                return etag + suffix
+        return None
+    if updated_at is not None and request.if_modified_since is not None:
+        #http dates have second precision
+        if updated_at.replace(microsecond=0) <= \
+                request.if_modified_since.replace(tzinfo=None):
+            return etag
+    return None
+
+
+'''
+Conditional GET route decorator
+    tables - the tables the response is built from (see resolve_tables)
+The strong ETag and Last-Modified come from the tables' TableVersion rows,
+so an If-None-Match / If-Modified-Since hit is answered with a 304 after
+a single lookup, before any rows are queried or serialized.
+'''
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tablenames = resolve_tables(tables)
+            versions, updated_at = _versions(tablenames)
+            etag = _etag(tablenames, versions)
+            #for cached, the response is cached under the same versions
+            g.table_versions = dict(zip(tablenames, versions))
+
+            matched = _not_modified(etag, updated_at)
+            if matched is not None:
+                response = Response(status=304)
+                etag = matched
+            else:
+                response = f(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if updated_at is not None:
+                response.last_modified = updated_at
+            return response
+
+        return wrapper
+    return conditional_decorator
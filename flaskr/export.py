@@ -0,0 +1,48 @@
+import os
+from flask import Response, request, abort, stream_with_context
+
+from flaskr.serializer import dumps
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+
+## Full-table exports, streamed row by row so memory stays flat
+def _json_array(key, rows, fields):
+    yield b'{"success":true,"%s":[' % key.encode('utf-8')
+    separator = b''
+    for row in rows:
+        yield separator + dumps(dict(zip(fields, row)))
+        separator = b','
+    yield b']}'
+
+def _ndjson(rows, fields):
+    for row in rows:
+        yield dumps(dict(zip(fields, row))) + b'\n'
+
+
+'''
+Streams every row of model ordered by id
+    key - name of the list in the json array format
+    fields - the columns written for each row
+    format query param - json (default) or ndjson
+    rows are read as column tuples with yield_per, i.e. a server-side
+    cursor on postgres
+'''
+def export_response(model, key, fields):
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        abort(400)
+
+    rows = model.query \
+        .with_entities(*[getattr(model, name) for name in fields]) \
+        .order_by(model.id) \
+        .yield_per(EXPORT_CHUNK_SIZE)
+
+    if fmt == 'ndjson':
+        body = _ndjson(rows, fields)
+        mimetype = 'application/x-ndjson'
+    else:
+        body = _json_array(key, rows, fields)
+        mimetype = 'application/json'
+
+    return Response(stream_with_context(body), mimetype=mimetype)
@@ -0,0 +1,162 @@
+from datetime import datetime
+from flask import request, abort
+from sqlalchemy import func, orm
+
+from models import Actor, Movie, GenderChoices
+
+ACTOR_FIELDS = ('id', 'name', 'age', 'gender')
+ACTOR_SORTS = ('id', 'name', 'age')
+MOVIE_FIELDS = ('id', 'title', 'release_date')
+MOVIE_SORTS = ('id', 'title', 'release_date')
+#relationships a list can include with each row
+ACTOR_INCLUDES = ('movies',)
+MOVIE_INCLUDES = ('actors',)
+
+
+## Query string helpers - anything malformed is a 400
+def _get_int(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+def _get_date(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+'''
+Actor filters
+    gender - one or more (comma separated) GenderChoices
+    age_min, age_max - inclusive age range
+    name - case-insensitive name prefix
+args defaults to the current request's query string
+'''
+def filter_actors(query, args=None):
+    args = request.args if args is None else args
+    gender = args.get('gender')
+    if gender:
+        try:
+            genders = [GenderChoices[g.strip().upper()] for g in gender.split(',')]
+        except KeyError:
+            abort(400)
+        query = query.filter(Actor.gender.in_(genders))
+
+    age_min = _get_int(args, 'age_min')
+    if age_min is not None:
+        query = query.filter(Actor.age >= age_min)
+
+    age_max = _get_int(args, 'age_max')
+    if age_max is not None:
+        query = query.filter(Actor.age <= age_max)
+
+    name = args.get('name')
+    if name:
+        query = query.filter(
+            func.lower(Actor.name).startswith(name.lower(), autoescape=True))
+
+    return query
+
+
+'''
+Movie filters
+    release_date_from, release_date_to - inclusive ISO 8601 date range
+    title - case-insensitive title prefix
+args defaults to the current request's query string
+'''
+def filter_movies(query, args=None):
+    args = request.args if args is None else args
+    release_date_from = _get_date(args, 'release_date_from')
+    if release_date_from is not None:
+        query = query.filter(Movie.release_date >= release_date_from)
+
+    release_date_to = _get_date(args, 'release_date_to')
+    if release_date_to is not None:
+        query = query.filter(Movie.release_date <= release_date_to)
+
+    title = args.get('title')
+    if title:
+        query = query.filter(
+            func.lower(Movie.title).startswith(title.lower(), autoescape=True))
+
+    return query
+
+
+## Reads the fields projection, e.g. fields=name,age. id is always returned
+# returns every allowed field when there is no projection
+def get_fields(allowed, args=None):
+    args = request.args if args is None else args
+    fields = args.get('fields')
+    if not fields:
+        return list(allowed)
+
+    requested = [f.strip() for f in fields.split(',') if f.strip()]
+    if not requested or any(f not in allowed for f in requested):
+        abort(400)
+    return ['id'] + [f for f in requested if f != 'id']
+
+
+'''
+Base query for a list endpoint
+    only the requested columns (all of fields when there is no
+    projection) and the sort column, which the cursor needs, are
+    selected - as plain rows, no ORM instances are built
+'''
+def select_fields(model, fields, sort):
+    return model.query.with_entities(*select_columns(model, fields, sort))
+
+def select_columns(model, fields, sort):
+    names = list(fields)
+    if sort[0] not in names:
+        names.append(sort[0])
+    return [getattr(model, name) for name in names]
+
+
+## Reads include, e.g. include=movies - relationships returned with each
+# row. returns [] when there is none
+def get_includes(allowed, args=None):
+    args = request.args if args is None else args
+    include = args.get('include')
+    if not include:
+        return []
+
+    requested = [name.strip() for name in include.split(',') if name.strip()]
+    if not requested or any(name not in allowed for name in requested):
+        abort(400)
+    return list(dict.fromkeys(requested))
+
+
+## The tables the included relationships of a list are read from (their
+# association tables and targets), as a callable for conditional and
+# cache.cached - lists without include only depend on their own table
+def include_tables(model, allowed):
+    def tables():
+        include = request.args.get('include', '')
+        names = []
+        for name in include.split(','):
+            name = name.strip()
+            if name in allowed:
+                relationship = getattr(model, name).property
+                names += [relationship.secondary.name, relationship.mapper.local_table.name]
+        return list(dict.fromkeys(names))
+    return tables
+
+
+'''
+Base query for a list endpoint with includes
+    ORM instances with only the columns of select_columns loaded, each
+    included relationship is loaded for the whole page with one more
+    SELECT ... IN query (selectinload), however many rows the page has
+'''
+def select_includes(model, fields, sort, includes):
+    return model.query.options(
+        orm.load_only(*select_columns(model, fields, sort)),
+        *[orm.selectinload(getattr(model, name)) for name in includes])
@@ -0,0 +1,201 @@
+import bisect
+import os
+import random
+import threading
+import time
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from timing import current_timings, record
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() != "false"
+#share of requests whose phases and statements are timed
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", 1.0))
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "True").lower() != "false"
+
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+PHASE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+'''
+Histogram
+Cumulative bucket counts, sum and count per label set, in the
+Prometheus exposition format
+'''
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count) in sorted(self._series.items())]
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, counts, total, count in series:
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(self.labels + ('le',), label_values + (f'{bound:g}',))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            le = _labels(self.labels + ('le',), label_values + ('+Inf',))
+            lines.append(f'{self.name}_bucket{le} {count}')
+            lines.append(f'{self.name}_sum{labels} {total:.6f}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels(self.labels, label_values)} {value}'
+                  for label_values, value in values]
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+'''
+Metrics
+Request counts and durations for every request, plus - for the sampled
+share of requests - the time spent in each phase (see timing) and the
+number of SQL statements run
+'''
+class Metrics:
+    def __init__(self, sample_rate=METRICS_SAMPLE_RATE, enabled=METRICS_ENABLED,
+                 server_timing=SERVER_TIMING_ENABLED):
+        self.sample_rate = sample_rate
+        self.enabled = enabled
+        self.server_timing = server_timing
+        self.requests = Counter(
+            'http_requests_total', 'Requests handled.', ('method', 'route', 'status'))
+        self.duration = Histogram(
+            'http_request_duration_seconds', 'Time to build the response.',
+            ('method', 'route'), DURATION_BUCKETS)
+        self.phases = Histogram(
+            'http_request_phase_seconds', 'Time spent in each phase of sampled requests.',
+            ('method', 'route', 'phase'), PHASE_BUCKETS)
+        self.statements = Histogram(
+            'http_request_sql_statements', 'SQL statements run by sampled requests.',
+            ('method', 'route'), STATEMENT_BUCKETS)
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            g.timings = {}
+
+    def finish_request(self, response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+        self.requests.inc(request.method, route, str(response.status_code))
+        self.duration.observe(elapsed, request.method, route)
+
+        timings = g.get('timings')
+        if timings is None:
+            return response
+        for phase, (seconds, count) in timings.items():
+            self.phases.observe(seconds, request.method, route, phase)
+        self.statements.observe(timings.get('sql', (0, 0))[1], request.method, route)
+
+        if self.server_timing:
+            response.headers['Server-Timing'] = server_timing(timings, elapsed)
+        return response
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.duration, self.phases, self.statements):
+            lines += metric.samples()
+        return '\n'.join(lines) + '\n'
+
+
+## Server-Timing header value, durations in milliseconds
+def server_timing(timings, elapsed):
+    entries = []
+    for phase, (seconds, count) in timings.items():
+        entry = f'{phase};dur={seconds * 1000:.2f}'
+        if phase == 'sql':
+            entry += f';desc="{count} statements"'
+        entries.append(entry)
+    entries.append(f'total;dur={elapsed * 1000:.2f}')
+    return ', '.join(entries)
+
+
+metrics = Metrics()
+
+
+## Times every statement run for a sampled request, on any engine
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_timings() is not None:
+        context._timing_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_timing_start', None)
+    if start is not None:
+        timings = current_timings()
+        if timings is not None:
+            record(timings, 'sql', time.perf_counter() - start)
+
+_listening = False
+
+def _listen_for_statements():
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def init_metrics(app, metrics=metrics):
+    if not metrics.enabled:
+        return metrics
+    _listen_for_statements()
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.finish_request)
+    return metrics
+
+
+def metrics_response(metrics=metrics):
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
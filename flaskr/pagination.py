@@ -0,0 +1,172 @@
+import base64
+import binascii
+import json
+import os
+from datetime import datetime
+from flask import request, abort
+from sqlalchemy import DateTime, or_
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+
+
+## Opaque cursors - base64 encoded json of the last row's keyset values
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400)
+    if not isinstance(values, dict):
+        abort(400)
+    return values
+
+
+## Reads limit & cursor from the query string (args, defaults to the
+# current request's). limit is capped at MAX_PAGE_SIZE, bad values are a 400
+def get_page_args(args=None):
+    args = request.args if args is None else args
+    limit = args.get('limit')
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    return limit, after
+
+
+## Reads sort from the query string - a column name, prefixed with - for
+# descending order, e.g. sort=-age. id is the default and the tie-breaker
+def get_sort(allowed, args=None):
+    args = request.args if args is None else args
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort.lstrip('-')
+    if name not in allowed:
+        abort(400)
+    return name, descending
+
+
+def _cursor_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def _parse_cursor_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, DateTime):
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            abort(400)
+    return value
+
+
+## Filters query to the rows after the cursor in (sort column, id) order,
+# nulls sort last in both directions. Past a non-null value only the
+# non-null rows are matched - a range on the sort column the database can
+# scan its index for - and null_tail_query reads the nulls once they run out
+def _after_cursor(query, model, column, descending, after):
+    if not isinstance(after.get('id'), int):
+        abort(400)
+    last_id = after['id']
+    if column is model.id:
+        return query.filter(model.id < last_id if descending else model.id > last_id)
+
+    value = _parse_cursor_value(column, after.get('value'))
+    if value is None:
+        return query.filter(column.is_(None), model.id > last_id)
+
+    if descending:
+        return query.filter(column <= value, or_(column < value, model.id > last_id))
+    return query.filter(column >= value, or_(column > value, model.id > last_id))
+
+
+'''
+Keyset pagination
+    query - query over model (or its columns), any filters already applied
+    sort - (column name, descending) from get_sort, defaults to id
+    returns the rows of the page and the cursor of the next page
+    (None on the last page)
+
+page_query, null_tail_query and next_page are the steps, for callers
+which run the queries themselves (flaskr.asgi)
+'''
+def paginate(query, model, sort=('id', False)):
+    page, limit = page_query(query, model, sort)
+    rows = page.all()
+    tail = null_tail_query(query, model, sort, len(rows))
+    if tail is not None:
+        rows += tail.all()
+    return next_page(rows, limit, model, sort)
+
+
+## Orders query by (sort column, id) and limits it to the rows after the
+# cursor - one more than the page size, to tell if there is a next page
+def page_query(query, model, sort=('id', False), args=None):
+    limit, after = get_page_args(args)
+    name, descending = sort
+    column = _sort_column(model, name)
+
+    if after is not None:
+        if after.get('sort', 'id') != name or after.get('desc', False) != descending:
+            abort(400)
+        query = _after_cursor(query, model, column, descending, after)
+
+    if column is model.id:
+        query = query.order_by(model.id.desc() if descending else model.id)
+    else:
+        order = column.desc() if descending else column.asc()
+        query = query.order_by(order.nulls_last(), model.id)
+
+    return query.limit(limit + 1), limit
+
+
+## The rows without a sort value which follow a page of page_query that
+# came up short after a non-null cursor value (count rows), None when
+# there are none to read. query is the one given to page_query
+def null_tail_query(query, model, sort, count, args=None):
+    limit, after = get_page_args(args)
+    name, descending = sort
+    column = _sort_column(model, name)
+    if count > limit or column is model.id or after is None or after.get('value') is None:
+        return None
+    return query.filter(column.is_(None)).order_by(model.id).limit(limit + 1 - count)
+
+
+## Trims the rows of page_query to the page, returns them with the cursor
+# of the next page
+def next_page(rows, limit, model, sort=('id', False)):
+    name, descending = sort
+    column = _sort_column(model, name)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = {'id': rows[-1].id}
+        if descending:
+            last['desc'] = True
+        if column is not model.id:
+            last.update({
+                'sort': name,
+                'value': _cursor_value(getattr(rows[-1], name))
+            })
+        next_cursor = encode_cursor(last)
+    return rows, next_cursor
+
+
+def _sort_column(model, name):
+    return model.id if name == 'id' else getattr(model, name)
@@ -0,0 +1,212 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#on by default in development (FLASK_ENV=development)
+QUERY_DEBUG = os.getenv(
+    "QUERY_DEBUG", str(os.getenv("FLASK_ENV") == "development")).lower() == "true"
+#more statements of one shape than this in a request is a likely N+1
+QUERY_DEBUG_REPEAT_THRESHOLD = int(os.getenv("QUERY_DEBUG_REPEAT_THRESHOLD", 5))
+QUERY_DEBUG_SLOW_MS = float(os.getenv("QUERY_DEBUG_SLOW_MS", 100))
+QUERY_DEBUG_EXPLAIN = os.getenv("QUERY_DEBUG_EXPLAIN", "True").lower() != "false"
+
+logger = logging.getLogger(__name__)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\$\d+|(?<!:):\w+|\?')
+_IN_LIST = re.compile(r'\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_SPACE = re.compile(r'\s+')
+
+
+## Statement shape - the statement with literals and parameters replaced
+# by ?, and IN lists of any length collapsed, so the same query with
+# different values counts as one shape
+def normalize(statement):
+    shape = _STRING.sub('?', statement)
+    shape = _PLACEHOLDER.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    shape = _IN_LIST.sub('IN (...)', shape)
+    return _SPACE.sub(' ', shape).strip()
+
+
+class Query:
+    __slots__ = ('statement', 'parameters', 'seconds', 'engine', 'executemany')
+
+    def __init__(self, statement, parameters, seconds, engine, executemany):
+        self.statement = statement
+        self.parameters = parameters
+        self.seconds = seconds
+        self.engine = engine
+        self.executemany = executemany
+
+    @property
+    def shape(self):
+        return normalize(self.statement)
+
+
+'''
+QueryLog
+The statements run on any engine by this thread while the log is active
+(see capture_queries), in order
+'''
+class QueryLog:
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def shapes(self):
+        return Counter(query.shape for query in self.queries)
+
+    ## (shape, count) of the shapes run more than threshold times
+    def repeated(self, threshold=QUERY_DEBUG_REPEAT_THRESHOLD):
+        return [(shape, count) for shape, count in self.shapes().most_common()
+                if count > threshold]
+
+    def slow(self, ms=QUERY_DEBUG_SLOW_MS):
+        return [query for query in self.queries if query.seconds * 1000 >= ms]
+
+    ## One line per shape with its count, for assertion messages
+    def report(self):
+        return '\n'.join(f'{count} x {shape}' for shape, count in self.shapes().most_common())
+
+
+_local = threading.local()
+
+def _active_logs():
+    logs = getattr(_local, 'logs', None)
+    if logs is None:
+        logs = _local.logs = []
+    return logs
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _active_logs() and not getattr(_local, 'paused', False):
+        context._query_log_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_log_start', None)
+    if start is None:
+        return
+    query = Query(statement, parameters, time.perf_counter() - start,
+                  conn.engine, executemany)
+    for log in _active_logs():
+        log.queries.append(query)
+
+_listening = False
+
+def _listen_for_statements():
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def start_log():
+    _listen_for_statements()
+    log = QueryLog()
+    _active_logs().append(log)
+    return log
+
+def stop_log(log):
+    logs = _active_logs()
+    if log in logs:
+        logs.remove(log)
+
+
+'''
+Records the statements run inside the block, e.g. in a test
+
+    with capture_queries() as queries:
+        client.get('/actors')
+    self.assertLessEqual(len(queries), 2, queries.report())
+    self.assertEqual(queries.repeated(threshold=1), [])
+'''
+@contextmanager
+def capture_queries():
+    log = start_log()
+    try:
+        yield log
+    finally:
+        stop_log(log)
+
+
+## The query plan of a recorded statement, None if it can't be explained
+def explain(query):
+    if query.executemany or not query.statement.lstrip().upper().startswith(
+            ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+        return None
+    prefix = 'EXPLAIN QUERY PLAN ' if query.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+
+    #the explain itself isn't recorded
+    _local.paused = True
+    try:
+        with query.engine.connect() as connection:
+            rows = connection.exec_driver_sql(prefix + query.statement, query.parameters).all()
+    except Exception as e:
+        return f'(explain failed: {e})'
+    finally:
+        _local.paused = False
+    return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+
+'''
+Debug mode (QUERY_DEBUG) - every request records its statements, reports
+the count in an X-Query-Count header, and logs a warning for each shape
+repeated more than repeat_threshold times (a likely N+1) and for each
+statement slower than slow_ms, with its query plan
+'''
+class QueryDebugger:
+    def __init__(self, repeat_threshold=QUERY_DEBUG_REPEAT_THRESHOLD,
+                 slow_ms=QUERY_DEBUG_SLOW_MS, explain=QUERY_DEBUG_EXPLAIN):
+        self.repeat_threshold = repeat_threshold
+        self.slow_ms = slow_ms
+        self.explain = explain
+
+    def start_request(self):
+        g.query_log = start_log()
+
+    def finish_request(self, response):
+        log = g.pop('query_log', None)
+        if log is None:
+            return response
+        stop_log(log)
+
+        route = f'{request.method} {request.path}'
+        for shape, count in log.repeated(self.repeat_threshold):
+            logger.warning('possible N+1 in %s: %d x %s', route, count, shape)
+        for query in log.slow(self.slow_ms):
+            plan = explain(query) if self.explain else None
+            logger.warning('slow query in %s (%.1f ms): %s%s', route, query.seconds * 1000,
+                           query.statement, f'\n{plan}' if plan else '')
+
+        response.headers['X-Query-Count'] = str(len(log))
+        return response
+
+    def teardown_request(self, exception=None):
+        log = g.pop('query_log', None)
+        if log is not None:
+            stop_log(log)
+
+
+def init_query_debug(app, debugger=None, enabled=QUERY_DEBUG):
+    if not enabled:
+        return None
+    debugger = debugger if debugger is not None else QueryDebugger()
+    app.before_request(debugger.start_request)
+    app.after_request(debugger.finish_request)
+    app.teardown_request(debugger.teardown_request)
+    return debugger
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import threading
+import time
+import weakref
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+from flaskr.cache import cache_backend
+
+#seconds a client's reads go to the primary after it writes
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+#seconds before a replica which failed is tried again
+REPLICA_RETRY_INTERVAL = int(os.getenv("REPLICA_RETRY_INTERVAL", 30))
+#redis url where sticky clients are kept, so a write on one worker sends the
+#client's next reads on every worker to the primary. Unset - per process
+REPLICA_STICKY_REDIS_URL = os.getenv("REPLICA_STICKY_REDIS_URL")
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+## Identifies the client for read-your-writes - its bearer token, or its
+# address for anonymous requests
+def client_key():
+    authorization = request.headers.get('Authorization')
+    if authorization:
+        return 'sticky:' + hashlib.sha256(authorization.encode('utf-8')).hexdigest()
+    return f'sticky:{request.remote_addr}'
+
+
+'''
+ReplicaRouter
+Picks the engine for reads of the current request: round robin over the
+replica binds (replica_0, replica_1... see models.setup_db) which are up,
+or None - meaning the primary - for writes, for clients which wrote within
+sticky_seconds, outside of requests and when every replica is down.
+
+A replica whose connection fails is marked down and skipped until
+retry_interval has passed, then probed with SELECT 1 before it is used again.
+Sticky clients are kept in backend, a flaskr.cache backend, so a shared
+backend keeps reads sticky across gunicorn workers.
+'''
+class ReplicaRouter:
+    def __init__(self, sticky_seconds=REPLICA_STICKY_SECONDS,
+                 retry_interval=REPLICA_RETRY_INTERVAL, backend=None,
+                 clock=time.monotonic):
+        self.sticky_seconds = sticky_seconds
+        self.retry_interval = retry_interval
+        self.backend = backend if backend is not None else cache_backend(
+            REPLICA_STICKY_REDIS_URL, 4096, prefix='capstone:')
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down = {}
+        self._watched = weakref.WeakSet()
+        self.reads = {}
+
+    def replica_binds(self, app):
+        return sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {}
+                      if key.startswith('replica_'))
+
+    def read_engine(self, app):
+        if not has_request_context() or request.method not in READ_METHODS:
+            return None
+
+        get_engine = lambda key: db.get_engine(app, bind=key)
+        #decided once per request - a single sticky lookup, and every query
+        #of the request reads from the same replica
+        if 'replica_bind' not in g:
+            if self.sticky_seconds > 0 and self.backend.get(client_key()) is not None:
+                g.replica_bind = None
+            else:
+                g.replica_bind = self.choose(self.replica_binds(app), get_engine)
+        return get_engine(g.replica_bind) if g.replica_bind is not None else None
+
+    ## Next replica bind in round robin order which is up, None if there is none
+    def choose(self, keys, get_engine):
+        if not keys:
+            return None
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(keys)
+
+        for i in range(len(keys)):
+            key = keys[(start + i) % len(keys)]
+            if self.is_up(key, get_engine):
+                self._watch(key, get_engine(key))
+                with self._lock:
+                    self.reads[key] = self.reads.get(key, 0) + 1
+                return key
+        return None
+
+    def is_up(self, key, get_engine):
+        with self._lock:
+            down_since = self._down.get(key)
+        if down_since is None:
+            return True
+        if self.clock() - down_since < self.retry_interval:
+            return False
+
+        #probed by one request at a time, others skip the replica meanwhile
+        with self._lock:
+            self._down[key] = self.clock()
+        if self.probe(get_engine(key)):
+            self.mark_up(key)
+            return True
+        return False
+
+    def probe(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+            return True
+        except Exception:
+            return False
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down[key] = self.clock()
+
+    def mark_up(self, key):
+        with self._lock:
+            self._down.pop(key, None)
+
+    def _watch(self, key, engine):
+        if engine in self._watched:
+            return
+        self._watched.add(engine)
+
+        @event.listens_for(engine, 'handle_error')
+        def replica_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(key)
+
+    ## Reads of this client go to the primary for sticky_seconds
+    def stick(self, key):
+        if self.sticky_seconds > 0:
+            self.backend.set(key, b'1', self.sticky_seconds)
+
+    def stats(self, app):
+        with self._lock:
+            return [{'bind': key, 'up': key not in self._down,
+                     'reads': self.reads.get(key, 0)}
+                    for key in self.replica_binds(app)]
+
+
+def init_replicas(app, router=None):
+    router = router if router is not None else ReplicaRouter()
+    app.extensions['replica_router'] = router
+
+    @app.after_request
+    def stick_after_write(response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            router.stick(client_key())
+        return response
+
+    return router
@@ -0,0 +1,127 @@
+import re
+from flask import request, abort
+from sqlalchemy import Float, and_, case, cast, func, literal, literal_column, or_, select, union_all
+
+from models import Actor, Movie, db
+from flaskr.pagination import encode_cursor, get_page_args
+
+#what can be searched - result type: (model, text column)
+SEARCH_TYPES = {
+    'actor': (Actor, Actor.name),
+    'movie': (Movie, Movie.title)
+}
+#the text search configuration of the search_vector columns (models)
+TS_CONFIG = 'simple'
+MAX_QUERY_LENGTH = 200
+
+
+## Search terms, the words of q lowercased. No words is a 400
+def get_terms(args):
+    q = args.get('q', '')
+    if len(q) > MAX_QUERY_LENGTH:
+        abort(400)
+    terms = re.findall(r'[^\W_]+', q.lower())
+    if not terms:
+        abort(400)
+    return terms
+
+## Reads type - one or more (comma separated) result types, default all
+def get_types(args):
+    types = args.get('type')
+    if not types:
+        return list(SEARCH_TYPES)
+    names = [name.strip() for name in types.split(',') if name.strip()]
+    if not names or any(name not in SEARCH_TYPES for name in names):
+        abort(400)
+    return list(dict.fromkeys(names))
+
+
+'''
+Postgres hits - rows whose search_vector matches every term as a prefix,
+or whose text is similar (pg_trgm's % operator, for typos). Ranked by
+the better of ts_rank and trigram similarity, both use GIN indexes.
+'''
+def _postgres_hits(kind, model, column, terms):
+    vector = literal_column(f'{model.__tablename__}.search_vector')
+    query = func.to_tsquery(TS_CONFIG, ' & '.join(f'{term}:*' for term in terms))
+    text = func.lower(column)
+    phrase = ' '.join(terms)
+    #float8, so ranks round trip through the cursor exactly
+    rank = cast(func.greatest(func.ts_rank(vector, query), func.similarity(text, phrase)), Float)
+    return select(
+        literal(kind).label('type'), model.id.label('id'),
+        column.label('text'), rank.label('rank')
+    ).where(or_(vector.op('@@')(query), text.op('%')(phrase)))
+
+
+'''
+Fallback hits for other databases (sqlite in local tests) - rows where
+every term starts a word of the text. Exact matches rank first, then
+texts starting with the query, then the rest.
+'''
+def _fallback_hits(kind, model, column, terms):
+    text = func.lower(column)
+    phrase = ' '.join(terms)
+    matches = [or_(text.startswith(term, autoescape=True),
+                   text.contains(' ' + term, autoescape=True)) for term in terms]
+    rank = case(
+        (text == phrase, 1.0),
+        (text.startswith(phrase, autoescape=True), 0.75),
+        else_=0.5
+    )
+    return select(
+        literal(kind).label('type'), model.id.label('id'),
+        column.label('text'), rank.label('rank')
+    ).where(and_(*matches))
+
+
+## Keeps the hits after the cursor in (rank descending, type, id) order
+def _after_cursor(hits, after):
+    rank, kind, last_id = after.get('rank'), after.get('type'), after.get('id')
+    if not (isinstance(rank, (int, float)) and kind in SEARCH_TYPES
+            and isinstance(last_id, int)):
+        abort(400)
+    return or_(
+        hits.c.rank < rank,
+        and_(hits.c.rank == rank, or_(
+            hits.c.type > kind,
+            and_(hits.c.type == kind, hits.c.id > last_id))))
+
+
+'''
+Full-text search over actor names and movie titles
+    q - the search text, every word has to match (as a prefix)
+    type - actor and/or movie, default both
+    limit & cursor - keyset pagination as on the list endpoints
+returns the hits of the page, best first, and the cursor of the next page
+'''
+def search_results(args=None):
+    args = request.args if args is None else args
+    terms = get_terms(args)
+    types = get_types(args)
+    limit, after = get_page_args(args)
+
+    session = db.session()
+    postgres = session.get_bind().dialect.name == 'postgresql'
+    hits_for = _postgres_hits if postgres else _fallback_hits
+    hits = union_all(*[hits_for(kind, *SEARCH_TYPES[kind], terms) for kind in types]) \
+        .subquery('hits')
+
+    query = select(hits).order_by(hits.c.rank.desc(), hits.c.type, hits.c.id)
+    if after is not None:
+        query = query.where(_after_cursor(hits, after))
+    rows = session.execute(query.limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor({'rank': last.rank, 'type': last.type, 'id': last.id})
+
+    results = [{
+        'type': row.type,
+        'id': row.id,
+        ('name' if row.type == 'actor' else 'title'): row.text,
+        'rank': round(row.rank, 4)
+    } for row in rows]
+    return results, next_cursor
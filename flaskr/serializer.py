@@ -0,0 +1,102 @@
+import json
+import os
+from datetime import date, datetime
+from enum import Enum
+from flask import current_app
+
+from timing import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#auto uses orjson when it is installed, json forces the stdlib encoder
+JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "auto")
+
+
+'''
+JSONEncoder
+stdlib encoder which writes datetimes as ISO 8601 and enums as their
+value - the same output as orjson, so both serializers are interchangeable
+'''
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, (datetime, date)):
+            return o.isoformat()
+        if isinstance(o, Enum):
+            return o.value
+        return super().default(o)
+
+
+def _orjson_default(o):
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+'''
+Serializer
+    dumps(obj) - compact json as bytes with sorted keys, like jsonify
+'''
+class Serializer:
+    def __init__(self, backend='auto'):
+        if backend not in ('auto', 'orjson', 'json'):
+            raise ValueError(f'Unknown JSON serializer {backend}')
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('orjson is not installed')
+        self.backend = 'orjson' if backend != 'json' and orjson is not None else 'json'
+
+        if self.backend == 'orjson':
+            self._options = orjson.OPT_SORT_KEYS
+            self.dumps = self._orjson_dumps
+        else:
+            self._encoder = JSONEncoder(
+                separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+            self.dumps = self._json_dumps
+
+    def _orjson_dumps(self, obj):
+        return orjson.dumps(obj, default=_orjson_default, option=self._options)
+
+    def _json_dumps(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+serializer = Serializer(JSON_SERIALIZER)
+
+def dumps(obj):
+    return serializer.dumps(obj)
+
+
+## Drop-in replacement for flask.jsonify using the app serializer
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    with timed('json'):
+        body = serializer.dumps(data) + b'\n'
+    return current_app.response_class(
+        body,
+        mimetype=current_app.config.get('JSONIFY_MIMETYPE', 'application/json')
+    )
+
+
+## Serializes rows straight from column tuples, no ORM instances
+# fields - the column names, in the order they were selected
+def rows_to_dicts(rows, fields):
+    with timed('format'):
+        return [dict(zip(fields, row)) for row in rows]
+
+
+## ORM instances from select_includes to dicts of fields, plus each
+# included relationship as a list of format()ed rows
+def entities_to_dicts(entities, fields, includes):
+    with timed('format'):
+        dicts = [{field: getattr(entity, field) for field in fields} for entity in entities]
+    #format() times itself
+    for entity, data in zip(entities, dicts):
+        for name in includes:
+            data[name] = [related.format() for related in getattr(entity, name)]
+    return dicts
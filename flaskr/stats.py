@@ -0,0 +1,74 @@
+from sqlalchemy import select, text
+
+from models import StatCount, db, stat_buckets, stats_count_sql, stats_rebuild_sql
+
+#the stats of each table, their counts sum to the table's row count
+TABLE_STATS = {tablename: list(stats) for tablename, stats in stat_buckets(None, '').items()}
+
+
+## {stat: {bucket: count}} of the non-empty buckets in stat_counts
+def stored_stats(session=None):
+    session = session if session is not None else db.session()
+    stats = {stat: {} for stats in TABLE_STATS.values() for stat in stats}
+    rows = session.execute(
+        select(StatCount.stat, StatCount.bucket, StatCount.count)
+        .where(StatCount.count != 0)
+        .order_by(StatCount.stat, StatCount.bucket))
+    for stat, bucket, count in rows:
+        stats.setdefault(stat, {})[bucket] = count
+    return stats
+
+
+## The same as stored_stats, counted from scratch over actors and movies
+def compute_stats(session=None):
+    session = session if session is not None else db.session()
+    dialect = session.get_bind().dialect.name
+    stats = {stat: {} for stats in TABLE_STATS.values() for stat in stats}
+    for stat, bucket, count in session.execute(text(stats_count_sql(dialect))):
+        stats[stat][bucket] = int(count)
+    return stats
+
+
+## The stats whose stored counts differ from the computed ones,
+# {stat: {bucket: (stored, computed)}} - empty when consistent
+def verify_stats(session=None):
+    session = session if session is not None else db.session()
+    stored, computed = stored_stats(session), compute_stats(session)
+    mismatches = {}
+    for stat in computed:
+        buckets = set(stored.get(stat, {})) | set(computed[stat])
+        for bucket in sorted(buckets):
+            expected = computed[stat].get(bucket, 0)
+            actual = stored.get(stat, {}).get(bucket, 0)
+            if actual != expected:
+                mismatches.setdefault(stat, {})[bucket] = (actual, expected)
+    return mismatches
+
+
+'''
+Recomputes stat_counts from scratch in one transaction, e.g. after rows
+were written with the triggers disabled or restored from a dump. The
+tables are locked against writes meanwhile (postgres), so no change
+slips in between the delete and the recount.
+'''
+def rebuild_stats(session=None):
+    session = session if session is not None else db.session()
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute(text('LOCK TABLE actors, movies, stat_counts IN SHARE ROW EXCLUSIVE MODE'))
+    session.execute(StatCount.__table__.delete())
+    session.execute(text(stats_rebuild_sql(dialect)))
+    session.commit()
+
+
+## The /stats payload - row counts and the counts of every stat
+def stats_summary(session=None):
+    stats = stored_stats(session)
+    summary = {
+        tablename: {'total': sum(stats[table_stats[0]].values())}
+        for tablename, table_stats in TABLE_STATS.items()
+    }
+    for tablename, table_stats in TABLE_STATS.items():
+        for stat in table_stats:
+            summary[tablename][stat[len(tablename) + 1:]] = stats[stat]
+    return summary
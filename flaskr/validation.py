@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from models import GenderChoices
+
+
+## Accepts ISO 8601 dates and the HTTP dates the API itself returns,
+# e.g. 'Fri, 11 Oct 2024 00:00:00 GMT'. Returns a naive UTC datetime
+def parse_date(value):
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        if not isinstance(value, str):
+            raise ValueError('not a date')
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            try:
+                parsed = parsedate_to_datetime(value)
+            except (TypeError, ValueError, IndexError):
+                raise ValueError('not a date')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _age(value):
+    if isinstance(value, bool):
+        raise ValueError
+    age = int(value)
+    if age < 0:
+        raise ValueError
+    return age
+
+
+'''
+Validates an actor from a request body
+    partial - only validate the fields present (PATCH)
+    returns (column values, list of errors)
+'''
+def validate_actor(item, partial=False):
+    if not isinstance(item, dict):
+        return None, ['expected an object']
+
+    row, errors = {}, []
+    if 'name' in item or not partial:
+        name = item.get('name')
+        if not isinstance(name, str) or not name.strip():
+            errors.append('name is required')
+        else:
+            row['name'] = name
+
+    if item.get('age') is not None:
+        try:
+            row['age'] = _age(item['age'])
+        except (TypeError, ValueError):
+            errors.append('age must be a positive integer')
+
+    if item.get('gender') is not None:
+        try:
+            row['gender'] = GenderChoices[str(item['gender']).upper()]
+        except KeyError:
+            errors.append('gender must be one of ' +
+                          ', '.join(g.name for g in GenderChoices))
+
+    return row, errors
+
+
+'''
+Validates a movie from a request body
+    partial - only validate the fields present (PATCH)
+    returns (column values, list of errors)
+'''
+def validate_movie(item, partial=False):
+    if not isinstance(item, dict):
+        return None, ['expected an object']
+
+    row, errors = {}, []
+    if 'title' in item or not partial:
+        title = item.get('title')
+        if not isinstance(title, str) or not title.strip():
+            errors.append('title is required')
+        else:
+            row['title'] = title
+
+    if item.get('release_date') is not None:
+        try:
+            row['release_date'] = parse_date(item['release_date'])
+        except ValueError:
+            errors.append('release_date must be an ISO 8601 or HTTP date')
+
+    return row, errors
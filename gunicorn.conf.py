@@ -0,0 +1,27 @@
+'''
+gunicorn settings, read from the working directory
+
+    gunicorn 'flaskr:create_app()'
+
+The app is built once in the master and forked into the workers
+(GUNICORN_PRELOAD, default True), so a worker boot or recycle costs a
+fork, not the imports and create_app. No connection is opened while the
+app is built. post_fork still gives each worker fresh pools, in case
+the master opened one.
+
+Workers are threaded (GUNICORN_WORKER_CLASS, default gthread) with
+GUNICORN_THREADS threads each. A GET /changes stream holds its thread
+while open, so sync workers would be taken by a few subscribers.
+'''
+import os
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "True").lower() != "false"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from models import reset_engines
+    reset_engines(server.app.wsgi())
@@ -0,0 +1,42 @@
+"""add search
+
+Revision ID: 3b7e9d04c6a1
+Revises: 8d2c41f7a9e3
+Create Date: 2026-10-18 17:25:40.663018
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3b7e9d04c6a1'
+down_revision = '8d2c41f7a9e3'
+branch_labels = None
+depends_on = None
+
+SEARCH_COLUMNS = {'actors': 'name', 'movies': 'title'}
+
+
+def upgrade():
+    #search falls back to LIKE matching elsewhere, see flaskr.search
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for tablename, column in SEARCH_COLUMNS.items():
+        op.execute(
+            f"ALTER TABLE {tablename} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+            f"(to_tsvector('simple', coalesce({column}, ''))) STORED")
+        op.execute(
+            f"CREATE INDEX ix_{tablename}_search_vector ON {tablename} USING gin (search_vector)")
+        op.execute(
+            f"CREATE INDEX ix_{tablename}_{column}_trgm ON {tablename} "
+            f"USING gin (lower({column}) gin_trgm_ops)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for tablename, column in SEARCH_COLUMNS.items():
+        op.drop_index(f'ix_{tablename}_{column}_trgm', table_name=tablename)
+        op.drop_index(f'ix_{tablename}_search_vector', table_name=tablename)
+        op.drop_column(tablename, 'search_vector')
@@ -0,0 +1,40 @@
+"""add updated_at and table versions
+
+Revision ID: 55a0560132cf
+Revises: 5f3cb1579b81
+Create Date: 2026-10-18 11:36:52.170484
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '55a0560132cf'
+down_revision = '5f3cb1579b81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('movies', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 0, 'updated_at': now},
+        {'table_name': 'movies', 'version': 0, 'updated_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    op.drop_column('movies', 'updated_at')
+    op.drop_column('actors', 'updated_at')
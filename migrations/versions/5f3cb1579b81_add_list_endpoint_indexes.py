@@ -0,0 +1,42 @@
+"""add list endpoint indexes
+
+Revision ID: 5f3cb1579b81
+Revises: ce94acd600ea
+Create Date: 2026-10-18 10:14:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3cb1579b81'
+down_revision = 'ce94acd600ea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'], unique=False)
+    op.create_index(
+        'ix_actors_name_lower', 'actors',
+        [sa.text('lower(name) text_pattern_ops')
+         if op.get_bind().dialect.name == 'postgresql'
+         else sa.text('lower(name)')],
+        unique=False
+    )
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    op.create_index(
+        'ix_movies_title_lower', 'movies',
+        [sa.text('lower(title) text_pattern_ops')
+         if op.get_bind().dialect.name == 'postgresql'
+         else sa.text('lower(title)')],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_lower', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_name_lower', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
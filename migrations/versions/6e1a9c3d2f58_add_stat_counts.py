@@ -0,0 +1,113 @@
+"""add stat counts
+
+Revision ID: 6e1a9c3d2f58
+Revises: 3b7e9d04c6a1
+Create Date: 2026-10-18 18:12:07.215930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e1a9c3d2f58'
+down_revision = '3b7e9d04c6a1'
+branch_labels = None
+depends_on = None
+
+UPSERT = (
+    "INSERT INTO stat_counts (stat, bucket, count) "
+    "SELECT stat, bucket, sum(delta) FROM ({changes}) changes "
+    "GROUP BY stat, bucket HAVING sum(delta) <> 0 ORDER BY stat, bucket "
+    "ON CONFLICT (stat, bucket) DO UPDATE SET count = stat_counts.count + excluded.count")
+
+
+def buckets(dialect, row):
+    if dialect == 'postgresql':
+        year = f"CAST(CAST(EXTRACT(YEAR FROM {row}.release_date) AS INTEGER) AS TEXT)"
+    else:
+        year = f"strftime('%Y', {row}.release_date)"
+    return {
+        'actors': {
+            'actors_by_gender': f"CAST({row}.gender AS TEXT)",
+            'actors_by_age': f"CAST({row}.age / 10 * 10 AS TEXT)"
+        },
+        'movies': {
+            'movies_by_release_year': year
+        }
+    }
+
+
+def changes(dialect, tablename, source, delta):
+    return ' UNION ALL '.join(
+        f"SELECT '{stat}' AS stat, coalesce({bucket}, 'unknown') AS bucket, {delta} AS delta "
+        f"FROM {source}"
+        for stat, bucket in buckets(dialect, source)[tablename].items())
+
+
+def upgrade():
+    op.create_table(
+        'stat_counts',
+        sa.Column('stat', sa.String(), nullable=False),
+        sa.Column('bucket', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('stat', 'bucket')
+    )
+    dialect = op.get_bind().dialect.name
+    for tablename in ('actors', 'movies'):
+        if dialect == 'postgresql':
+            new = changes(dialect, tablename, 'new_rows', 1)
+            old = changes(dialect, tablename, 'old_rows', -1)
+            op.execute(f"""
+CREATE OR REPLACE FUNCTION {tablename}_stats() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {UPSERT.format(changes=new)};
+    ELSIF TG_OP = 'DELETE' THEN
+        {UPSERT.format(changes=old)};
+    ELSE
+        {UPSERT.format(changes=new + ' UNION ALL ' + old)};
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql""")
+            for event_name, tables in (('INSERT', 'NEW TABLE AS new_rows'),
+                                       ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+                                       ('DELETE', 'OLD TABLE AS old_rows')):
+                op.execute(
+                    f"CREATE TRIGGER {tablename}_stats_{event_name.lower()} "
+                    f"AFTER {event_name} ON {tablename} REFERENCING {tables} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION {tablename}_stats()")
+            continue
+
+        for event_name, rows in (('INSERT', (('NEW', 1),)),
+                                 ('UPDATE', (('OLD', -1), ('NEW', 1))),
+                                 ('DELETE', (('OLD', -1),))):
+            upserts = ''.join(
+                f"INSERT INTO stat_counts (stat, bucket, count) "
+                f"VALUES ('{stat}', coalesce({bucket}, 'unknown'), {delta}) "
+                f"ON CONFLICT (stat, bucket) DO UPDATE SET count = count + excluded.count;\n"
+                for row, delta in rows
+                for stat, bucket in buckets(dialect, row)[tablename].items())
+            op.execute(
+                f"CREATE TRIGGER {tablename}_stats_{event_name.lower()} "
+                f"AFTER {event_name} ON {tablename} BEGIN\n{upserts}END")
+
+    counts = ' UNION ALL '.join(
+        changes(dialect, tablename, tablename, 1) for tablename in ('actors', 'movies'))
+    op.execute(
+        f"INSERT INTO stat_counts (stat, bucket, count) "
+        f"SELECT stat, bucket, sum(delta) FROM ({counts}) changes GROUP BY stat, bucket")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for tablename in ('actors', 'movies'):
+        for event_name in ('insert', 'update', 'delete'):
+            if dialect == 'postgresql':
+                op.execute(f"DROP TRIGGER {tablename}_stats_{event_name} ON {tablename}")
+            else:
+                op.execute(f"DROP TRIGGER {tablename}_stats_{event_name}")
+        if dialect == 'postgresql':
+            op.execute(f"DROP FUNCTION {tablename}_stats()")
+    op.drop_table('stat_counts')
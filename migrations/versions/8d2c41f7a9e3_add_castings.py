@@ -0,0 +1,33 @@
+"""add castings
+
+Revision ID: 8d2c41f7a9e3
+Revises: 55a0560132cf
+Create Date: 2026-10-18 16:02:11.418306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2c41f7a9e3'
+down_revision = '55a0560132cf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'castings',
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('actor_id', 'movie_id')
+    )
+    op.create_index('ix_castings_movie_id', 'castings', ['movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_castings_movie_id', table_name='castings')
+    op.drop_table('castings')
@@ -0,0 +1,78 @@
+"""add changes
+
+Revision ID: a4d8f2b6e019
+Revises: 6e1a9c3d2f58
+Create Date: 2026-10-18 19:03:44.508127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8f2b6e019'
+down_revision = '6e1a9c3d2f58'
+branch_labels = None
+depends_on = None
+
+ACTIONS = {'INSERT': 'create', 'UPDATE': 'patch', 'DELETE': 'delete'}
+
+
+def upgrade():
+    op.create_table(
+        'changes',
+        sa.Column('seq', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('action', sa.String(), nullable=False),
+        sa.Column('entity_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+        sa.PrimaryKeyConstraint('seq'),
+        sqlite_autoincrement=True
+    )
+    op.create_index('ix_changes_created_at', 'changes', ['created_at'], unique=False)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("""
+CREATE OR REPLACE FUNCTION log_changes() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(7240);
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO changes (table_name, action, entity_id)
+        SELECT TG_TABLE_NAME, 'delete', id FROM old_rows ORDER BY id;
+    ELSE
+        INSERT INTO changes (table_name, action, entity_id)
+        SELECT TG_TABLE_NAME, CASE TG_OP WHEN 'INSERT' THEN 'create' ELSE 'patch' END, id
+        FROM new_rows ORDER BY id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql""")
+        for tablename in ('actors', 'movies'):
+            for event_name in ACTIONS:
+                rows = 'OLD TABLE AS old_rows' if event_name == 'DELETE' else 'NEW TABLE AS new_rows'
+                op.execute(
+                    f"CREATE TRIGGER {tablename}_changes_{event_name.lower()} "
+                    f"AFTER {event_name} ON {tablename} REFERENCING {rows} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION log_changes()")
+        return
+
+    for tablename in ('actors', 'movies'):
+        for event_name, action in ACTIONS.items():
+            row = 'OLD' if event_name == 'DELETE' else 'NEW'
+            op.execute(
+                f"CREATE TRIGGER {tablename}_changes_{event_name.lower()} "
+                f"AFTER {event_name} ON {tablename} BEGIN\n"
+                f"INSERT INTO changes (table_name, action, entity_id) VALUES "
+                f"('{tablename}', '{action}', {row}.id);\nEND")
+
+
+def downgrade():
+    postgres = op.get_bind().dialect.name == 'postgresql'
+    for tablename in ('actors', 'movies'):
+        for event_name in ACTIONS:
+            trigger = f'{tablename}_changes_{event_name.lower()}'
+            op.execute(f'DROP TRIGGER {trigger} ON {tablename}' if postgres else f'DROP TRIGGER {trigger}')
+    if postgres:
+        op.execute('DROP FUNCTION log_changes()')
+    op.drop_index('ix_changes_created_at', table_name='changes')
+    op.drop_table('changes')
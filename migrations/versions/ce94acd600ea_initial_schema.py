@@ -0,0 +1,44 @@
+"""initial schema
+
+Revision ID: ce94acd600ea
+Revises: 
+Create Date: 2026-10-18 10:02:11.418230
+
+Databases created before migrations were added (by db.create_all)
+already have these tables - mark them as up to date with
+`flask db stamp ce94acd600ea` before running `flask db upgrade`.
+Databases built from capstone.psql are stamped with a later revision,
+see the README.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ce94acd600ea'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('actors',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('age', sa.Integer(), nullable=True),
+    sa.Column('gender', sa.Enum('MALE', 'FEMALE', 'NON_BINARY', 'OTHER', name='genderchoices'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('movies',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(), nullable=True),
+    sa.Column('release_date', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('movies')
+    op.drop_table('actors')
+    sa.Enum(name='genderchoices').drop(op.get_bind(), checkfirst=True)
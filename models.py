@@ -1,25 +1,196 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime
+from datetime import datetime
+from sqlalchemy import BigInteger, Column, String, Integer, DateTime, ForeignKey, Index, Table, func
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
 from enum import Enum
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from flask_migrate import Migrate
 import json
-from dotenv import load_dotenv
 
-load_dotenv()
+from pooling import pool_config, engine_options, statement_timeout_hook
+from settings import load_env
+from timing import timed
+
+load_env()
+
+
+'''
+RoutingSession
+Sends reads to a replica when the app has a replica router (see
+flaskr.replicas) and it picks one for the current request, everything
+else - and any flush - goes to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get('replica_router')
+        if router is not None and not self._flushing:
+            engine = router.read_engine(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+'''
+SQLAlchemy which accepts an engine_hooks entry in SQLALCHEMY_ENGINE_OPTIONS,
+callables run with each engine as it is created, e.g. to register events
+'''
+class SQLAlchemy(BaseSQLAlchemy):
+    def create_engine(self, sa_url, engine_opts):
+        hooks = engine_opts.pop('engine_hooks', ())
+        engine = super().create_engine(sa_url, engine_opts)
+        for hook in hooks:
+            hook(engine)
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 db = SQLAlchemy()
+migrate = Migrate()
 
 database_path = os.getenv("database_path")
+#comma separated urls of read replicas of database_path
+replica_paths = [path for path in os.getenv("DATABASE_REPLICA_PATHS", "").split(",") if path]
 
 ########
 #setup db
 
-def setup_db(app, database_path=database_path):
+# replica_paths are bound as replica_0, replica_1...
+# pool_options override the DB_POOL_* environment settings, see
+# pooling.pool_config
+def setup_db(app, database_path=database_path, replica_paths=replica_paths, **pool_options):
+    config = pool_config(**pool_options)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = {
+        f"replica_{i}": path for i, path in enumerate(replica_paths)}
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = os.getenv("SQLALCHEMY_TRACK_MODIFICATIONS")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+        engine_options(database_path, config),
+        engine_hooks=[statement_timeout_hook(config)])
+    app.config["DB_POOL_CONFIG"] = config
     db.app = app
     db.init_app(app)
-    db.create_all()
-    
+    migrate.init_app(app, db, include_object=include_object)
+
+
+## Creates the missing tables on the primary (replicas get their schema
+# from it) - for local and test databases, deployed ones are upgraded with
+# flask db upgrade. Not part of setup_db, so starting a worker doesn't
+# connect to the database or introspect its schema
+def init_db(app):
+    with app.app_context():
+        db.create_all(bind=None)
+
+
+## Called in each forked worker (see gunicorn.conf.py) - connections
+# opened before the fork are shared with the parent, so the worker starts
+# with fresh pools without closing them
+def reset_engines(app):
+    with app.app_context():
+        for bind in [None] + list(app.config["SQLALCHEMY_BINDS"] or ()):
+            engine = db.get_engine(app, bind=bind)
+            engine.pool = engine.pool.recreate()
+
+
+######
+#write notifications
+
+'''
+Callbacks run after a write to actors or movies has committed,
+called with the table name and the kind of write (insert, update
+or delete). Writes that bypass the models (bulk endpoints) call
+notify_write themselves.
+'''
+write_listeners = []
+
+def notify_write(tablename, action):
+    for listener in write_listeners:
+        listener(tablename, action)
+
+######
+#table versions
+
+'''
+TableVersion Model
+    String table_name - PK
+    Integer version - bumped in the same transaction as every write
+    Datetime updated_at - time of the last write
+
+A single row lookup tells whether a table changed, used for ETags
+and Last-Modified on the read endpoints
+'''
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+#dialects with INSERT ... ON CONFLICT DO UPDATE
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+## Call before committing a write to tablename
+# session defaults to db.session. A single upsert, so concurrent first
+# writes to a table without a row don't race to insert it
+def bump_version(tablename, session=None):
+    session = db.session() if session is None else session
+    now = datetime.utcnow()
+    table = TableVersion.__table__
+    insert = UPSERT_INSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        session.execute(
+            insert(table)
+            .values(table_name=tablename, version=1, updated_at=now)
+            .on_conflict_do_update(
+                index_elements=[table.c.table_name],
+                set_={'version': table.c.version + 1, 'updated_at': now})
+        )
+        return
+    result = session.execute(
+        table.update()
+        .where(table.c.table_name == tablename)
+        .values(version=table.c.version + 1, updated_at=now)
+    )
+    if result.rowcount == 0:
+        session.add(TableVersion(table_name=tablename, version=1, updated_at=now))
+
+## returns (version, updated_at), (0, None) for a table never written to
+def get_table_version(tablename):
+    row = db.session.query(TableVersion.version, TableVersion.updated_at) \
+        .filter(TableVersion.table_name == tablename).one_or_none()
+    return (row.version, row.updated_at) if row else (0, None)
+
+## get_table_version for several tables in one lookup, as a list in the
+# order of tablenames
+def get_table_versions(tablenames):
+    rows = db.session.query(TableVersion.table_name, TableVersion.version,
+                            TableVersion.updated_at) \
+        .filter(TableVersion.table_name.in_(tablenames)).all()
+    found = {row.table_name: (row.version, row.updated_at) for row in rows}
+    return [found.get(tablename, (0, None)) for tablename in tablenames]
+
+######
+#castings
+
+'''
+castings - which actors are cast in which movies
+    Integer actor_id - FK actors.id
+    Integer movie_id - FK movies.id
+
+The primary key (actor_id, movie_id) serves an actor's filmography and
+ix_castings_movie_id a movie's cast. Rows go with their actor or movie.
+'''
+
+castings = Table(
+    'castings', db.Model.metadata,
+    Column('actor_id', Integer, ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Column('movie_id', Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_castings_movie_id', 'movie_id')
+)
 
 ######
 
@@ -39,6 +210,11 @@ Actor Model
     String name
     Integer Age
     String gender
+    Datetime updated_at - set on insert & update
+    movies - the movies the actor is cast in (castings)
+
+Indexes match the list endpoint filters - gender & age range, and
+case-insensitive name prefix (text_pattern_ops so LIKE 'x%' can use it)
 '''
 
 class Actor(db.Model):
@@ -48,31 +224,55 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(Integer)
     gender = Column(db.Enum(GenderChoices))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    movies = orm.relationship(
+        'Movie', secondary=castings, back_populates='actors', order_by='Movie.id')
+
+    __table_args__ = (
+        Index('ix_actors_gender_age', gender, age),
+        Index(
+            'ix_actors_name_lower',
+            func.lower(name).label('name_lower'),
+            postgresql_ops={'name_lower': 'text_pattern_ops'}
+        ),
+    )
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'insert')
   
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'update')
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'delete')
 
     def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age, 
-            'gender': self.gender.value if self.gender else None
-        }
+        with timed('format'):
+            return {
+                'id': self.id,
+                'name': self.name,
+                'age': self.age, 
+                'gender': self.gender.value if self.gender else None
+            }
 
 '''
 Movie Model
     Integer id - PK
     String title
     Datetime Release Date
+    Datetime updated_at - set on insert & update
+    actors - the movie's cast (castings)
+
+Indexes match the list endpoint filters - release date range & sort,
+and case-insensitive title prefix
 '''
 
 class Movie(db.Model):
@@ -81,26 +281,310 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(db.DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    actors = orm.relationship(
+        'Actor', secondary=castings, back_populates='movies', order_by='Actor.id')
+
+    __table_args__ = (
+        Index('ix_movies_release_date', release_date),
+        Index(
+            'ix_movies_title_lower',
+            func.lower(title).label('title_lower'),
+            postgresql_ops={'title_lower': 'text_pattern_ops'}
+        ),
+    )
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'insert')
   
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'update')
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__, 'delete')
+
+    ## Casting changes bump the castings version only - the actor and
+    # movie rows themselves are unchanged
+    def add_actor(self, actor):
+        if actor in self.actors:
+            return
+        self.actors.append(actor)
+        bump_version(castings.name)
+        db.session.commit()
+        notify_write(castings.name, 'insert')
+
+    def remove_actor(self, actor):
+        self.actors.remove(actor)
+        bump_version(castings.name)
+        db.session.commit()
+        notify_write(castings.name, 'delete')
+
+    def format(self):
+        with timed('format'):
+            return {
+                'id': self.id,
+                'title': self.title,
+                'release_date': self.release_date 
+            }
+
+
+######
+#search
+
+'''
+Full-text search columns, postgres only (see flaskr.search)
+    tsvector search_vector - generated from the name / title with the
+                             'simple' configuration (no stemming, names
+                             aren't english words), GIN indexed
+    GIN trigram index on the lowercased name / title, for fuzzy matches
+
+They aren't mapped - only search reads them - and are created by
+after_create DDL here and by the add_search migration.
+'''
+SEARCH_COLUMNS = {'actors': 'name', 'movies': 'title'}
+
+def search_ddl(tablename, column):
+    return [
+        f"ALTER TABLE {tablename} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+        f"(to_tsvector('simple', coalesce({column}, ''))) STORED",
+        f"CREATE INDEX ix_{tablename}_search_vector ON {tablename} USING gin (search_vector)",
+        f"CREATE INDEX ix_{tablename}_{column}_trgm ON {tablename} "
+        f"USING gin (lower({column}) gin_trgm_ops)"
+    ]
+
+event.listen(db.Model.metadata, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+for _table in (Actor.__table__, Movie.__table__):
+    for _statement in search_ddl(_table.name, SEARCH_COLUMNS[_table.name]):
+        event.listen(_table, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+
+SEARCH_SCHEMA_NAMES = {'search_vector'} | {
+    name for tablename, column in SEARCH_COLUMNS.items()
+    for name in (f'ix_{tablename}_search_vector', f'ix_{tablename}_{column}_trgm')}
+
+## Alembic autogenerate filter - leaves the search columns and indexes,
+# which aren't in the models, alone
+def include_object(object, name, type_, reflected, compare_to):
+    return not (reflected and compare_to is None and name in SEARCH_SCHEMA_NAMES)
+
+
+######
+#stats
+
+'''
+StatCount Model
+    String stat - e.g. actors_by_gender
+    String bucket - e.g. MALE, or 'unknown' for rows without the value
+    Integer count - rows in the bucket
+
+Summary counts behind /stats (see flaskr.stats), kept up to date by
+triggers on actors and movies in the same transaction as every write -
+through the models, the bulk endpoints or the async app alike. On
+postgres the triggers run once per statement over its transition tables,
+elsewhere (sqlite) once per row.
+'''
+
+class StatCount(db.Model):
+    __tablename__ = 'stat_counts'
+
+    stat = Column(String, primary_key=True)
+    bucket = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+#the triggers are created with stat_counts, after the tables they watch
+StatCount.__table__.add_is_dependent_on(Actor.__table__)
+StatCount.__table__.add_is_dependent_on(Movie.__table__)
+
+AGE_BUCKET_SIZE = 10
+
+## {table: {stat: SQL of the bucket of row}}, row is the table name or a
+# trigger's NEW / OLD / transition table
+def stat_buckets(dialect, row):
+    if dialect == 'postgresql':
+        year = f"CAST(CAST(EXTRACT(YEAR FROM {row}.release_date) AS INTEGER) AS TEXT)"
+    else:
+        year = f"strftime('%Y', {row}.release_date)"
+    return {
+        'actors': {
+            'actors_by_gender': f"CAST({row}.gender AS TEXT)",
+            'actors_by_age': f"CAST({row}.age / {AGE_BUCKET_SIZE} * {AGE_BUCKET_SIZE} AS TEXT)"
+        },
+        'movies': {
+            'movies_by_release_year': year
+        }
+    }
+
+## SELECT of (stat, bucket, delta) for each row of source and stat of tablename
+def stat_changes(dialect, tablename, source, delta):
+    return ' UNION ALL '.join(
+        f"SELECT '{stat}' AS stat, coalesce({bucket}, 'unknown') AS bucket, {delta} AS delta "
+        f"FROM {source}"
+        for stat, bucket in stat_buckets(dialect, source)[tablename].items())
+
+_UPSERT_STATS = (
+    "INSERT INTO stat_counts (stat, bucket, count) "
+    "SELECT stat, bucket, sum(delta) FROM ({changes}) changes "
+    "GROUP BY stat, bucket HAVING sum(delta) <> 0 ORDER BY stat, bucket "
+    "ON CONFLICT (stat, bucket) DO UPDATE SET count = stat_counts.count + excluded.count")
+
+## SELECT of (stat, bucket, count) counted from scratch over every row
+def stats_count_sql(dialect):
+    changes = ' UNION ALL '.join(
+        stat_changes(dialect, tablename, tablename, 1) for tablename in ('actors', 'movies'))
+    return f"SELECT stat, bucket, sum(delta) AS count FROM ({changes}) changes GROUP BY stat, bucket"
+
+## Counts every row from scratch into an empty stat_counts
+def stats_rebuild_sql(dialect):
+    return f"INSERT INTO stat_counts (stat, bucket, count) {stats_count_sql(dialect)}"
+
+## The trigger functions and triggers which maintain stat_counts
+def stats_ddl(dialect):
+    statements = []
+    for tablename in ('actors', 'movies'):
+        if dialect == 'postgresql':
+            new = stat_changes(dialect, tablename, 'new_rows', 1)
+            old = stat_changes(dialect, tablename, 'old_rows', -1)
+            statements.append(f"""
+CREATE OR REPLACE FUNCTION {tablename}_stats() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {_UPSERT_STATS.format(changes=new)};
+    ELSIF TG_OP = 'DELETE' THEN
+        {_UPSERT_STATS.format(changes=old)};
+    ELSE
+        {_UPSERT_STATS.format(changes=new + ' UNION ALL ' + old)};
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql""")
+            for event_name, tables in (('INSERT', 'NEW TABLE AS new_rows'),
+                                       ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+                                       ('DELETE', 'OLD TABLE AS old_rows')):
+                statements.append(
+                    f"CREATE TRIGGER {tablename}_stats_{event_name.lower()} "
+                    f"AFTER {event_name} ON {tablename} REFERENCING {tables} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION {tablename}_stats()")
+            continue
+
+        for event_name, rows in (('INSERT', (('NEW', 1),)),
+                                 ('UPDATE', (('OLD', -1), ('NEW', 1))),
+                                 ('DELETE', (('OLD', -1),))):
+            upserts = ''.join(
+                f"INSERT INTO stat_counts (stat, bucket, count) "
+                f"VALUES ('{stat}', coalesce({bucket}, 'unknown'), {delta}) "
+                f"ON CONFLICT (stat, bucket) DO UPDATE SET count = count + excluded.count;\n"
+                for row, delta in rows
+                for stat, bucket in stat_buckets(dialect, row)[tablename].items())
+            statements.append(
+                f"CREATE TRIGGER {tablename}_stats_{event_name.lower()} "
+                f"AFTER {event_name} ON {tablename} BEGIN\n{upserts}END")
+    return statements
+
+@event.listens_for(StatCount.__table__, 'after_create')
+def create_stat_triggers(target, connection, **kw):
+    dialect = connection.dialect.name
+    for statement in stats_ddl(dialect):
+        connection.exec_driver_sql(statement)
+    #the watched tables may already have rows
+    connection.exec_driver_sql(stats_rebuild_sql(dialect))
+
+
+######
+#change log
+
+'''
+Change Model
+    BigInteger seq - PK, increases with every change, the SSE event id
+    String table_name - actors or movies
+    String action - create, patch or delete
+    Integer entity_id - id of the row
+    Datetime created_at
+
+One row per created, patched or deleted actor or movie, written by
+triggers in the transaction of the write - so every writer is logged
+(models, bulk endpoints, the async app). On postgres the triggers hold
+a transaction-level advisory lock from the log insert to the commit, so
+seq order is commit order and a reader resuming after a seq can't miss
+a change committed later with a lower seq. See flaskr.changes.
+'''
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    table_name = Column(String, nullable=False)
+    action = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    #seqs of pruned rows are never handed out again on sqlite
+    __table_args__ = (
+        Index('ix_changes_created_at', 'created_at'),
+        {'sqlite_autoincrement': True}
+    )
 
     def format(self):
         return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date 
+            'seq': self.seq,
+            'type': self.table_name[:-1],
+            'action': self.action,
+            'id': self.entity_id
         }
 
+Change.__table__.add_is_dependent_on(Actor.__table__)
+Change.__table__.add_is_dependent_on(Movie.__table__)
+
+#actions logged for each kind of write
+CHANGE_ACTIONS = {'INSERT': 'create', 'UPDATE': 'patch', 'DELETE': 'delete'}
+#advisory lock key of the change log writers
+CHANGE_LOG_LOCK = 7240
 
+## The trigger functions and triggers which log changes
+def changes_ddl(dialect):
+    if dialect == 'postgresql':
+        statements = [f"""
+CREATE OR REPLACE FUNCTION log_changes() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock({CHANGE_LOG_LOCK});
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO changes (table_name, action, entity_id)
+        SELECT TG_TABLE_NAME, 'delete', id FROM old_rows ORDER BY id;
+    ELSE
+        INSERT INTO changes (table_name, action, entity_id)
+        SELECT TG_TABLE_NAME, CASE TG_OP WHEN 'INSERT' THEN 'create' ELSE 'patch' END, id
+        FROM new_rows ORDER BY id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql"""]
+        for tablename in ('actors', 'movies'):
+            for event_name in CHANGE_ACTIONS:
+                rows = 'OLD TABLE AS old_rows' if event_name == 'DELETE' else 'NEW TABLE AS new_rows'
+                statements.append(
+                    f"CREATE TRIGGER {tablename}_changes_{event_name.lower()} "
+                    f"AFTER {event_name} ON {tablename} REFERENCING {rows} "
+                    f"FOR EACH STATEMENT EXECUTE FUNCTION log_changes()")
+        return statements
 
+    return [
+        f"CREATE TRIGGER {tablename}_changes_{event_name.lower()} "
+        f"AFTER {event_name} ON {tablename} BEGIN\n"
+        f"INSERT INTO changes (table_name, action, entity_id) VALUES "
+        f"('{tablename}', '{action}', {'OLD' if event_name == 'DELETE' else 'NEW'}.id);\nEND"
+        for tablename in ('actors', 'movies')
+        for event_name, action in CHANGE_ACTIONS.items()
+    ]
 
+@event.listens_for(Change.__table__, 'after_create')
+def create_change_triggers(target, connection, **kw):
+    for statement in changes_ddl(connection.dialect.name):
+        connection.exec_driver_sql(statement)
 
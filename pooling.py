@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+
+'''
+TimedQueuePool
+QueuePool which records how long checkouts wait for a connection
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value not in (None, '') else default
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+'''
+Pool configuration, each setting is read from the environment unless
+given explicitly
+    pool_size - DB_POOL_SIZE, connections kept open per process
+    max_overflow - DB_MAX_OVERFLOW, extra connections under load
+    pool_timeout - DB_POOL_TIMEOUT, seconds to wait for a connection
+    pool_recycle - DB_POOL_RECYCLE, seconds before a connection is replaced
+    pool_pre_ping - DB_POOL_PRE_PING, test connections on checkout
+    statement_timeout - DB_STATEMENT_TIMEOUT, milliseconds (postgres)
+    external_pooler - DB_EXTERNAL_POOLER, running behind PgBouncer in
+                      transaction mode: no client-side pool and no
+                      session state (statement_timeout is SET LOCAL
+                      per transaction)
+'''
+def pool_config(**overrides):
+    config = {
+        'pool_size': _env_int('DB_POOL_SIZE', 5),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', True),
+        'statement_timeout': _env_int('DB_STATEMENT_TIMEOUT', 0),
+        'external_pooler': _env_bool('DB_EXTERNAL_POOLER', False)
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+
+## SQLALCHEMY_ENGINE_OPTIONS for a database url and pool config
+def engine_options(database_path, config):
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        #in-memory sqlite needs its single static connection
+        return {}
+
+    postgres = url.get_backend_name() == 'postgresql'
+    options = {'pool_pre_ping': config['pool_pre_ping']}
+    if url.get_backend_name() == 'sqlite':
+        #pooled sqlite connections move between request threads
+        options['connect_args'] = {'check_same_thread': False}
+
+    if config['external_pooler']:
+        #the external pooler owns the connections
+        options['poolclass'] = NullPool
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': config['pool_size'],
+        'max_overflow': config['max_overflow'],
+        'pool_timeout': config['pool_timeout'],
+        'pool_recycle': config['pool_recycle']
+    })
+    if postgres and config['statement_timeout']:
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={config['statement_timeout']}"
+        }
+    return options
+
+
+## The asyncio driver url for database_path, e.g. postgresql+asyncpg
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+def async_database_url(database_path, config):
+    url = make_url(database_path)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'postgresql' and config['external_pooler']:
+        url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+    return url
+
+
+## create_async_engine options for a database url and pool config
+# asyncpg takes statement_timeout as a server setting. It prepares every
+# statement, so behind PgBouncer in transaction mode both its cache and
+# the dialect's (see async_database_url) are turned off
+def async_engine_options(database_path, config):
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        #aiosqlite opens a connection per checkout for files
+        return {'poolclass': StaticPool} if url.database in (None, '', ':memory:') else {}
+
+    postgres = url.get_backend_name() == 'postgresql'
+    options = {'pool_pre_ping': config['pool_pre_ping']}
+    connect_args = {}
+
+    if config['external_pooler']:
+        options['poolclass'] = NullPool
+        if postgres:
+            connect_args['statement_cache_size'] = 0
+            options['connect_args'] = connect_args
+        return options
+
+    options.update({
+        'pool_size': config['pool_size'],
+        'max_overflow': config['max_overflow'],
+        'pool_timeout': config['pool_timeout'],
+        'pool_recycle': config['pool_recycle']
+    })
+    if postgres and config['statement_timeout']:
+        connect_args['server_settings'] = {
+            'statement_timeout': str(config['statement_timeout'])}
+        options['connect_args'] = connect_args
+    return options
+
+
+## Engine hook for external pooler mode - session settings would leak to
+# other clients of a PgBouncer server connection, so they are per transaction
+def statement_timeout_hook(config):
+    def hook(engine):
+        if not (config['external_pooler'] and config['statement_timeout']):
+            return
+        if engine.dialect.name != 'postgresql':
+            return
+
+        @event.listens_for(engine, 'begin')
+        def set_local_statement_timeout(connection):
+            connection.exec_driver_sql(
+                f"SET LOCAL statement_timeout = {int(config['statement_timeout'])}")
+    return hook
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'timeout': pool.timeout()
+        })
+    if isinstance(pool, TimedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'wait_total_ms': round(pool.wait_total * 1000, 3),
+                'wait_max_ms': round(pool.wait_max * 1000, 3),
+                'wait_avg_ms': round(pool.wait_total * 1000 / pool.checkouts, 3)
+                if pool.checkouts else 0.0
+            })
+    return stats
@@ -0,0 +1,16 @@
+import os
+from dotenv import load_dotenv
+
+
+'''
+.env is read once per process, by whichever module reads its settings
+first (auth or models) - later calls are no-ops. Variables already in
+the environment win over the file.
+'''
+_loaded = False
+
+def load_env():
+    global _loaded
+    if not _loaded:
+        load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+        _loaded = True
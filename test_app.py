@@ -1,11 +1,40 @@
 
+import asyncio
+import gzip
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import json
+from datetime import datetime
+from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, orm
 
 from flaskr import create_app
-from models import setup_db, Actor, Movie
+from models import (
+    db, bump_version, get_table_version, init_db, reset_engines, setup_db, Actor, Movie, GenderChoices
+)
+from auth.auth import AuthError, check_permissions, compile_permissions
+from auth.jwks import JWKSKeyStore, JWKSError
+from auth.token_cache import TokenCache
+from auth.rate_limit import LocalRateLimitBackend, RateLimiter, init_rate_limits
+from auth.auth import token_cache
+from flaskr.cache import LocalCacheBackend
+from flaskr.serializer import Serializer, orjson, rows_to_dicts
+from flaskr.compression import CompressedBodyCache, compress_stream
+from pooling import TimedQueuePool, pool_config, engine_options, pool_stats
+from flaskr.replicas import ReplicaRouter
+from flaskr.asgi import create_asgi_app
+from flaskr.metrics import Histogram, Metrics, init_metrics
+from flaskr.admission import AdmissionControl, init_admission
+from flaskr.changes import ChangeFeed, init_changes, load_changes, prune_changes
+from flaskr.stats import compute_stats, rebuild_stats, stored_stats, verify_stats
+from flaskr.query_debug import QueryDebugger, capture_queries, init_query_debug, normalize
+from timing import timed
 
 class CapstoneTestCase(unittest.TestCase):
 
@@ -63,6 +92,141 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data["success"])
         self.assertTrue(len(data["movies"]))
 
+    """Testing actors are paginated with a keyset cursor"""
+    def test_get_actors_paginated(self):
+        res = self.client().get('/actors?limit=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data["actors"]), 1)
+        self.assertTrue(data["next_cursor"])
+
+        res = self.client().get(f'/actors?limit=1&cursor={data["next_cursor"]}')
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_data["actors"][0]["id"], data["actors"][0]["id"])
+
+    def test_get_movies_invalid_limit(self):
+        for limit in ('abc', '1.5', '0', '-1'):
+            res = self.client().get(f'/movies?limit={limit}')
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_invalid_cursor(self):
+        res = self.client().get('/movies?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    """Testing list filters, sorting and field projection"""
+    def test_get_actors_filtered(self):
+        res = self.client().get('/actors?gender=MALE&age_min=18&age_max=99')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data["actors"]))
+        for actor in data["actors"]:
+            self.assertEqual(actor["gender"], "MALE")
+            self.assertTrue(18 <= actor["age"] <= 99)
+
+    def test_get_actors_sorted_projection(self):
+        res = self.client().get('/actors?sort=-age&fields=age')
+        data = json.loads(res.data)
+        ages = [actor["age"] for actor in data["actors"] if actor["age"] is not None]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data["actors"][0].keys()), {"id", "age"})
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+    def test_get_movies_title_prefix(self):
+        res = self.client().get('/movies?title=Movie&release_date_from=2020-01-01')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for movie in data["movies"]:
+            self.assertTrue(movie["title"].startswith("Movie"))
+
+    def test_get_movies_unknown_field(self):
+        res = self.client().get('/movies?fields=budget')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    """Testing full-table exports stream json and ndjson"""
+    def test_export_actors(self):
+        res = self.client().get('/actors/export')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertTrue(len(data["actors"]))
+
+    def test_export_movies_ndjson(self):
+        res = self.client().get('/movies/export?format=ndjson')
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(lines))
+        self.assertIn("title", json.loads(lines[0]))
+
+    """Testing list responses are cached until the next write"""
+    def test_get_actors_cached_until_write(self):
+        self.client().get('/actors?limit=5')
+        res = self.client().get('/actors?limit=5')
+        self.assertEqual(res.headers["X-Cache"], "HIT")
+
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        self.client().post("/actors", json={"name": "Cache Actor", "age": 30}, headers=header)
+
+        res = self.client().get('/actors?limit=5')
+        self.assertEqual(res.headers["X-Cache"], "MISS")
+
+    """Testing single actor & movie retrieval"""
+    def test_get_actor(self):
+        res = self.client().get('/actors/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["actor"]["id"], 1)
+
+    def test_get_movie_does_not_exist(self):
+        res = self.client().get('/movies/9999')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
+    """Testing conditional GETs answer 304 until the table changes"""
+    def test_get_movies_not_modified(self):
+        res = self.client().get('/movies')
+        etag = res.headers["ETag"]
+        self.assertTrue(res.headers["Last-Modified"])
+
+        res = self.client().get('/movies', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+        new_movie = Movie(title='ETag Movie', release_date='2024-03-19')
+        new_movie.insert()
+
+        res = self.client().get('/movies', headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    """Testing responses are gzipped when the client accepts it"""
+    def test_export_actors_gzip(self):
+        res = self.client().get('/actors/export', headers={"Accept-Encoding": "gzip"})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertTrue(len(data["actors"]))
+
     """Testing deletion of actor from database - covering success
      and failures on 422 and unauthorized"""
     def test_delete_actor_success(self):
@@ -225,6 +389,120 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data["success"], False)
 
+    """Testing bulk creation of actors and movies - covering success,
+     validation failure and unauthorized"""
+    def test_bulk_create_actors(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        new_actors = [
+            {"name": "Bulk Actor 1", "age": 30, "gender": "MALE"},
+            {"name": "Bulk Actor 2", "age": "41", "gender": "FEMALE"}
+        ]
+
+        res = self.client().post("/actors/bulk", json=new_actors, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["created"], 2)
+        self.assertTrue(all(result["id"] for result in data["results"]))
+
+    def test_bulk_create_actors_invalid_item(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        new_actors = [
+            {"name": "Bulk Actor 3", "age": 30},
+            {"age": 30, "gender": "UNKNOWN"}
+        ]
+
+        res = self.client().post("/actors/bulk", json=new_actors, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data["success"], False)
+        self.assertEqual(data["results"][0]["index"], 1)
+
+    def test_bulk_create_movies_ndjson(self):
+        header = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        body = '{"title": "Bulk Movie 1", "release_date": "2024-03-19"}\n' \
+               '{"title": "Bulk Movie 2", "release_date": "Fri, 11 Oct 2024 00:00:00 GMT"}\n'
+
+        res = self.client().post("/movies/bulk", data=body,
+                                 content_type="application/x-ndjson", headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["created"], 2)
+
+    def test_bulk_create_movies_unauthorized(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+
+        res = self.client().post("/movies/bulk", json=[{"title": "Bulk Movie"}], headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+
+    """Testing bulk update and deletion by id list - covering success,
+     missing selection and unauthorized"""
+    def test_bulk_patch_actors(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        body = {"ids": [1, 2], "changes": {"age": 50}}
+
+        res = self.client().patch("/actors/bulk", json=body, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(sorted(data["ids"]), [1, 2])
+        self.assertEqual(data["count"], 2)
+
+    def test_bulk_patch_actors_without_selection(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+
+        res = self.client().patch("/actors/bulk", json={"changes": {"age": 50}}, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+    def test_bulk_patch_actors_invalid_ids(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+
+        for ids in ("23", [True], [1.9], ["1"], {"1": 2}):
+            res = self.client().patch("/actors/bulk", json={"ids": ids, "changes": {"age": 50}},
+                                      headers=header)
+            self.assertEqual(res.status_code, 400)
+
+    def test_bulk_delete_movies(self):
+        header = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        new_movie = Movie(title='Bulk Delete Movie', release_date='2024-03-19')
+        new_movie.insert()
+
+        res = self.client().delete("/movies/bulk", json={"ids": [new_movie.id, 9999]}, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["ids"], [new_movie.id])
+        self.assertEqual(data["count"], 1)
+
+    def test_bulk_delete_actors_not_authorized(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+
+        res = self.client().delete("/actors/bulk", json={"ids": [1]}, headers=header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data["success"], False)
+
     """Testing update of actors from database - covering success
      and failure on unauthorized"""
     def test_update_actor(self):
@@ -277,6 +555,1175 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertEqual(data['success'], False)
 
+    """Testing casting an actor in a movie and removing them"""
+    def test_cast_actor(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        new_movie = Movie(title='Cast Movie', release_date='2024-03-19')
+        new_movie.insert()
+        new_actor = Actor(name='Cast Actor', age=30, gender='FEMALE')
+        new_actor.insert()
+
+        res = self.client().post(f'/movies/{new_movie.id}/actors', json={'actor_id': new_actor.id}, headers=header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [new_actor.id])
+
+        res = self.client().get(f'/actors/{new_actor.id}/movies')
+        self.assertEqual([movie['id'] for movie in json.loads(res.data)['movies']], [new_movie.id])
+
+        res = self.client().delete(f'/movies/{new_movie.id}/actors/{new_actor.id}', headers=header)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(f'/movies/{new_movie.id}/actors')
+        self.assertEqual(json.loads(res.data)['actors'], [])
+
+    def test_cast_actor_unauthorized(self):
+        header = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+
+        res = self.client().post('/movies/1/actors', json={'actor_id': 1}, headers=header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    """This class tests the in-process JWKS cache against a local key file"""
+
+    def setUp(self):
+        self.now = 0
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'jwks.json')
+        self.write_keys(['key-1'])
+        self.store = JWKSKeyStore(
+            f'file://{self.path}',
+            ttl=60,
+            min_refresh_interval=10,
+            clock=lambda: self.now
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_keys(self, kids):
+        keys = [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'}
+                for kid in kids]
+        with open(self.path, 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    """Testing keys are fetched once and then served from memory"""
+    def test_key_set_is_cached(self):
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+    """Testing unknown kids trigger a refetch, but no more than once per interval"""
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('key-1')
+        self.now = 5
+        self.assertIsNone(self.store.get_key('missing'))
+        self.assertEqual(self.store.fetch_count, 1)
+
+        self.write_keys(['key-1', 'key-2'])
+        self.now = 11
+        self.assertEqual(self.store.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.store.fetch_count, 2)
+
+    """Testing a stale key set is still served while refreshing in the background"""
+    def test_stale_key_set_is_served_while_revalidating(self):
+        self.store.get_key('key-1')
+        os.remove(self.path)
+        self.now = 61
+        self.assertEqual(self.store.get_key('key-1')['kid'], 'key-1')
+
+    """Testing a failed first fetch is reported"""
+    def test_first_fetch_failure_raises(self):
+        os.remove(self.path)
+        with self.assertRaises(JWKSError):
+            self.store.get_key('key-1')
+
+    """Testing async lookups fetch in a worker thread and then hit memory"""
+    def test_get_key_async(self):
+        key = asyncio.run(self.store.get_key_async('key-1'))
+        self.assertEqual(key['kid'], 'key-1')
+        os.remove(self.path)
+        self.assertEqual(asyncio.run(self.store.get_key_async('key-1'))['kid'], 'key-1')
+        self.assertEqual(self.store.fetch_count, 1)
+
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    """This class tests the verified token cache"""
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = TokenCache(max_size=2, clock=lambda: self.now)
+
+    """Testing a cached payload is returned until the token expires"""
+    def test_hit_until_expiry(self):
+        self.cache.put('token', {'sub': 'a', 'exp': 1100}, frozenset(['get:actors']))
+        payload, permissions = self.cache.get('token')
+        self.assertEqual(payload['sub'], 'a')
+        self.assertIn('get:actors', permissions)
+
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+
+    """Testing the least recently used token is evicted once full"""
+    def test_lru_eviction(self):
+        self.cache.put('one', {'exp': 2000})
+        self.cache.put('two', {'exp': 2000})
+        self.cache.get('one')
+        self.cache.put('three', {'exp': 2000})
+
+        self.assertIsNotNone(self.cache.get('one'))
+        self.assertIsNone(self.cache.get('two'))
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+    """Testing nothing is cached when the cache is switched off"""
+    def test_disabled(self):
+        self.cache.enabled = False
+        self.cache.put('token', {'exp': 2000})
+        self.assertIsNone(self.cache.get('token'))
+
+
+
+class CheckPermissionsTestCase(unittest.TestCase):
+
+    """This class tests permission checks against compiled permission sets"""
+
+    def setUp(self):
+        self.payload = {'permissions': ['create:actor', 'patch:actor']}
+        self.granted = compile_permissions(self.payload)
+
+    def test_all_required_permissions(self):
+        self.assertTrue(check_permissions(
+            frozenset(['create:actor', 'patch:actor']), self.payload, self.granted))
+
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions(
+                frozenset(['create:actor', 'delete:actor']), self.payload, self.granted)
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_any_of_permissions(self):
+        self.assertTrue(check_permissions(
+            (), self.payload, self.granted, any_of=['delete:actor', 'patch:actor']))
+
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions(
+                (), self.payload, self.granted, any_of=['delete:actor', 'create:movie'])
+        self.assertEqual(ctx.exception.status_code, 403)
+
+    def test_missing_permissions_claim(self):
+        with self.assertRaises(AuthError) as ctx:
+            check_permissions('create:actor', {})
+        self.assertEqual(ctx.exception.status_code, 400)
+
+
+
+class LocalCacheBackendTestCase(unittest.TestCase):
+
+    """This class tests the in-process response cache backend"""
+
+    def setUp(self):
+        self.now = 0
+        self.backend = LocalCacheBackend(max_entries=2, clock=lambda: self.now)
+
+    def test_entries_expire(self):
+        self.backend.set('key', b'body', 30)
+        self.assertEqual(self.backend.get('key'), b'body')
+
+        self.now = 30
+        self.assertIsNone(self.backend.get('key'))
+
+    def test_lru_eviction(self):
+        self.backend.set('one', b'1', 30)
+        self.backend.set('two', b'2', 30)
+        self.backend.get('one')
+        self.backend.set('three', b'3', 30)
+
+        self.assertEqual(self.backend.get('one'), b'1')
+        self.assertIsNone(self.backend.get('two'))
+
+
+
+class SqliteTestCase(unittest.TestCase):
+
+    """Base of the test cases run against the app on a fresh sqlite database,
+    subclasses add their rows in seed"""
+
+    #replica databases, bound as replica_0, replica_1, ...
+    replicas = 0
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.url = f'sqlite:///{directory}/capstone.db'
+        self.app = create_app()
+        setup_db(self.app, self.url, replica_paths=[
+            f'sqlite:///{directory}/replica_{i}.db' for i in range(self.replicas)])
+        init_db(self.app)
+        with self.app.app_context():
+            self.seed()
+
+    def seed(self):
+        pass
+
+
+class ResponseCacheTestCase(SqliteTestCase):
+
+    """This class tests cached responses are keyed on the table versions"""
+
+    def seed(self):
+        Actor(name='Tom Hanks', age=64, gender=GenderChoices.MALE).insert()
+
+    def test_write_from_another_process_invalidates(self):
+        client = self.app.test_client()
+        client.get('/actors')
+        self.assertEqual(client.get('/actors').headers['X-Cache'], 'HIT')
+
+        #no write listener of this app runs
+        engine = create_engine(self.url)
+        self.addCleanup(engine.dispose)
+        with orm.Session(engine) as session:
+            session.add(Actor(name='Emma Stone', age=32))
+            bump_version('actors', session)
+            session.commit()
+
+        res = client.get('/actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(res.get_json()['actors']), 2)
+
+    def test_encoded_query_values_keyed_apart(self):
+        with self.app.app_context():
+            Actor(name='Tommy Lee Jones', age=75, gender=GenderChoices.MALE).insert()
+        client = self.app.test_client()
+
+        crafted = client.get('/actors?name=tom%26sort%3D-age')
+        res = client.get('/actors?name=tom&sort=-age')
+
+        self.assertEqual(crafted.get_json()['actors'], [])
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual([a['name'] for a in res.get_json()['actors']],
+                         ['Tommy Lee Jones', 'Tom Hanks'])
+
+    def test_cache_per_app(self):
+        self.app.test_client().get('/actors')
+        other = create_app()
+        setup_db(other, self.url)
+
+        self.assertEqual(other.test_client().get('/actors').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.app.extensions['response_cache'].stats()['misses'], 1)
+
+    def test_admin_endpoints_require_token(self):
+        for path in ('/admin/cache', '/admin/pool'):
+            res = self.app.test_client().get(path)
+            self.assertEqual(res.status_code, 401)
+
+    def test_disabled(self):
+        self.app.extensions['response_cache'].enabled = False
+        self.assertNotIn('X-Cache', self.app.test_client().get('/actors').headers)
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    """This class tests the json serializers write identical output"""
+
+    def setUp(self):
+        self.data = {
+            'success': True,
+            'movies': [{'id': 1, 'title': 'Movie 1',
+                        'release_date': datetime(2023, 1, 1)}],
+            'actors': [{'id': 1, 'name': 'Actor 1', 'age': 30,
+                        'gender': GenderChoices.MALE}]
+        }
+
+    def test_stdlib_serializer(self):
+        data = json.loads(Serializer('json').dumps(self.data))
+        self.assertEqual(data['movies'][0]['release_date'], '2023-01-01T00:00:00')
+        self.assertEqual(data['actors'][0]['gender'], 'MALE')
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        self.assertEqual(Serializer('orjson').dumps(self.data),
+                         Serializer('json').dumps(self.data))
+
+    def test_rows_to_dicts(self):
+        rows = [(1, 'Actor 1'), (2, 'Actor 2')]
+        self.assertEqual(rows_to_dicts(rows, ['id', 'name']),
+                         [{'id': 1, 'name': 'Actor 1'}, {'id': 2, 'name': 'Actor 2'}])
+
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    """This class tests response body compression helpers"""
+
+    def test_compress_stream(self):
+        chunks = ['{"id":1}\n', b'{"id":2}\n']
+        body = b''.join(compress_stream(chunks, 'gzip'))
+        self.assertEqual(gzip.decompress(body), b'{"id":1}\n{"id":2}\n')
+
+    def test_compressed_body_is_reused(self):
+        cache = CompressedBodyCache(max_entries=4)
+        first = cache.get_or_compress('"actors-1"', b'x' * 2048, 'gzip')
+        second = cache.get_or_compress('"actors-1"', b'x' * 2048, 'gzip')
+
+        self.assertIs(first, second)
+        self.assertEqual(gzip.decompress(first), b'x' * 2048)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+class PoolingTestCase(unittest.TestCase):
+
+    """This class tests the connection pool configuration"""
+
+    def setUp(self):
+        self.config = pool_config(pool_size=2, max_overflow=1, pool_timeout=5,
+                                  statement_timeout=1000, external_pooler=False)
+
+    def test_engine_options(self):
+        options = engine_options('postgresql://localhost/capstone', self.config)
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (2, 1))
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=1000'})
+
+    def test_external_pooler_has_no_pool(self):
+        config = dict(self.config, external_pooler=True)
+        options = engine_options('postgresql://localhost/capstone', config)
+        self.assertEqual(options['poolclass'].__name__, 'NullPool')
+        self.assertNotIn('connect_args', options)
+
+    def test_sqlite_connections_can_change_threads(self):
+        options = engine_options('sqlite:///capstone.db', self.config)
+        self.assertEqual(options['connect_args'], {'check_same_thread': False})
+
+    def test_in_memory_sqlite_keeps_default_pool(self):
+        self.assertEqual(engine_options('sqlite://', self.config), {})
+
+    def test_pool_stats(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        url = f'sqlite:///{directory}/pool.db'
+        options = engine_options(url, self.config)
+        engine = create_engine(url, **options)
+        self.addCleanup(engine.dispose)
+
+        with engine.connect() as connection:
+            stats = pool_stats(engine)
+            self.assertEqual(stats['pool'], 'TimedQueuePool')
+            self.assertEqual(stats['checked_out'], 1)
+        stats = pool_stats(engine)
+        self.assertEqual((stats['checked_out'], stats['checkouts']), (0, 1))
+
+
+class ReplicaRouterTestCase(unittest.TestCase):
+
+    """This class tests replica selection, health and stickiness"""
+
+    def setUp(self):
+        self.now = 0
+        self.router = ReplicaRouter(sticky_seconds=5, retry_interval=30,
+                                    clock=lambda: self.now)
+        self.router.backend.clock = lambda: self.now
+        self.engines = {'replica_0': create_engine('sqlite://'),
+                        'replica_1': create_engine('sqlite://')}
+
+    def choose(self):
+        return self.router.choose(sorted(self.engines), self.engines.get)
+
+    def test_round_robin(self):
+        self.assertEqual([self.choose() for _ in range(3)],
+                         ['replica_0', 'replica_1', 'replica_0'])
+
+    def test_down_replica_is_skipped_until_it_recovers(self):
+        self.router.mark_down('replica_0')
+        self.assertEqual([self.choose() for _ in range(2)], ['replica_1', 'replica_1'])
+
+        self.now = 31
+        self.assertEqual([self.choose() for _ in range(2)], ['replica_0', 'replica_1'])
+
+    def test_failed_probe_keeps_replica_down(self):
+        self.engines['replica_0'] = create_engine('sqlite:////nonexistent/replica.db')
+        self.router.mark_down('replica_0')
+        self.now = 31
+        self.assertEqual(self.choose(), 'replica_1')
+        self.assertFalse(self.router.is_up('replica_0', self.engines.get))
+
+    def test_no_replica_up(self):
+        for key in self.engines:
+            self.router.mark_down(key)
+        self.assertIsNone(self.choose())
+
+    def test_stickiness_expires(self):
+        self.router.stick('sticky:client')
+        self.assertIsNotNone(self.router.backend.get('sticky:client'))
+        self.now = 6
+        self.assertIsNone(self.router.backend.get('sticky:client'))
+
+
+class ReplicaRoutingTestCase(SqliteTestCase):
+
+    """This class tests reads are routed to a replica database"""
+
+    replicas = 1
+
+    def setUp(self):
+        super().setUp()
+        self.router = self.app.extensions['replica_router']
+
+    def seed(self):
+        Actor(name='Primary', age=30, gender=GenderChoices.FEMALE).insert()
+        replica = db.get_engine(self.app, bind='replica_0')
+        Actor.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actor.__table__.insert(), {
+                'name': 'Replica', 'age': 40, 'gender': GenderChoices.MALE,
+                'updated_at': datetime(2023, 1, 1)})
+
+    def names(self):
+        res = self.app.test_client().get('/actors')
+        return [actor['name'] for actor in res.get_json()['actors']]
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.names(), ['Replica'])
+
+    def test_reads_after_write_go_to_primary(self):
+        self.router.stick('sticky:127.0.0.1')
+        self.assertEqual(self.names(), ['Primary'])
+
+    def test_replica_response_not_served_after_write(self):
+        #cached under the replica's table versions
+        self.assertEqual(self.names(), ['Replica'])
+        self.router.stick('sticky:127.0.0.1')
+        self.assertEqual(self.names(), ['Primary'])
+
+    def test_sticky_lookup_once_per_request(self):
+        lookups = []
+        get = self.router.backend.get
+        self.router.backend.get = lambda key: lookups.append(key) or get(key)
+        self.app.extensions['response_cache'].enabled = False
+
+        self.assertEqual(self.names(), ['Replica'])
+        self.assertEqual(lookups, ['sticky:127.0.0.1'])
+
+    def test_reads_go_to_primary_when_replica_is_down(self):
+        self.router.mark_down('replica_0')
+        self.assertEqual(self.names(), ['Primary'])
+
+
+class AsyncAppTestCase(unittest.IsolatedAsyncioTestCase):
+
+    """This class tests the ASGI app against a local sqlite database"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        url = f'sqlite:///{directory}/async.db'
+
+        engine = create_engine(url)
+        db.Model.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(Actor.__table__.insert(), [
+                {'name': f'Actor {i}', 'age': 20 + i, 'gender': GenderChoices.MALE}
+                for i in range(3)])
+        engine.dispose()
+
+        self.app = create_asgi_app(url)
+        self.client = self.app.test_client()
+
+    async def asyncTearDown(self):
+        await self.app.extensions['async_engine'].dispose()
+
+    async def test_list_is_paginated(self):
+        res = await self.client.get('/actors?limit=2&sort=-age')
+        data = await res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([a['age'] for a in data['actors']], [22, 21])
+
+        res = await self.client.get(f'/actors?limit=2&sort=-age&cursor={data["next_cursor"]}')
+        data = await res.get_json()
+        self.assertEqual([a['age'] for a in data['actors']], [20])
+        self.assertIsNone(data['next_cursor'])
+
+    async def test_export_ndjson(self):
+        res = await self.client.get('/actors/export?format=ndjson')
+        lines = (await res.get_data()).splitlines()
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2, 3])
+
+    async def test_movie_dates_parsed(self):
+        self.addCleanup(token_cache.clear)
+        payload = {'sub': 'user|a', 'exp': time.time() + 60,
+                   'permissions': ['create:movie', 'patch:movie', 'patch:actor']}
+        token_cache.put('token-a', payload, frozenset(payload['permissions']))
+        headers = {'Authorization': 'Bearer token-a'}
+
+        res = await self.client.post('/movies', headers=headers,
+                                     json={'title': 'Cast Away', 'release_date': '2000-12-22'})
+        self.assertEqual(res.status_code, 200)
+        movie = (await res.get_json())['actor']
+
+        res = await self.client.patch(f'/movies/{movie["id"]}', headers=headers,
+                                      json={'release_date': 'Fri, 05 Jan 2001 00:00:00 GMT'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((await res.get_json())['movie']['release_date'], '2001-01-05T00:00:00')
+
+        res = await self.client.patch('/actors/1', headers=headers, json={'age': '41'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((await res.get_json())['actor']['age'], 41)
+
+    async def test_writes_limited_by_subject(self):
+        init_rate_limits(self.app, RateLimiter(rate=1, burst=1))
+        self.addCleanup(token_cache.clear)
+        payload = {'sub': 'user|a', 'exp': time.time() + 60, 'permissions': ['delete:actor']}
+        token_cache.put('token-a', payload, frozenset(payload['permissions']))
+        headers = {'Authorization': 'Bearer token-a'}
+
+        first = await self.client.delete('/actors/1', headers=headers)
+        second = await self.client.delete('/actors/2', headers=headers)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '1')
+        self.assertEqual((await second.get_json())['message'], 'Too Many Requests')
+
+    async def test_error_bodies_match_wsgi_app(self):
+        res = await self.client.get('/actors/100')
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(await res.get_json(),
+                         {'success': False, 'error': 404, 'message': 'Not Found'})
+
+        res = await self.client.get('/actors?sort=gender')
+        self.assertEqual(res.status_code, 400)
+
+        res = await self.client.post('/actors', json={'name': 'New'})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual((await res.get_json())['message'], 'Unauthorized')
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    """This class tests request timing and the Prometheus metrics"""
+
+    def make_app(self, sample_rate):
+        app = Flask(__name__)
+        engine = create_engine('sqlite://')
+        self.addCleanup(engine.dispose)
+
+        @app.route('/items/<int:id>')
+        def item(id):
+            with engine.connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+                connection.exec_driver_sql('SELECT 2')
+            with timed('format'):
+                return {'id': id}
+
+        metrics = init_metrics(app, Metrics(sample_rate=sample_rate))
+        return app, metrics
+
+    def test_sampled_request_has_server_timing(self):
+        app, metrics = self.make_app(sample_rate=1)
+        res = app.test_client().get('/items/1')
+
+        timing = res.headers['Server-Timing']
+        self.assertIn('sql;dur=', timing)
+        self.assertIn('desc="2 statements"', timing)
+        self.assertIn('format;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+        text = metrics.render()
+        self.assertIn('http_requests_total{method="GET",route="/items/<int:id>",status="200"} 1', text)
+        self.assertIn('http_request_sql_statements_bucket{method="GET",route="/items/<int:id>",le="2"} 1', text)
+        self.assertIn('phase="sql"', text)
+
+    def test_unsampled_request_is_only_counted(self):
+        app, metrics = self.make_app(sample_rate=0)
+        res = app.test_client().get('/items/1')
+
+        self.assertNotIn('Server-Timing', res.headers)
+        text = metrics.render()
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/items/<int:id>"} 1', text)
+        self.assertNotIn('phase=', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('latency', 'Latency.', ('route',), (1, 5))
+        for value in (0.5, 1, 3, 7):
+            histogram.observe(value, '/')
+
+        lines = histogram.samples()
+        self.assertIn('latency_bucket{route="/",le="1"} 2', lines)
+        self.assertIn('latency_bucket{route="/",le="5"} 3', lines)
+        self.assertIn('latency_bucket{route="/",le="+Inf"} 4', lines)
+        self.assertIn('latency_sum{route="/"} 11.500000', lines)
+
+
+class PaginationTestCase(SqliteTestCase):
+
+    """This class tests sorted keyset pages, nulls last in both directions"""
+
+    def seed(self):
+        for i, age in enumerate((40, None, 30, 40, None, 30, 50)):
+            Actor(name=f'Actor {i}', age=age, gender=GenderChoices.MALE).insert()
+
+    def walk(self, sort):
+        ids, cursor = [], None
+        while True:
+            query = f'/actors?limit=2&sort={sort}' + (f'&cursor={cursor}' if cursor else '')
+            res = self.app.test_client().get(query)
+            self.assertEqual(res.status_code, 200)
+            data = res.get_json()
+            ids += [actor['id'] for actor in data['actors']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_ascending_pages_end_with_nulls(self):
+        self.assertEqual(self.walk('age'), [3, 6, 1, 4, 7, 2, 5])
+
+    def test_descending_pages_end_with_nulls(self):
+        self.assertEqual(self.walk('-age'), [7, 1, 4, 3, 6, 2, 5])
+
+
+class CastingTestCase(SqliteTestCase):
+
+    """This class tests casts, filmographies and list includes"""
+
+    def seed(self):
+        actors = [Actor(name=f'Actor {i}', age=30 + i, gender=GenderChoices.MALE)
+                  for i in range(4)]
+        for actor in actors:
+            actor.insert()
+        for i in range(6):
+            movie = Movie(title=f'Movie {i}', release_date=datetime(2020, 1, i + 1))
+            movie.insert()
+            movie.add_actor(actors[i % 4])
+            movie.add_actor(actors[(i + 1) % 4])
+
+    def test_castings_version_upserted(self):
+        #castings had no table_versions row before its first write
+        with self.app.app_context():
+            self.assertEqual(get_table_version('castings')[0], 12)
+            bump_version('castings')
+            db.session.commit()
+            self.assertEqual(get_table_version('castings')[0], 13)
+
+    def test_get_cast(self):
+        res = self.app.test_client().get('/movies/1/actors')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Actor 0', 'Actor 1'])
+
+    def test_get_filmography(self):
+        res = self.app.test_client().get('/actors/1/movies')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Movie 0', 'Movie 3', 'Movie 4'])
+
+    def test_get_cast_movie_does_not_exist(self):
+        res = self.app.test_client().get('/movies/99/actors')
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_movies_include_actors(self):
+        res = self.app.test_client().get('/movies?include=actors&fields=title&limit=2')
+        data = res.get_json()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['title'], 'Movie 0')
+        self.assertEqual([actor['id'] for actor in data['movies'][1]['actors']], [2, 3])
+        self.assertNotIn('release_date', data['movies'][0])
+
+    def test_include_query_count_does_not_grow_with_page(self):
+        counts = []
+        for limit in (1, 6):
+            with capture_queries() as queries:
+                res = self.app.test_client().get(f'/actors?include=movies&limit={limit}')
+            self.assertEqual(res.status_code, 200)
+            counts.append(len(queries))
+
+        #table versions, the page and the movies of the page
+        self.assertEqual(counts, [3, 3])
+
+    def test_include_unknown_relationship(self):
+        res = self.app.test_client().get('/actors?include=agents')
+        self.assertEqual(res.status_code, 400)
+
+    def test_casting_changes_list_etag(self):
+        client = self.app.test_client()
+        etag = client.get('/movies?include=actors').headers['ETag']
+        plain_etag = client.get('/movies').headers['ETag']
+
+        with self.app.app_context():
+            Movie.query.get(1).add_actor(Actor.query.get(3))
+
+        self.assertNotEqual(client.get('/movies?include=actors').headers['ETag'], etag)
+        self.assertEqual(client.get('/movies').headers['ETag'], plain_etag)
+
+
+class SearchTestCase(SqliteTestCase):
+
+    """This class tests search, with the LIKE fallback of sqlite"""
+
+    def seed(self):
+        for name in ('Tom Hanks', 'Tommy Lee Jones', 'Emma Stone', '100% Real'):
+            Actor(name=name, age=40, gender=GenderChoices.MALE).insert()
+        for title in ('Tom', 'Top Gun', 'Cast Away'):
+            Movie(title=title, release_date=datetime(2000, 1, 1)).insert()
+
+    def search(self, query):
+        res = self.app.test_client().get(f'/search?{query}')
+        return res.status_code, res.get_json()
+
+    def test_search_ranks_exact_match_first(self):
+        status, data = self.search('q=tom')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([(hit['type'], hit['id']) for hit in data['results']],
+                         [('movie', 1), ('actor', 1), ('actor', 2)])
+        self.assertEqual(data['results'][0]['title'], 'Tom')
+
+    def test_search_matches_every_word_prefix(self):
+        status, data = self.search('q=lee%20tom')
+        self.assertEqual([hit['name'] for hit in data['results']], ['Tommy Lee Jones'])
+
+    def test_search_escapes_like_wildcards(self):
+        status, data = self.search('q=100%25')
+        self.assertEqual([hit['name'] for hit in data['results']], ['100% Real'])
+
+    def test_search_type(self):
+        status, data = self.search('q=to&type=movie')
+        self.assertEqual([hit['title'] for hit in data['results']], ['Tom', 'Top Gun'])
+
+    def test_search_paginated(self):
+        status, data = self.search('q=tom&limit=2')
+        self.assertEqual(len(data['results']), 2)
+
+        status, next_data = self.search(f'q=tom&limit=2&cursor={data["next_cursor"]}')
+        self.assertEqual([(hit['type'], hit['id']) for hit in next_data['results']],
+                         [('actor', 2)])
+        self.assertIsNone(next_data['next_cursor'])
+
+    def test_search_invalid_limit(self):
+        for limit in ('abc', '0'):
+            status, data = self.search(f'q=tom&limit={limit}')
+            self.assertEqual(status, 400)
+
+    def test_search_without_words(self):
+        status, data = self.search('q=%25%25')
+        self.assertEqual(status, 400)
+        self.assertEqual(data['success'], False)
+
+
+class StatsTestCase(SqliteTestCase):
+
+    """This class tests the summary counts behind /stats, kept by sqlite triggers"""
+
+    def seed(self):
+        Actor(name='Tom Hanks', age=64, gender=GenderChoices.MALE).insert()
+        Actor(name='Emma Stone', age=32, gender=GenderChoices.FEMALE).insert()
+        Actor(name='Nobody', age=None, gender=None).insert()
+        Movie(title='Cast Away', release_date=datetime(2000, 12, 22)).insert()
+
+    def stats(self):
+        res = self.app.test_client().get('/stats')
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_stats(self):
+        data = self.stats()
+
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actors'], {
+            'total': 3,
+            'by_gender': {'FEMALE': 1, 'MALE': 1, 'unknown': 1},
+            'by_age': {'30': 1, '60': 1, 'unknown': 1}
+        })
+        self.assertEqual(data['movies'], {'total': 1, 'by_release_year': {'2000': 1}})
+
+    def test_stats_follow_updates_and_deletes(self):
+        with self.app.app_context():
+            actor = Actor.query.filter_by(name='Tom Hanks').one()
+            actor.age = 65
+            actor.update()
+            Movie.query.one().delete()
+
+        data = self.stats()
+        self.assertEqual(data['actors']['by_age'], {'30': 1, '60': 1, 'unknown': 1})
+        self.assertEqual(data['movies'], {'total': 0, 'by_release_year': {}})
+
+        with self.app.app_context():
+            actor = Actor.query.filter_by(name='Tom Hanks').one()
+            actor.age = 70
+            actor.gender = GenderChoices.FEMALE
+            actor.update()
+
+        data = self.stats()
+        self.assertEqual(data['actors']['by_age'], {'30': 1, '70': 1, 'unknown': 1})
+        self.assertEqual(data['actors']['by_gender'], {'FEMALE': 2, 'unknown': 1})
+
+    def test_stats_follow_multi_row_statements(self):
+        with self.app.app_context():
+            db.session.execute(Movie.__table__.insert(), [
+                {'title': f'Movie {i}', 'release_date': datetime(2001 + i % 2, 1, 1)}
+                for i in range(10)])
+            db.session.execute(Actor.__table__.update().values(age=Actor.age + 10))
+            db.session.execute(Actor.__table__.delete().where(Actor.gender.is_(None)))
+            db.session.commit()
+
+            self.assertEqual(verify_stats(), {})
+            self.assertEqual(stored_stats(), compute_stats())
+
+        data = self.stats()
+        self.assertEqual(data['actors']['total'], 2)
+        self.assertEqual(data['actors']['by_age'], {'40': 1, '70': 1})
+        self.assertEqual(data['movies']['by_release_year'], {'2000': 1, '2001': 5, '2002': 5})
+
+    def test_rebuild_stats(self):
+        with self.app.app_context():
+            db.session.execute(db.text("UPDATE stat_counts SET count = 7"))
+            db.session.commit()
+            mismatches = verify_stats()
+            self.assertEqual(mismatches['movies_by_release_year'], {'2000': (7, 1)})
+
+            rebuild_stats()
+            self.assertEqual(verify_stats(), {})
+        self.assertEqual(self.stats()['actors']['total'], 3)
+
+    def test_rebuild_stats_command(self):
+        runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            db.session.execute(db.text("DELETE FROM stat_counts WHERE stat = 'actors_by_age'"))
+            db.session.commit()
+
+        result = runner.invoke(args=['rebuild-stats', '--verify'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('actors_by_age 30: stored 0, computed 1', result.output)
+
+        result = runner.invoke(args=['rebuild-stats'])
+        self.assertEqual(result.exit_code, 0)
+        result = runner.invoke(args=['rebuild-stats', '--verify'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('stats are consistent', result.output)
+
+
+class ChangeFeedTestCase(SqliteTestCase):
+
+    """This class tests the change log and the /changes event stream"""
+
+    def setUp(self):
+        super().setUp()
+        self.feed = init_changes(self.app, ChangeFeed(
+            self.app, poll_interval=0.05, heartbeat=0.1, stream_timeout=0.5))
+        self.addCleanup(self.feed.stop)
+
+    def seed(self):
+        Actor(name='Tom Hanks', age=64, gender=GenderChoices.MALE).insert()
+        movie = Movie(title='Cast Away', release_date=datetime(2000, 12, 22))
+        movie.insert()
+        movie.title = 'Cast Away!'
+        movie.update()
+        movie.delete()
+
+    def events(self, body):
+        events = []
+        for block in body.split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in block.splitlines()
+                          if not line.startswith(':') and ': ' in line)
+            if 'id' in fields:
+                events.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+        return events
+
+    def test_writes_are_logged(self):
+        with self.app.app_context():
+            changes = load_changes(0, 10)
+        self.assertEqual([(c['seq'], c['type'], c['action'], c['id']) for c in changes], [
+            (1, 'actor', 'create', 1),
+            (2, 'movie', 'create', 1),
+            (3, 'movie', 'patch', 1),
+            (4, 'movie', 'delete', 1)
+        ])
+
+    def test_multi_row_statements_log_every_row(self):
+        with self.app.app_context():
+            db.session.execute(Actor.__table__.insert(), [{'name': f'Actor {i}'} for i in range(3)])
+            db.session.execute(Actor.__table__.update().values(age=30))
+            db.session.commit()
+            changes = load_changes(4, 10)
+        self.assertEqual([(c['action'], c['id']) for c in changes], [
+            ('create', 2), ('create', 3), ('create', 4),
+            ('patch', 1), ('patch', 2), ('patch', 3), ('patch', 4)
+        ])
+
+    def test_stream_from_offset(self):
+        res = self.app.test_client().get('/changes?after=2')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        body = res.get_data(as_text=True)
+        self.assertTrue(body.startswith('retry: '))
+        self.assertEqual(self.events(body), [
+            (3, 'patch', {'seq': 3, 'type': 'movie', 'action': 'patch', 'id': 1}),
+            (4, 'delete', {'seq': 4, 'type': 'movie', 'action': 'delete', 'id': 1})
+        ])
+        self.assertIn(': keep-alive', body)
+
+    def test_stream_resumes_from_last_event_id(self):
+        res = self.app.test_client().get('/changes?after=0', headers={'Last-Event-ID': '3'})
+        self.assertEqual([seq for seq, _, _ in self.events(res.get_data(as_text=True))], [4])
+
+    def test_stream_sends_new_changes(self):
+        def write():
+            with self.app.app_context():
+                Actor(name='Emma Stone', age=32).insert()
+        timer = threading.Timer(0.1, write)
+        timer.start()
+        self.addCleanup(timer.join)
+
+        res = self.app.test_client().get('/changes')
+        self.assertEqual(self.events(res.get_data(as_text=True)), [
+            (5, 'create', {'seq': 5, 'type': 'actor', 'action': 'create', 'id': 2})
+        ])
+
+    def test_subscribers_share_polls(self):
+        self.feed.start()
+        with self.app.app_context():
+            Actor(name='Emma Stone', age=32).insert()
+        self.feed.poll()
+
+        with capture_queries() as log:
+            for _ in range(10):
+                events = self.feed.events_after(4, timeout=0)
+                self.assertEqual([event['seq'] for event in events], [5])
+        self.assertEqual(len(log.queries), 0)
+
+    def test_stream_bad_offset(self):
+        res = self.app.test_client().get('/changes?after=abc')
+        self.assertEqual(res.status_code, 400)
+
+    def test_prune_changes(self):
+        with self.app.app_context():
+            self.assertEqual(prune_changes(days=1), 0)
+            db.session.execute(db.text("UPDATE changes SET created_at = '2000-01-01 00:00:00'"))
+            db.session.commit()
+            self.assertEqual(prune_changes(days=1), 4)
+            self.assertEqual(load_changes(0, 10), [])
+
+
+class RateLimitTestCase(SqliteTestCase):
+
+    """This class tests rate limits and load shedding"""
+
+    def test_token_bucket_refills(self):
+        now = [0.0]
+        backend = LocalRateLimitBackend(clock=lambda: now[0])
+
+        self.assertEqual([backend.take('k', 1, 2) for _ in range(3)], [0, 0, 1.0])
+        now[0] = 0.5
+        self.assertEqual(backend.take('k', 1, 2), 0.5)
+        now[0] = 1.0
+        self.assertEqual(backend.take('k', 1, 2), 0)
+
+    def test_anonymous_requests_not_limited_by_default(self):
+        init_rate_limits(self.app, RateLimiter(anonymous_rate=0.5, anonymous_burst=1))
+        client = self.app.test_client()
+
+        statuses = [client.get('/actors').status_code for _ in range(3)]
+
+        self.assertEqual(statuses, [200, 200, 200])
+
+    def test_anonymous_requests_limited_by_address(self):
+        init_rate_limits(self.app, RateLimiter(anonymous_rate=0.5, anonymous_burst=2,
+                                               anonymous_enabled=True))
+        client = self.app.test_client()
+
+        statuses = [client.get('/actors').status_code for _ in range(3)]
+        res = client.get('/movies')
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(res.headers['Retry-After'], '2')
+        self.assertEqual(res.get_json()['message'], 'Too Many Requests')
+
+    def test_exports_limited_by_address(self):
+        init_rate_limits(self.app, RateLimiter(anonymous_rate=0.5, anonymous_burst=1,
+                                               anonymous_enabled=True))
+        client = self.app.test_client()
+
+        self.assertEqual(client.get('/actors/export').status_code, 200)
+        self.assertEqual(client.get('/movies/export').status_code, 429)
+
+    def test_forwarded_addresses_limited_apart(self):
+        init_rate_limits(self.app, RateLimiter(anonymous_rate=0.5, anonymous_burst=1,
+                                               anonymous_enabled=True))
+        self.app.wsgi_app = ProxyFix(self.app.wsgi_app, x_for=1)
+        client = self.app.test_client()
+
+        first = client.get('/actors', headers={'X-Forwarded-For': '10.0.0.1'})
+        second = client.get('/actors', headers={'X-Forwarded-For': '10.0.0.1'})
+        other = client.get('/actors', headers={'X-Forwarded-For': '10.0.0.2'})
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(other.status_code, 200)
+
+    def test_token_without_subject_refused(self):
+        init_rate_limits(self.app, RateLimiter(rate=1, burst=1))
+        self.addCleanup(token_cache.clear)
+        payload = {'exp': time.time() + 60, 'permissions': ['delete:actor']}
+        token_cache.put('token-nosub', payload, frozenset(payload['permissions']))
+        client = self.app.test_client()
+
+        res = client.delete('/actors/99', headers={'Authorization': 'Bearer token-nosub'})
+
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(res.get_json()['message'], 'Subject not included in JWT.')
+
+    def test_requests_limited_by_subject(self):
+        init_rate_limits(self.app, RateLimiter(rate=1, burst=1))
+        self.addCleanup(token_cache.clear)
+        for token, sub in (('token-a', 'user|a'), ('token-b', 'user|b')):
+            payload = {'sub': sub, 'exp': time.time() + 60, 'permissions': ['delete:actor']}
+            token_cache.put(token, payload, frozenset(payload['permissions']))
+        client = self.app.test_client()
+
+        first = client.delete('/actors/99', headers={'Authorization': 'Bearer token-a'})
+        second = client.delete('/actors/99', headers={'Authorization': 'Bearer token-a'})
+        other = client.delete('/actors/99', headers={'Authorization': 'Bearer token-b'})
+
+        self.assertEqual(first.status_code, 422)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '1')
+        self.assertEqual(other.status_code, 422)
+
+    def test_requests_over_in_flight_cap_are_shed(self):
+        app = Flask(__name__)
+        admission = init_admission(app, AdmissionControl(max_in_flight=1, retry_after=2))
+        started, release = threading.Event(), threading.Event()
+
+        @app.route('/slow')
+        def slow():
+            started.set()
+            release.wait(5)
+            return {'success': True}
+
+        @app.route('/metrics')
+        def metrics():
+            return 'ok'
+
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(app.test_client().get('/slow')))
+        thread.start()
+        started.wait(5)
+
+        shed = app.test_client().get('/slow')
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed.headers['Retry-After'], '2')
+        self.assertEqual(app.test_client().get('/metrics').status_code, 200)
+
+        release.set()
+        thread.join()
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(app.test_client().get('/slow').status_code, 200)
+        self.assertEqual(admission.stats()['shed'], 1)
+
+
+class StartupTestCase(unittest.TestCase):
+
+    """This class tests building the app doesn't touch the database"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'capstone.db')
+        self.app = Flask(__name__)
+        setup_db(self.app, f'sqlite:///{self.path}')
+
+    def test_setup_db_does_not_connect(self):
+        self.assertFalse(os.path.exists(self.path))
+
+        init_db(self.app)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 0)
+
+    def test_reset_engines_replaces_pools(self):
+        with self.app.app_context():
+            pool = db.get_engine(self.app).pool
+        reset_engines(self.app)
+        with self.app.app_context():
+            self.assertIsNot(db.get_engine(self.app).pool, pool)
+
+
+class QueryDebugTestCase(SqliteTestCase):
+
+    """This class tests query counting and the N+1 and slow query checks"""
+
+    def seed(self):
+        for age in (30, 40, 50):
+            Actor(name=f'Actor {age}', age=age, gender=GenderChoices.FEMALE).insert()
+
+    def test_normalize_collapses_values(self):
+        self.assertEqual(
+            normalize("SELECT * FROM actors WHERE id IN (?, ?, ?) AND name = 'Ann'  LIMIT 10"),
+            'SELECT * FROM actors WHERE id IN (...) AND name = ? LIMIT ?')
+        self.assertEqual(normalize('SELECT * FROM actors WHERE id = %(id_1)s'),
+                         normalize('SELECT * FROM actors WHERE id = 7'))
+
+    """GET /actors looks up the table version and the page, whatever the page size"""
+    def test_get_actors_query_count(self):
+        with capture_queries() as queries:
+            res = self.app.test_client().get('/actors')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.get_json()['actors']), 3)
+        self.assertLessEqual(len(queries), 2, queries.report())
+        self.assertEqual(queries.repeated(threshold=1), [])
+
+    def test_get_actor_query_count(self):
+        with capture_queries() as queries:
+            res = self.app.test_client().get('/actors/1')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(queries), 2, queries.report())
+
+    def test_debug_mode_flags_repeated_and_slow_queries(self):
+        app = Flask(__name__)
+        engine = create_engine('sqlite://')
+        self.addCleanup(engine.dispose)
+
+        @app.route('/items')
+        def items():
+            with engine.connect() as connection:
+                for id in range(3):
+                    connection.exec_driver_sql('SELECT ? + 1', (id,))
+            return {'success': True}
+
+        init_query_debug(app, QueryDebugger(repeat_threshold=2, slow_ms=0), enabled=True)
+        with capture_queries() as queries:
+            with self.assertLogs('flaskr.query_debug', 'WARNING') as logs:
+                res = app.test_client().get('/items')
+
+        self.assertEqual(res.headers['X-Query-Count'], '3')
+        self.assertEqual(len(queries), 3)
+        self.assertIn('possible N+1 in GET /items: 3 x SELECT ? + ?', logs.output[0])
+        self.assertEqual(len([line for line in logs.output if 'slow query' in line]), 3)
+        self.assertIn('SCAN CONSTANT ROW', logs.output[1])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+import time
+from flask import g, has_request_context
+
+
+'''
+Request phase timings
+Time spent in each phase of a request (auth, jwks, sql, format, json...)
+is added up in g.timings as {phase: [seconds, count]} - but only for
+requests flaskr.metrics has chosen to sample, which set g.timings.
+Anywhere else these are no-ops, so auth and models can use them
+without depending on the app.
+'''
+def current_timings():
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+def record(timings, phase, seconds):
+    entry = timings.get(phase)
+    if entry is None:
+        timings[phase] = [seconds, 1]
+    else:
+        entry[0] += seconds
+        entry[1] += 1
+
+
+## with timed('auth'): ... adds the time taken to the phase
+class timed:
+    __slots__ = ('phase', 'timings', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.timings = current_timings()
+        if self.timings is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            record(self.timings, self.phase, time.perf_counter() - self.start)
+        return False